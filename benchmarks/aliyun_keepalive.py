@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+aliyunsdkcore 长连接复用压测
+
+本地起一个HTTPS桩服务(自签证书)，分别用每次新建连接和ConnectionPool复用连接
+发同样数量的请求，比较耗时和握手次数。
+
+    python benchmarks/aliyun_keepalive.py -n 500
+"""
+import os
+import sys
+import ssl
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "libs", "aliyun-python-sdk-core"))
+
+from aliyunsdkcore.http.connection_pool import ConnectionPool  # noqa
+
+BODY = '{"Message":"OK","RequestId":"bench","BizId":"1","Code":"OK"}'
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 头和body分两次写，不关Nagle会叠上40ms的延迟确认
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # 每个连接一个线程，keep-alive连接不会卡住其它请求
+    daemon_threads = True
+    handshakes = 0
+
+    def get_request(self):
+        sock, addr = BaseHTTPServer.HTTPServer.get_request(self)
+        self.handshakes += 1
+        return sock, addr
+
+    def handle_error(self, request, client_address):
+        # 客户端直接断开连接时服务端会读到EOF，压测不关心
+        pass
+
+
+def make_cert(path):
+    cert, key = os.path.join(path, "cert.pem"), os.path.join(path, "key.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                           "-keyout", key, "-out", cert, "-days", "1",
+                           "-subj", "/CN=127.0.0.1"],
+                          stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    return cert, key
+
+
+def start_server(cert, key):
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    server.socket = ssl.wrap_socket(server.socket, certfile=cert, keyfile=key, server_side=True)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def run(pool_factory, port, n):
+    context = ssl._create_unverified_context()
+    begin = time.time()
+    for i in range(n):
+        pool = pool_factory(context)
+        status, _, body = pool.request(True, "127.0.0.1", port, "GET", "/?Action=SendSms",
+                                       None, {}, timeout=10)
+        assert status == 200 and body == BODY
+    return time.time() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=500, help="请求次数")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        server = start_server(*make_cert(tmp))
+        port = server.server_address[1]
+
+        # max_idle_per_host=0：用完即关，等同于原来每次新建HTTPSConnection
+        before = server.handshakes
+        cost = run(lambda ctx: ConnectionPool(0, ssl_context=ctx), port, args.n)
+        print("new connection: %6.0f req/s  %.2f ms/req  handshakes=%s" % (
+            args.n / cost, cost * 1000 / args.n, server.handshakes - before))
+
+        shared = {}
+        before = server.handshakes
+        cost = run(lambda ctx: shared.setdefault("pool", ConnectionPool(ssl_context=ctx)),
+                   port, args.n)
+        print("keep-alive:     %6.0f req/s  %.2f ms/req  handshakes=%s" % (
+            args.n / cost, cost * 1000 / args.n, server.handshakes - before))
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
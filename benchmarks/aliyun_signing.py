@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+aliyunsdkcore RPC签名压测
+
+对同一个SendSmsRequest，分别用原来整体编码的签名方式和缓存静态参数后的
+rpc_signature_composer.get_signed_url签名，比较每秒签名次数，并核对两者签名一致。
+
+    python benchmarks/aliyun_signing.py -n 20000
+"""
+import os
+import sys
+import time
+import urllib
+import argparse
+import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "libs", "aliyun-python-sdk-core"))
+sys.path.insert(0, os.path.join(ROOT, "libs", "aliyun-python-sdk-dysmsapi"))
+
+from aliyunsdkcore.auth.composer import rpc_signature_composer as composer  # noqa
+from aliyunsdkcore.auth.algorithm import sha_hmac1  # noqa
+from aliyunsdkcore.utils import parameter_helper  # noqa
+from aliyunsdkdysmsapi.request.v20170525 import SendSmsRequest  # noqa
+
+AK = "LTAIbenchmarkak00"
+SECRET = "benchmarksecret0000000000000000"
+
+
+def standard_urlencode(query):
+    ret = urllib.urlencode(query)
+    return ret.replace('+', '%20').replace('*', '%2A').replace('%7E', '~')
+
+
+def reference_signed_url(params, ak, secret, accept_format, method, body_params, signer=sha_hmac1):
+    """
+    改动前的get_signed_url：每次都整体排序、编码全部参数
+    """
+    params["Timestamp"] = parameter_helper.get_iso_8061_date()
+    params["SignatureMethod"] = signer.get_signer_name()
+    params["SignatureType"] = signer.get_signer_type()
+    params["SignatureVersion"] = signer.get_singer_version()
+    params["SignatureNonce"] = parameter_helper.get_uuid()
+    params["AccessKeyId"] = ak
+    if accept_format is not None:
+        params["Format"] = accept_format
+    sign_params = dict(params)
+    sign_params.update(body_params)
+    string_to_sign = method + "&%2F&" + \
+        urllib.pathname2url(standard_urlencode(sorted(sign_params.items())))
+    params["Signature"] = signer.get_sign_string(string_to_sign, secret + '&')
+    return '/?' + standard_urlencode(params)
+
+
+def sms_params(i):
+    request = SendSmsRequest.SendSmsRequest()
+    request.set_TemplateCode("SMS_138690015")
+    request.set_TemplateParam('{"code":"%06d"}' % i)
+    request.set_OutId("bench-%s" % i)
+    request.set_SignName("小粉盒")
+    request.set_PhoneNumbers("1306475%04d" % (i % 10000))
+    params = dict(request.get_query_params())
+    params.update({"Version": request.get_version(), "Action": request.get_action_name(),
+                   "Format": "JSON", "RegionId": "cn-hangzhou"})
+    return params
+
+
+def check():
+    # 固定时间戳和随机数，两种方式的URL参数和签名应该完全一样
+    get_date, get_uuid = parameter_helper.get_iso_8061_date, parameter_helper.get_uuid
+    parameter_helper.get_iso_8061_date = lambda: "2018-07-01T00:00:00Z"
+    parameter_helper.get_uuid = lambda: "00000000-0000-0000-0000-000000000000"
+    try:
+        for i in range(100):
+            body = {"PhoneNumberJson": '["1306475%04d"]' % i} if i % 2 else {}
+            old = reference_signed_url(sms_params(i), AK, SECRET, "JSON", "POST", body)
+            new = composer.get_signed_url(sms_params(i), AK, SECRET, "JSON", "POST", body)
+            assert urlparse.parse_qs(old[2:]) == urlparse.parse_qs(new[2:]), (old, new)
+    finally:
+        parameter_helper.get_iso_8061_date, parameter_helper.get_uuid = get_date, get_uuid
+
+
+def run(sign, n):
+    requests = [sms_params(i) for i in range(n)]
+    begin = time.time()
+    for params in requests:
+        sign(params, AK, SECRET, "JSON", "GET", {})
+    return time.time() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000, help="签名次数")
+    args = parser.parse_args()
+
+    check()
+    for name, sign in [("full encode", reference_signed_url),
+                       ("cached static", composer.get_signed_url)]:
+        cost = run(sign, args.n)
+        print("%-14s %8.0f signs/s  %.1f us/sign" % (name, args.n / cost, cost * 1e6 / args.n))
+
+
+if __name__ == "__main__":
+    main()
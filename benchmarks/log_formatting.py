@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+日志格式化压测
+
+同一批典型的订单、设备日志记录，分别用LogFormatter和JsonFormatter格式化，
+比较每秒能格式化多少条。
+
+    python benchmarks/log_formatting.py -n 100000
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from log import LogFormatter, JsonFormatter, RpcContextFilter  # noqa
+from util import metrics  # noqa
+
+MESSAGES = [
+    ("[order](%s) 创建成功", ("20180701123000000001",)),
+    ("[order](%s) 支付成功 %s:%s", ("20180701123000000001", "微信", "oX8d0uF3")),
+    ("[device](%s-%s) 库存减少1个, 当前库存%s", ("D20180001", "A01", 7)),
+    ("[alipay] precreate %s", ({"out_trade_no": "20180701123000000001", "total_amount": 3.5},)),
+]
+
+
+def make_records(n):
+    records = []
+    context = RpcContextFilter()
+    with metrics.track("create_order"):
+        for i in range(n):
+            msg, args = MESSAGES[i % len(MESSAGES)]
+            record = logging.LogRecord("biz", logging.INFO, "biz.py", 75, msg, args, None)
+            context.filter(record)
+            records.append(record)
+    return records
+
+
+def run(formatter, records):
+    begin = time.time()
+    for record in records:
+        formatter.format(record)
+    return time.time() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000, help="日志条数")
+    args = parser.parse_args()
+
+    for name, formatter in [("text", LogFormatter(color=False)), ("json", JsonFormatter())]:
+        records = make_records(args.n)
+        cost = run(formatter, records)
+        print("%-5s %8.0f records/s  %.2f us/record" % (name, args.n / cost, cost * 1e6 / args.n))
+
+
+if __name__ == "__main__":
+    main()
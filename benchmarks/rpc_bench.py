@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+"""
+热点RPC压测
+
+按比例生成接近线上规模的数据(scale=1时1千台设备、2万条货道、500万订单、100万用户)，
+用nameko的worker_factory直接调用InvboxService，统计每个RPC的耗时和SQL条数，
+结果写成JSON，可以和之前某次提交的结果对比。
+
+    # sqlite内存库，1%的数据量
+    python benchmarks/rpc_bench.py --database sqlite --scale 0.01 -o bench-sqlite.json
+
+    # 本地MySQL，默认建在invbox_bench库里，--reuse跳过已经生成过的数据
+    python benchmarks/rpc_bench.py --database mysql --scale 1 --reuse \\
+        --compare bench-mysql-old.json -o bench-mysql.json
+
+支付网关换成本地桩，不会访问支付宝/微信。
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import subprocess
+import ujson as json
+
+from datetime import datetime as dte, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+logger = logging.getLogger("bench")
+
+# scale=1时的数据量
+VOLUMES = {
+    "devices": 1000,
+    "roads": 20000,
+    "orders": 5000000,
+    "users": 1000000,
+}
+
+ORDER_DAYS = 365            # 订单分布在最近多少天
+STAT_DAYS = 30              # 生成多少天的设备日统计
+ITEMS = 200
+ORDER_BATCH = 50000         # 订单分批生成、提交
+
+PENDING_RATIO = 0.0001      # 未完成订单的比例，cluster_heartbeat要扫描
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--mysql-database", default="invbox_bench",
+                        help="MySQL库名，不要用线上库")
+    parser.add_argument("--scale", type=float, default=0.01, help="数据量比例，1为线上规模")
+    parser.add_argument("--repeat", type=int, default=20, help="每个RPC调用次数")
+    parser.add_argument("--only", default="", help="只跑这些用例，逗号分隔")
+    parser.add_argument("--reuse", action="store_true", help="数据量一致时跳过生成(MySQL)")
+    parser.add_argument("--seed", type=int, default=20180701)
+    parser.add_argument("-o", "--output", default="", help="结果JSON文件")
+    parser.add_argument("--compare", default="", help="和之前的结果JSON对比")
+    return parser.parse_args()
+
+
+def setup_database(args):
+    """
+    models按配置在导入时建库，必须在导入models之前设置
+    """
+    os.environ["DATABASE"] = args.database
+    from config import config
+    config.mysql["database"] = args.mysql_database
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).strip()
+    except Exception:
+        return ""
+
+
+# ---------------------------------------------------------------- 数据生成
+
+def insert_rows(model, rows):
+    """
+    分块insert_many；sqlite单条语句最多999个参数
+    """
+    if not rows:
+        return
+    from models import db
+    from config import config
+
+    size = 999 // len(rows[0]) if config.database == "sqlite" else 2000
+    with db.atomic():
+        for i in range(0, len(rows), size):
+            model.insert_many(rows[i: i + size]).execute()
+
+
+def generate(volumes, rnd):
+    import models as M
+    import datastat
+    from const import OrderStatus, PayStatus, PayType
+
+    # 订单状态分布
+    status_weights = [(OrderStatus.DONE, 75), (OrderStatus.CLOSED, 20),
+                      (OrderStatus.REFUNDED, 3), (OrderStatus.DELIVER_FAILED, 2)]
+    paid_status = (OrderStatus.DONE, OrderStatus.REFUNDED, OrderStatus.DELIVER_FAILED)
+    pay_status = {OrderStatus.CREATED: PayStatus.UNPAY, OrderStatus.CLOSED: PayStatus.CLOSED,
+                  OrderStatus.REFUNDED: PayStatus.REFUND}
+
+    now = dte.now()
+    roads_per_device = max(1, volumes["roads"] // volumes["devices"])
+
+    M.Admin.create(mobile="13000000000", username="bench", role=0)
+    address_types = [M.AddressType.create(name=u"场地%s" % i).id for i in range(3)]
+    category = M.DeviceCategory.create(
+        name="bench", road_count=roads_per_device,
+        road_meta_list=json.dumps([{"upper_limit": 30, "lower_limit": 3}] * roads_per_device))
+    supplyers = [M.Supplyer.create(name="supplyer-%s" % i, mobile="131%08d" % i).id
+                 for i in range(50)]
+    brands = [M.ItemBrand.create(name="brand-%s" % i).id for i in range(20)]
+    image = M.Image.create(md5="bench", url="/media/image/bench.png")
+    categories = [M.ItemCategory.create(name="category-%s" % i, thumbnail=image, image=image).id
+                  for i in range(20)]
+    insert_rows(M.Item, [{"name": "item-%s" % i, "category": rnd.choice(categories),
+                          "brand": rnd.choice(brands), "basic_price": rnd.randint(100, 2000),
+                          "cost_price": 50} for i in range(ITEMS)])
+    items = [(i.id, i.basic_price) for i in M.Item.select(M.Item.id, M.Item.basic_price)]
+
+    insert_rows(M.Device, [{"no": "D%06d" % i, "name": "device-%s" % i, "category": category.id,
+                            "involved": True, "address": "address-%s" % i,
+                            "address_type": rnd.choice(address_types),
+                            "supplyer": rnd.choice(supplyers), "heartbeat_at": now,
+                            "is_stockout": False}
+                           for i in range(volumes["devices"])])
+    devices = [d for d, in M.Device.select(M.Device.id).tuples()]
+
+    rows = []
+    for device in devices:
+        for no in range(1, roads_per_device + 1):
+            item, price = rnd.choice(items)
+            rows.append({"no": "%02d" % no, "device": device, "item": item,
+                         "amount": rnd.randint(0, 30), "price": price})
+    insert_rows(M.Road, rows)
+    roads = list(M.Road.select(M.Road.id, M.Road.device, M.Road.item, M.Road.price).tuples())
+
+    for start in range(0, volumes["users"], ORDER_BATCH):
+        insert_rows(M.User, [{"username": "user-%07d" % i, "mobile": "170%08d" % i,
+                              "wxuserid": "wx%07d" % i}
+                             for i in range(start, min(start + ORDER_BATCH, volumes["users"]))])
+    first_user = M.User.select(M.User.id).order_by(M.User.id).get().id
+
+    statuses = [s for s, weight in status_weights for _ in range(weight)]
+    pending = int(volumes["orders"] * PENDING_RATIO)
+    for start in range(0, volumes["orders"], ORDER_BATCH):
+        rows = []
+        for i in range(start, min(start + ORDER_BATCH, volumes["orders"])):
+            road, device, item, price = rnd.choice(roads)
+            amount = rnd.randint(1, 3)
+            created_at = now - timedelta(seconds=rnd.randint(0, ORDER_DAYS * 86400))
+            status = OrderStatus.CREATED if i < pending else rnd.choice(statuses)
+            paid = status in paid_status
+            rows.append({
+                "no": "B%013d" % i,
+                "road": road, "device": device, "item": item,
+                "item_amount": amount,
+                "price": price * amount,
+                "pay_money": price * amount if paid else 0,
+                "pay_status": pay_status.get(status, PayStatus.PAIED),
+                "pay_type": rnd.choice([PayType.WX, PayType.ALIPAY]),
+                "pay_at": created_at + timedelta(seconds=30) if paid else None,
+                "refund_money": price * amount if status == OrderStatus.REFUNDED else 0,
+                "status": status,
+                "user": first_user + rnd.randint(0, volumes["users"] - 1)
+                        if paid and rnd.random() < 0.6 else None,
+                "deliver_at": created_at + timedelta(seconds=60) if status == OrderStatus.DONE else None,
+                "created_at": created_at,
+            })
+        insert_rows(M.Order, rows)
+        logger.info("orders %s/%s", start + len(rows), volumes["orders"])
+
+    rows = []
+    for day in range(STAT_DAYS):
+        day = (now - timedelta(days=day)).strftime("%Y-%m-%d")
+        for device in devices:
+            rows.append({"day": day, "device": device, "flows": rnd.randint(50, 500),
+                         "stays": rnd.randint(10, 100), "clicks": rnd.randint(0, 50),
+                         "visitors": rnd.randint(0, 40)})
+    insert_rows(M.DayDeviceStat, rows)
+
+    # 聚合表和计数字段按订单回填
+    M.HourOrderStat.rebuild(now - timedelta(days=ORDER_DAYS + 1), now + timedelta(hours=1))
+    datastat.rebuild_user_counters()
+    datastat.rebuild_item_counters()
+
+
+def prepare_data(args, volumes):
+    import models as M
+
+    if args.reuse and args.database == "mysql":
+        try:
+            if M.Device.select().count() == volumes["devices"] and \
+                    M.Order.select().count() >= volumes["orders"]:
+                logger.info("reuse existing data")
+                return 0
+        except Exception:
+            M.db.rollback()
+
+    begin = time.time()
+    M.db.drop_tables(M.MODEL_TABLES, safe=True)
+    M.create_tables()
+    generate(volumes, random.Random(args.seed))
+    return time.time() - begin
+
+
+# ---------------------------------------------------------------- 压测用例
+
+class StubPay(object):
+    """
+    本地支付网关桩
+    """
+
+    def precreate(self, order_no, price, notify_url, item_info, device_info):
+        return {"code_url": "https://qr.example.com/%s" % order_no}
+
+    def refund(self, order_no, money):
+        return {}
+
+    def query_trade(self, order_no):
+        return {}
+
+
+def make_cases(service, rnd):
+    """
+    {用例名: (RPC名, 每次调用前生成参数的函数)}
+    """
+    import models as M
+    import dashboard
+    from const import PayType
+
+    admin = {"role": 0, "id": M.Admin.get().id}
+    devices = list(M.Device.select(M.Device.id, M.Device.no))
+    sellable = list(M.Road.select(M.Road, M.Device)
+                          .join(M.Device)
+                          .where(M.Road.amount > 0)
+                          .limit(1000))
+    # 后台常翻的是前几页
+    order_pages = min(100, M.Order.select().count() // 10 + 1)
+    road_pages = min(100, M.Road.select().count() // 10 + 1)
+
+    def create_order():
+        road = rnd.choice(sellable)
+        return (road.device.no, road.item_id, 1, rnd.choice([PayType.WX, PayType.ALIPAY]), "https://notify.example.com"), {}
+
+    def get_orders_page():
+        return (), {"page": rnd.randint(1, order_pages), "query": [], "admin_info": admin}
+
+    def get_orders_export():
+        # 导出单台设备的订单
+        query = [[{"operator": "=", "attribute": "device", "value": rnd.choice(devices).id}]]
+        return (), {"query": query, "export": True, "admin_info": admin}
+
+    def get_roads():
+        return (), {"page": rnd.randint(1, road_pages), "query": [], "admin_info": admin}
+
+    def by_device():
+        return (rnd.choice(devices).no,), {}
+
+    def add_client_log():
+        return (rnd.choice(devices).no, "flow", {"count": rnd.randint(1, 5)}), {}
+
+    def no_args():
+        return (), {}
+
+    def cold_dashboard():
+        # 看板有进程内缓存，每次都测重新聚合的耗时
+        dashboard.clear_cache()
+        return (), {}
+
+    cases = {
+        "create_order": ("create_order", create_order),
+        "get_orders_page": ("get_orders", get_orders_page),
+        "get_orders_export": ("get_orders", get_orders_export),
+        "get_roads": ("get_roads", get_roads),
+        "get_categories_for_device": ("get_categories_for_device", by_device),
+        "cluster_heartbeat": ("cluster_heartbeat", no_args),
+        "add_client_log": ("add_client_log", add_client_log),
+    }
+    for name in dir(service):
+        if name.startswith("dashboard_"):
+            cases[name] = (name, cold_dashboard)
+    return cases
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_case(service, rpc_name, make_args, repeat):
+    from util import metrics
+
+    func = getattr(service, rpc_name)
+    devnull = open(os.devnull, "w")
+
+    def call():
+        args, kwargs = make_args()
+        tracker = metrics.Tracker(rpc_name)
+        metrics._local.tracker = tracker
+        stdout, sys.stdout = sys.stdout, devnull    # add_client_log会print
+        begin = time.time()
+        try:
+            res = func(*args, **kwargs)
+        finally:
+            sys.stdout = stdout
+            metrics._local.tracker = None
+        return time.time() - begin, tracker.sql_count, res
+
+    call()                              # 预热
+    costs = []
+    sql = []
+    errors = 0
+    for _ in range(repeat):
+        cost, sql_count, res = call()
+        costs.append(cost)
+        sql.append(sql_count)
+        if isinstance(res, dict) and res.get("resultCode", 0) < 0:
+            errors += 1
+
+    return {
+        "calls": repeat,
+        "errors": errors,
+        "mean_ms": round(sum(costs) * 1000 / repeat, 2),
+        "min_ms": round(min(costs) * 1000, 2),
+        "p50_ms": round(percentile(costs, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(costs, 0.95) * 1000, 2),
+        "max_ms": round(max(costs) * 1000, 2),
+        "avg_sql": round(float(sum(sql)) / repeat, 2),
+    }
+
+
+def compare(results, path):
+    with open(path) as f:
+        old = json.load(f)["results"]
+    print("%-32s %10s %10s %8s" % ("case", "old p50", "new p50", "change"))
+    for name in sorted(results):
+        if name not in old:
+            continue
+        before, after = old[name]["p50_ms"], results[name]["p50_ms"]
+        change = (after - before) / before * 100 if before else 0
+        print("%-32s %10.2f %10.2f %+7.1f%%" % (name, before, after, change))
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    setup_database(args)
+
+    from nameko.testing.services import worker_factory
+    from pay.manager import PayManager
+    from service.service import InvboxService
+
+    PayManager.get_pay_obj = classmethod(lambda cls, pay_type: StubPay())
+
+    volumes = dict((k, max(1, int(v * args.scale))) for k, v in VOLUMES.items())
+    generated = prepare_data(args, volumes)
+    logger.info("data ready in %.1fs: %s", generated, volumes)
+
+    service = worker_factory(InvboxService)
+    cases = make_cases(service, random.Random(args.seed))
+    only = set(filter(None, args.only.split(",")))
+
+    results = {}
+    for name in sorted(cases):
+        if only and name not in only:
+            continue
+        rpc_name, make_args = cases[name]
+        results[name] = run_case(service, rpc_name, make_args, args.repeat)
+        print("%-32s p50 %8.2fms  p95 %8.2fms  sql %6.1f" % (
+            name, results[name]["p50_ms"], results[name]["p95_ms"], results[name]["avg_sql"]))
+
+    report = {
+        "commit": git_commit(),
+        "database": args.database,
+        "scale": args.scale,
+        "volumes": volumes,
+        "repeat": args.repeat,
+        "generate_seconds": round(generated, 1),
+        "created_at": dte.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
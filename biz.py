@@ -7,14 +7,15 @@ import logging
 import random
 import ujson as json
 
-from datetime import datetime as dte
+from datetime import datetime as dte, timedelta
 from models import (db, RedeemActivity, Redeem, VoiceActivity, VoiceWord, Order,
-                    Device, DeviceCategory, Road, User)
+                    Device, DeviceCategory, Road, User, Item, HourOrderStat)
 from selector import UserSelectorProxy
 from const import (OrderStatus, PayStatus, DELIVER_EXPIRE_SECONDS,
-                   WAITING_PAY_EXPIRE_SECONDS, PayType)
+                   WAITING_PAY_EXPIRE_SECONDS, PayType, RECENT_BUY_DAYS)
 from pay.manager import PayManager
 from const import PayTypeMsg, RedeemStatus
+from util import trace
 # from sms.helper import SMSHelper
 
 
@@ -32,7 +33,10 @@ class OrderBiz(object):
             self.order = order
         if order_no:
             self.order = Order.get(Order.no == order_no)
+            # 按订单号找到的订单来自外部请求(支付回调、出货结果等)，接上订单的关联id
+            trace.bind_order(order_no)
 
+    @trace.traced("order.refresh_pay_status")
     def refresh_pay_status(self):
         order = self.order
         res = PayManager.query_trade(order.pay_type, order.no)
@@ -50,6 +54,7 @@ class OrderBiz(object):
         elif new_pay_status == PayStatus.REFUND:
             self.refund_success(res["refund_money"])
 
+    @trace.traced("order.create")
     def create(self, road, amount, pay_type):
         """
         创建订单
@@ -72,9 +77,12 @@ class OrderBiz(object):
             pay_status=PayStatus.UNPAY,
         )
         order.save()
+        trace.bind_order(order_no)
         logger.info("[order](%s) 创建成功", order_no)
         self.order = order
+        self.update_item_counters(pv_count=1)
 
+    @trace.traced("order.pay_success")
     def pay_success(self, money, pay_type,
                     redeem=None, voice_word=None, buyer=""):
         """
@@ -102,6 +110,7 @@ class OrderBiz(object):
         except Exception, e:
             logger.error(e)
 
+    @trace.traced("order.pay_fail")
     def pay_fail(self):
         """
         支付失败
@@ -149,6 +158,7 @@ class OrderBiz(object):
         order = self.order
         logger.info("[order](%s) 支付初始化成功", order.no)
 
+    @trace.traced("order.deliver_success")
     def deliver_success(self):
         """
         出货成功
@@ -160,12 +170,19 @@ class OrderBiz(object):
         order.reload()
         logger.info("[order](%s) 出货成功", order.no)
 
+        self.update_hour_stat(orders_pay=1,
+                              sales_volume=order.pay_money,
+                              sales_quantity=order.item_amount)
+        self.update_user_counters(buy_count=1, recent_buy_count=1)
+        self.update_item_counters(sales_count=1)
+
         try:
             device_biz = DeviceBiz(device=order.device)
             device_biz.decr_road_stock(order.road)
         except Exception:
             logger.exception("decrease stock error")
 
+    @trace.traced("order.deliver_fail")
     def deliver_fail(self):
         """
         出货失败
@@ -196,6 +213,7 @@ class OrderBiz(object):
                         order.no, int(paid_time))
             self.refund()
 
+    @trace.traced("order.refund")
     def refund(self):
         """
         发起退款
@@ -228,9 +246,11 @@ class OrderBiz(object):
             qs.execute()
             order.reload()
             logger.info("[order](%s) 发起退款成功", order.no)
+            self.update_hour_stat(orders_refund=1, refund_money=order.refund_money)
         else:
             logger.info("[order](%s) 发起退款失败", order.no)
 
+    @trace.traced("order.refund_success")
     def refund_success(self, money):
         """
         退款成功
@@ -239,6 +259,7 @@ class OrderBiz(object):
         logger.info("[order](%s) 退款成功", order.no)
         if order.status == OrderStatus.REFUNDED:
             return
+        old_status = order.status
         qs = Order.update(status=OrderStatus.REFUNDED,
                           pay_status=PayStatus.REFUND,
                           refund_money=money) \
@@ -246,6 +267,49 @@ class OrderBiz(object):
         qs.execute()
         order.reload()
 
+        deltas = {"orders_refund": 1, "refund_money": order.refund_money}
+        if old_status == OrderStatus.DONE:
+            # 已计入成交的订单退款，要扣回
+            deltas.update(orders_pay=-1,
+                          sales_volume=-order.pay_money,
+                          sales_quantity=-order.item_amount)
+            user_deltas = {"buy_count": -1}
+            if order.created_at >= dte.now() - timedelta(days=RECENT_BUY_DAYS):
+                user_deltas["recent_buy_count"] = -1
+            self.update_user_counters(**user_deltas)
+            self.update_item_counters(sales_count=-1)
+        self.update_hour_stat(**deltas)
+
+    def update_hour_stat(self, **deltas):
+        """
+        更新订单所在小时的统计数
+        """
+        order = self.order
+        try:
+            HourOrderStat.incr(order, **deltas)
+        except Exception:
+            logger.exception("[order](%s) 更新小时统计失败", order.no)
+
+    def update_user_counters(self, **deltas):
+        """
+        更新购买用户的购买次数
+        """
+        order = self.order
+        try:
+            User.incr_counters(order.user_id, **deltas)
+        except Exception:
+            logger.exception("[order](%s) 更新用户购买次数失败", order.no)
+
+    def update_item_counters(self, **deltas):
+        """
+        更新商品的销量、访问量
+        """
+        order = self.order
+        try:
+            Item.incr_counters(order.item_id, **deltas)
+        except Exception:
+            logger.exception("[order](%s) 更新商品销量失败", order.no)
+
 
 class DeviceBiz(object):
 
@@ -428,6 +492,7 @@ class MarktingBiz(object):
                           device=None,
                           use_at=None).where(Redeem.id == redeem.id)
         q.execute()
+        User.incr_counters(redeem.user_id, redeem_used=-1)
         logger.info("[markting] 归还兑换码成功 <Redeem:%s>", redeem.code)
         return True
 
@@ -441,6 +506,7 @@ class MarktingBiz(object):
                           device=device,
                           use_at=dte.now()).where(Redeem.id == redeem.id)
         q.execute()
+        User.incr_counters(redeem.user_id, redeem_used=1)
         logger.info("[markting] 扣除兑换码成功 <Redeem:%s>", redeem.code)
         return True
 
@@ -515,6 +581,7 @@ class MarktingBiz(object):
                 user=u,
             )
             r.save()
+            User.incr_counters(u.id, redeem_total=1)
 
             helper = SMSHelper()
             helper.send_redeem_message(r)
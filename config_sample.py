@@ -20,14 +20,43 @@ class Config(object):
         "password": "mysql@yfh",
     }
 
+    # 连接池：最大连接数要大于max_workers加定时任务数；stale_timeout要小于MySQL的wait_timeout；
+    # timeout为连接池满时等待空闲连接的秒数
+    mysql_pool = {
+        "max_connections": 20,
+        "stale_timeout": 300,
+        "timeout": 10,
+    }
+
+    # 从库，只读RPC的查询走从库；database/user/password不填时与主库相同
+    mysql_replicas = [
+        # {"host": "172.18.224.102", "port": 3307},
+    ]
+    replica_max_lag = 5             # 从库允许的最大复制延迟，秒，超过则退回主库
+    replica_check_interval = 10     # 从库延迟检查结果的缓存时间，秒
+
     redis = {
         "host": DB_HOST,
         "port": 6380,
         "db": 0,
+        "max_connections": 50,          # 连接池大小，满了最多等pool_timeout秒
+        "pool_timeout": 5,
+        "socket_timeout": 5,
+        "socket_connect_timeout": 2,
+        "health_check_interval": 30,    # 空闲超过多少秒的连接取出时先PING
     }
 
     log_level = "INFO"
     log_path = "/src/logs"
+    log_format = "text"             # 文件日志格式，text或json(每行一个JSON对象)
+
+    executor_workers = 4            # 后台任务线程数
+    executor_queue_size = 1000      # 后台任务队列上限，满了提交方最多等1秒
+
+    metrics_log_interval = 60       # 每隔多少秒输出一次RPC指标日志
+
+    slow_query_threshold = 0.2      # 慢查询阈值，秒
+    slow_query_explain_rate = 0.05  # 慢查询再次抓EXPLAIN的抽样比例
 
     def to_dict(self):
         data = {}
@@ -41,6 +41,10 @@ OrderStatusMsg = {
 }
 
 
+# 用户近期购买次数的统计天数
+RECENT_BUY_DAYS = 28
+
+
 # 支付状态
 PayStatus = Enum()
 PayStatus.UNPAY = 1             # 未支付
@@ -99,9 +103,17 @@ SupplyStatusMsg = {
 
 # 短信发送状态
 SMSStatus = Enum()
-SMSStatus.READY = 0
+SMSStatus.READY = 0         # 待发送
 SMSStatus.FAIL = 1
 SMSStatus.OK = 2
+SMSStatus.SENDING = 3       # 发送中，已被发件箱取出
+
+# 短信回执状态，与阿里云QuerySendDetails的SendStatus一致
+SMSReceipt = Enum()
+SMSReceipt.UNKNOWN = 0      # 还没查到回执
+SMSReceipt.WAITING = 1      # 等待回执
+SMSReceipt.FAIL = 2         # 接收失败
+SMSReceipt.DELIVERED = 3    # 接收成功
 
 # 短信渠道
 SMSChannel = Enum()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+看板数据聚合
+
+dashboard_*接口共用的聚合引擎：今日/本周/本年三个时间窗口用条件聚合
+在同一次扫描里算出，排行榜直接在SQL里LIMIT，结果缓存CACHE_SECONDS秒，
+所有看板接口共享同一份缓存。
+
+销售额、销量及商品/设备排行来自小时聚合表HourOrderStat，不再扫描订单表；
+只有涉及去重用户的指标才需要扫订单表。
+"""
+import time
+import logging
+
+from datetime import datetime as dte, timedelta
+from peewee import fn, JOIN
+from playhouse.shortcuts import case
+from models import Order, DayDeviceStat, Device, Item, User, HourOrderStat
+from const import OrderStatus, PayStatus, PayType
+
+logger = logging.getLogger(__name__)
+
+CACHE_SECONDS = 30      # 看板数据缓存时间
+RANK_SIZE = 5           # 排行榜条数
+
+_cache = {}
+
+
+def get_windows(now):
+    """
+    时间窗口的起始时间：今日、本周、本年
+    """
+    from_day = dte(now.year, now.month, now.day)
+    return {
+        "today": from_day,
+        "week": from_day - timedelta(days=now.weekday()),
+        "year": dte(now.year, 1, 1),
+    }
+
+
+def cached(func):
+    """
+    按函数名缓存聚合结果，过期后重新计算
+    """
+    key = func.__name__
+
+    def wrap(self):
+        hit = _cache.get(key)
+        if hit and hit[0] > time.time():
+            return hit[1]
+        res = func(self)
+        _cache[key] = (time.time() + CACHE_SECONDS, res)
+        return res
+    return wrap
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def _in_window(field, start, *conds):
+    cond = field >= start
+    for c in conds:
+        cond = cond & c
+    return cond
+
+
+class DashboardAggregator(object):
+    """
+    看板聚合引擎
+
+    每个source表一次扫描（以最早的窗口为下界），按窗口用CASE WHEN分别累加。
+    """
+
+    def __init__(self, now=None):
+        self.now = now or dte.now()
+        self.windows = get_windows(self.now)
+        self.earliest = min(self.windows.values())
+
+    def _sum_if(self, cond, value=1):
+        return fn.SUM(case(None, [(cond, value)], 0))
+
+    def _count_distinct_if(self, cond, value):
+        return fn.COUNT(fn.DISTINCT(case(None, [(cond, value)], None)))
+
+    @cached
+    def sales_totals(self):
+        """
+        销售汇总：销售额、销售个数、动销设备数
+        """
+        paid = HourOrderStat.orders_pay > 0
+
+        columns = []
+        for zoom, start in self.windows.items():
+            columns.extend([
+                self._sum_if(HourOrderStat.hour >= start, HourOrderStat.sales_volume) \
+                    .alias("%s_sales_amount" % zoom),
+                self._sum_if(HourOrderStat.hour >= start, HourOrderStat.sales_quantity) \
+                    .alias("%s_item_amount" % zoom),
+                self._count_distinct_if(_in_window(HourOrderStat.hour, start, paid),
+                                        HourOrderStat.device).alias("%s_active_devices" % zoom),
+            ])
+
+        row = HourOrderStat.select(*columns) \
+                           .where(HourOrderStat.hour >= self.earliest,
+                                  HourOrderStat.hour <= self.now) \
+                           .dicts() \
+                           .first()
+        return self._split_windows(row, ["sales_amount", "item_amount", "active_devices"])
+
+    @cached
+    def order_totals(self):
+        """
+        订单汇总：支付用户数、成交笔数、粉丝成交笔数
+
+        需要按用户去重或关联用户，只能扫订单表
+        """
+        paid = Order.pay_status.not_in([PayStatus.UNPAY, PayStatus.CLOSED])
+        done = Order.status == OrderStatus.DONE
+        fans = User.mobile != ""
+
+        columns = []
+        for zoom, start in self.windows.items():
+            columns.extend([
+                self._count_distinct_if(_in_window(Order.created_at, start, paid),
+                                        Order.user).alias("%s_users_pay" % zoom),
+                self._sum_if(_in_window(Order.created_at, start, done)) \
+                    .alias("%s_total_buys" % zoom),
+                self._sum_if(_in_window(Order.created_at, start, done, fans)) \
+                    .alias("%s_fans_buys" % zoom),
+            ])
+
+        row = Order.select(*columns) \
+                   .join(User, JOIN.LEFT_OUTER) \
+                   .where(Order.created_at >= self.earliest,
+                          Order.created_at <= self.now) \
+                   .dicts() \
+                   .first()
+        return self._split_windows(row, ["users_pay", "total_buys", "fans_buys"])
+
+    @cached
+    def order_ranks(self):
+        """
+        排行榜：商品销售额/销量、单机销售额/销量、用户购买次数
+
+        兑换码订单不计入排行
+        """
+        ranks = {}
+        for zoom, start in self.windows.items():
+            where = [HourOrderStat.hour >= start,
+                     HourOrderStat.hour <= self.now,
+                     HourOrderStat.pay_type != PayType.REDEEM]
+            ranks[zoom] = {
+                "item_sales": self._rank(Item.name, HourOrderStat.item,
+                                         fn.SUM(HourOrderStat.sales_volume), where),
+                "item_amount": self._rank(Item.name, HourOrderStat.item,
+                                          fn.SUM(HourOrderStat.sales_quantity), where),
+                "device_sales": self._rank(Device.address, HourOrderStat.device,
+                                           fn.SUM(HourOrderStat.sales_volume), where),
+                "device_amount": self._rank(Device.address, HourOrderStat.device,
+                                            fn.SUM(HourOrderStat.sales_quantity), where),
+                "user_buys": self._rank(User.id, Order.user, fn.COUNT(Order.id), [
+                    Order.created_at >= start,
+                    Order.created_at <= self.now,
+                    Order.redeem.is_null(True),
+                    Order.status == OrderStatus.DONE]),
+            }
+        return ranks
+
+    def _rank(self, label, group, aggregate, where):
+        source = group.model_class
+        qs = source.select(label.alias("label"), aggregate.alias("value")) \
+                   .join(label.model_class, on=(group == label.model_class.id)) \
+                   .where(*where) \
+                   .group_by(group)
+        if source is HourOrderStat:
+            # 全部退款的小时记录不算成交
+            qs = qs.having(fn.SUM(HourOrderStat.orders_pay) > 0)
+        qs = qs.order_by(aggregate.desc()) \
+               .limit(RANK_SIZE) \
+               .tuples()
+        return [(lb, float(val or 0)) for lb, val in qs]
+
+    @cached
+    def device_stat_totals(self):
+        """
+        设备日统计汇总：人流量、停留人数、点击数
+        """
+        columns = []
+        for zoom, start in self.windows.items():
+            day = start.strftime("%Y-%m-%d")
+            for field in (DayDeviceStat.flows, DayDeviceStat.stays, DayDeviceStat.clicks):
+                columns.append(self._sum_if(DayDeviceStat.day >= day, field)
+                               .alias("%s_%s" % (zoom, field.name)))
+
+        row = DayDeviceStat.select(*columns) \
+                           .where(DayDeviceStat.day >= self.earliest.strftime("%Y-%m-%d"),
+                                  DayDeviceStat.day <= self.now.strftime("%Y-%m-%d")) \
+                           .dicts() \
+                           .first()
+        return self._split_windows(row, ["flows", "stays", "clicks"])
+
+    @cached
+    def device_stat_ranks(self):
+        """
+        设备人流量、停留人数、点击数排行
+        """
+        ranks = {}
+        for zoom, start in self.windows.items():
+            ranks[zoom] = {}
+            for field in (DayDeviceStat.flows, DayDeviceStat.stays, DayDeviceStat.clicks):
+                qs = DayDeviceStat.select(Device.address, fn.SUM(field)) \
+                                  .join(Device) \
+                                  .where(DayDeviceStat.day >= start.strftime("%Y-%m-%d"),
+                                         DayDeviceStat.day <= self.now.strftime("%Y-%m-%d")) \
+                                  .group_by(DayDeviceStat.device) \
+                                  .order_by(fn.SUM(field).desc()) \
+                                  .limit(RANK_SIZE) \
+                                  .tuples()
+                ranks[zoom][field.name] = [(address, int(val or 0)) for address, val in qs]
+        return ranks
+
+    @cached
+    def user_totals(self):
+        """
+        新增用户数（无手机号且已购买）、新增粉丝数（有手机号）
+        """
+        columns = []
+        for zoom, start in self.windows.items():
+            columns.extend([
+                self._sum_if(_in_window(User.created_at, start,
+                                        User.mobile == "",
+                                        User.first_buy_at.is_null(False))) \
+                    .alias("%s_new_users" % zoom),
+                self._sum_if(_in_window(User.created_at, start, User.mobile != "")) \
+                    .alias("%s_new_fans" % zoom),
+            ])
+
+        row = User.select(*columns) \
+                  .where(User.created_at >= self.earliest,
+                         User.created_at <= self.now) \
+                  .dicts() \
+                  .first()
+        return self._split_windows(row, ["new_users", "new_fans"])
+
+    @cached
+    def device_totals(self):
+        """
+        设备数：已接入数、各窗口内有心跳的设备数（全部/已接入）
+        """
+        involved = Device.involved == True  # noqa
+        columns = [self._sum_if(involved).alias("involved_count")]
+        for zoom, start in self.windows.items():
+            columns.extend([
+                self._sum_if(Device.heartbeat_at >= start).alias("%s_online" % zoom),
+                self._sum_if(_in_window(Device.heartbeat_at, start, involved)) \
+                    .alias("%s_online_involved" % zoom),
+            ])
+
+        row = Device.select(*columns).dicts().first()
+        res = self._split_windows(row, ["online", "online_involved"])
+        res["involved"] = int(row["involved_count"] or 0) if row else 0
+        return res
+
+    def _split_windows(self, row, names):
+        row = row or {}
+        return {
+            zoom: {n: int(row.get("%s_%s" % (zoom, n)) or 0) for n in names}
+            for zoom in self.windows
+        }
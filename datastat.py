@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+"""
+每日统计
+
+把前一天的订单、用户数据汇总进DayDeviceStat/DayItemStat/DayUserGroupStat/DayStat。
+
+每张表按天用一条GROUP BY算出全部分组，再整体写回：先把当天的订单类指标清零，
+再按(day, 分组)唯一键批量upsert，所以同一天重复执行结果一致，可以放心重跑和回填。
+DayDeviceStat的人流量、停留人数、点击数由add_client_log实时累加，这里不会改动。
+
+用户的购买次数、兑换码数，商品的销量、访问量在业务里实时累加，
+这里负责每天滚动近期购买次数和全量对账。
+"""
+import time
+import logging
+import ujson as json
+
+from datetime import datetime as dte, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from peewee import fn
+from playhouse.shortcuts import case
+from models import (db, Order, User, UserGroup, Redeem, Item, ItemBrand, ItemCategory,
+                    DayDeviceStat, DayItemStat, DayUserGroupStat, DayStat)
+from selector import UserSelectorProxy
+from const import OrderStatus, PayStatus, RedeemStatus, RECENT_BUY_DAYS
+
+logger = logging.getLogger(__name__)
+
+# 由订单汇总出的指标
+ORDER_FIELDS = ["sales_volume", "sales_quantity", "orders_pay", "users_pay"]
+
+# 由用户汇总出的指标
+USER_FIELDS = ["users", "registers", "actives"]
+
+# 批量更新计数时每条UPDATE的记录数
+BATCH_SIZE = 1000
+
+
+def get_day_range(day):
+    """
+    day可以是datetime或"2018-06-01"，返回(day字符串, 起始时间, 截止时间)
+    """
+    if not isinstance(day, dte):
+        day = dte.strptime(str(day), "%Y-%m-%d")
+    start_at = dte(day.year, day.month, day.day)
+    return start_at.strftime("%Y-%m-%d"), start_at, start_at + timedelta(days=1)
+
+
+def _order_columns():
+    paid = Order.pay_status.not_in([PayStatus.UNPAY, PayStatus.CLOSED])
+    done = Order.status == OrderStatus.DONE
+    return [
+        fn.SUM(case(None, [(done, Order.pay_money)], 0)).alias("sales_volume"),
+        fn.SUM(case(None, [(done, Order.item_amount)], 0)).alias("sales_quantity"),
+        fn.SUM(case(None, [(paid, 1)], 0)).alias("orders_pay"),
+        fn.COUNT(fn.DISTINCT(case(None, [(paid, Order.user)], None))).alias("users_pay"),
+    ]
+
+
+def _day_orders(start_at, end_at, *columns):
+    return Order.select(*(list(columns) + _order_columns())) \
+                .where(Order.created_at >= start_at,
+                       Order.created_at < end_at)
+
+
+def save_day_rows(model, day, key, rows, fields):
+    """
+    覆盖写入某一天的统计数据
+
+    先把当天所有记录的fields清零（当天没有数据的分组也要归零），
+    再按唯一键(day, key)批量upsert。
+    """
+    values = []
+    for row in rows:
+        value = {f: int(row[f] or 0) for f in fields}
+        value["day"] = day
+        if key:
+            value[key] = row[key]
+        values.append(value)
+
+    with db.atomic():
+        model.update(**{f: 0 for f in fields}).where(model.day == day).execute()
+        model.insert_or_update(values,
+                               conflict=["day", key] if key else ["day"],
+                               replace=fields)
+    return len(rows)
+
+
+def stat_device_by_day(day):
+    """
+    设备日统计：销售额、销量、支付笔数、支付用户数、商品访问量（下单数）
+    """
+    day, start_at, end_at = get_day_range(day)
+    qs = _day_orders(start_at, end_at,
+                     Order.device,
+                     fn.COUNT(Order.id).alias("item_clicks")) \
+        .group_by(Order.device) \
+        .dicts()
+    return save_day_rows(DayDeviceStat, day, "device", list(qs),
+                         ORDER_FIELDS + ["item_clicks"])
+
+
+def stat_item_by_day(day):
+    """
+    商品日统计：销售额、销量、支付笔数、支付用户数、商品访问量（下单数）
+    """
+    day, start_at, end_at = get_day_range(day)
+    qs = _day_orders(start_at, end_at,
+                     Order.item,
+                     fn.COUNT(Order.id).alias("clicks")) \
+        .group_by(Order.item) \
+        .dicts()
+    return save_day_rows(DayItemStat, day, "item", list(qs),
+                         ORDER_FIELDS + ["clicks"])
+
+
+def _user_stat(start_at, end_at, user_query=None):
+    """
+    用户数、新增用户、活跃用户（当天有成交）及订单指标
+
+    user_query为None时统计全部用户，否则只统计该查询圈定的用户
+    """
+    done = Order.status == OrderStatus.DONE
+    users = User.select(fn.COUNT(User.id).alias("users"),
+                        fn.SUM(case(None, [(User.created_at >= start_at, 1)], 0))
+                        .alias("registers")) \
+                .where(User.created_at < end_at)
+    orders = _day_orders(start_at, end_at,
+                         fn.COUNT(fn.DISTINCT(case(None, [(done, Order.user)], None)))
+                         .alias("actives"))
+    if user_query is not None:
+        users = users.where(User.id.in_(user_query))
+        orders = orders.where(Order.user.in_(user_query))
+
+    row = users.dicts().first()
+    row.update(orders.dicts().first())
+    return row
+
+
+def stat_user_group_by_day(day):
+    """
+    用户群日统计，每个用户群按自身条件圈定用户
+    """
+    day, start_at, end_at = get_day_range(day)
+    rows = []
+    for ug in UserGroup.select():
+        user_query = UserSelectorProxy(json.loads(ug.condition)).select() \
+                                                                .select(User.id) \
+                                                                .order_by()
+        row = _user_stat(start_at, end_at, user_query)
+        row["user_group"] = ug.id
+        rows.append(row)
+    return save_day_rows(DayUserGroupStat, day, "user_group", rows,
+                         USER_FIELDS + ORDER_FIELDS)
+
+
+def stat_all_by_day(day):
+    """
+    全站日统计
+    """
+    day, start_at, end_at = get_day_range(day)
+    row = _user_stat(start_at, end_at)
+    return save_day_rows(DayStat, day, None, [row], USER_FIELDS + ORDER_FIELDS)
+
+
+STAT_FUNCS = [
+    ("device", stat_device_by_day),
+    ("item", stat_item_by_day),
+    ("user_group", stat_user_group_by_day),
+    ("day", stat_all_by_day),
+]
+
+
+def stat_day(day):
+    """
+    统计某一天的全部聚合表，返回每张表写入的行数和耗时
+
+    单张表失败不影响其他表，错误记在errors里
+    """
+    day = get_day_range(day)[0]
+    report = {"day": day, "rows": {}, "errors": {}}
+    begin = time.time()
+    for name, func in STAT_FUNCS:
+        try:
+            report["rows"][name] = func(day)
+        except Exception as e:
+            logger.exception("[datastat] stat %s of %s failed", name, day)
+            report["errors"][name] = str(e)
+    report["seconds"] = round(time.time() - begin, 3)
+    logger.info("[datastat] %s rows:%s errors:%s cost:%.3fs",
+                day, report["rows"], report["errors"].keys(), report["seconds"])
+    return report
+
+
+def _stat_chunk(days):
+    try:
+        return [stat_day(day) for day in days]
+    finally:
+        if not db.is_closed():
+            db.close()
+
+
+def stat_days(start_date, end_date, workers=4):
+    """
+    回填[start_date, end_date]的统计数据
+
+    日期按workers切成连续的几段并行执行，每段内按天顺序统计
+    """
+    _, start_at, _ = get_day_range(start_date)
+    _, _, end_at = get_day_range(end_date)
+    days = []
+    while start_at < end_at:
+        days.append(start_at.strftime("%Y-%m-%d"))
+        start_at += timedelta(days=1)
+
+    if workers <= 1 or len(days) <= 1:
+        return [stat_day(day) for day in days]
+
+    size = (len(days) + workers - 1) // workers
+    chunks = [days[i: i + size] for i in range(0, len(days), size)]
+    executor = ThreadPoolExecutor(len(chunks))
+    try:
+        reports = []
+        for res in executor.map(_stat_chunk, chunks):
+            reports.extend(res)
+    finally:
+        executor.shutdown()
+    return reports
+
+
+def _set_counter(model, field, counts):
+    """
+    把counts({id: 值})批量写进model.field，不在counts里的记录清零
+
+    值相同的记录合并成一条UPDATE，只更新值有变化的记录
+    """
+    column = getattr(model, field)
+    current = dict(model.select(model.id, column).where(column != 0).tuples())
+
+    by_value = {}
+    for uid in set(current) | set(counts):
+        value = counts.get(uid, 0)
+        if current.get(uid, 0) != value:
+            by_value.setdefault(value, []).append(uid)
+
+    changed = 0
+    for value, ids in by_value.items():
+        for i in range(0, len(ids), BATCH_SIZE):
+            changed += model.update(**{field: value}) \
+                            .where(model.id.in_(ids[i: i + BATCH_SIZE])) \
+                            .execute()
+    return changed
+
+
+def _count_by(field, *where):
+    model = field.model_class
+    return dict(model.select(field, fn.COUNT(model.id))
+                     .where(field.is_null(False), *where)
+                     .group_by(field)
+                     .tuples())
+
+
+def refresh_recent_buy_counts(now=None):
+    """
+    重算用户近RECENT_BUY_DAYS天的购买次数，返回更新的用户数
+
+    成交时已经实时+1，这里每天把滑出窗口的订单扣掉
+    """
+    since = (now or dte.now()) - timedelta(days=RECENT_BUY_DAYS)
+    counts = _count_by(Order.user,
+                       Order.status == OrderStatus.DONE,
+                       Order.created_at >= since)
+    return _set_counter(User, "recent_buy_count", counts)
+
+
+def rebuild_user_counters():
+    """
+    根据订单和兑换码全量重算用户的计数字段，用于初始化和对账
+    """
+    done = Order.status == OrderStatus.DONE
+    used = Redeem.status == RedeemStatus.USED
+    return {
+        "buy_count": _set_counter(User, "buy_count", _count_by(Order.user, done)),
+        "recent_buy_count": refresh_recent_buy_counts(),
+        "redeem_total": _set_counter(User, "redeem_total", _count_by(Redeem.user)),
+        "redeem_used": _set_counter(User, "redeem_used", _count_by(Redeem.user, used)),
+    }
+
+
+def rebuild_item_counters():
+    """
+    全量重算商品销量、访问量和商品类型、品牌的商品数，用于初始化和对账
+    """
+    done = Order.status == OrderStatus.DONE
+    return {
+        "sales_count": _set_counter(Item, "sales_count", _count_by(Order.item, done)),
+        "pv_count": _set_counter(Item, "pv_count", _count_by(Order.item)),
+        "category_item_count": _set_counter(ItemCategory, "item_count",
+                                            _count_by(Item.category)),
+        "brand_item_count": _set_counter(ItemBrand, "item_count", _count_by(Item.brand)),
+    }
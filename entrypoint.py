@@ -1,27 +1,91 @@
 # -*- coding: utf-8 -*-
 
+import re
 import time
+import uuid
+import calendar
 import eventlet
-import random
-import re
 
 from datetime import datetime as dte
 from logging import getLogger
 from nameko.extensions import Entrypoint
-from util.rds import get_redis, RedisKeys
+from util.rds import get_redis, pipeline, batch, RedisKeys
 
 
 logger = getLogger(__name__)
 
+FIRE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# 触发时间幂等key的过期时间，秒
+CRON_FIRED_EXPIRE = 7 * 24 * 3600
+
+# 领导者租约：续约或抢占租约，同时标记本次触发的时间点；触发时间点不过期，
+# 换了领导者、节点间时钟有偏差也不会重复执行
+# KEYS: 租约key, 任期计数key, 上次触发时间点key
+# ARGV: 节点id, 租约毫秒数, 本次触发时间点
+# 返回{任期, 0}表示本节点是领导者且应执行，{任期, 1}表示该时间点已执行过，
+# {0, 租约剩余毫秒数}表示其他节点是领导者
+TIMER_LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+local term
+if not owner then
+    term = redis.call('INCR', KEYS[2])
+    redis.call('SET', KEYS[1], ARGV[1] .. ':' .. term, 'PX', ARGV[2])
+elseif string.sub(owner, 1, string.len(ARGV[1]) + 1) == ARGV[1] .. ':' then
+    term = tonumber(string.sub(owner, string.len(ARGV[1]) + 2))
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+else
+    return {0, redis.call('PTTL', KEYS[1])}
+end
+local last = tonumber(redis.call('GET', KEYS[3]) or '0')
+if tonumber(ARGV[3]) <= last then
+    return {term, 1}
+end
+redis.call('SET', KEYS[3], ARGV[3])
+return {term, 0}
+"""
+
+
+def next_boundary(now, interval):
+    """
+    now之后的下一个整interval时间点（时间戳）
+    """
+    return (int(now) // interval + 1) * interval
+
+
+def sleep_until(ts, should_stop):
+    """
+    睡到ts，每秒检查一次是否需要停止；返回False表示被停止
+    """
+    while True:
+        if should_stop():
+            return False
+        left = ts - time.time()
+        if left <= 0:
+            return True
+        eventlet.sleep(min(left, 1))
+
 
 class DistributedTimer(Entrypoint):
     """
     跟官方timer不同的是，DistributedTimer每次interval只有集群中的一个节点会运行。
+
+    节点之间用Redis租约选出领导者：各节点睡到整interval时间点，领导者续约并执行，
+    其他节点在租约快到期时才去抢占，所以Redis访问次数与节点数基本无关。
+    领导者挂掉后租约过期，其他节点抢到租约，任期加一（只用于日志里区分换了领导者）。
+    每个时间点是否执行过记在Redis里，和续约在同一个脚本里判断，
+    旧领导者恢复后拿不到租约，也不会重复执行同一个时间点。
+
+    租约只保证每个时间点只触发一次，不能阻止卡住的旧领导者和新领导者同时在跑
+    前后两个时间点的任务，定时任务本身要能重复执行。
     """
 
     def __init__(self, interval):
 
         self.interval = interval
+        self.lease = max(interval * 3, 10)
+        self.node_id = uuid.uuid4().hex
+        self.term = None
         self.should_stop = False
         self.gt = None
 
@@ -39,18 +103,38 @@ class DistributedTimer(Entrypoint):
         self.gt.kill()
 
     def _run(self):
-        while True:
-            rds = get_redis()
-            t = time.time()
-            key = RedisKeys.TIMER_LOCK % self.method_name
-            ok = rds.set(key, t, nx=True, ex=self.interval)
-            if ok:
-                self.handle_timer_tick()
-
-            if self.should_stop:
-                break
+        script = get_redis().register_script(TIMER_LEASE_SCRIPT)
+        wake_at = next_boundary(time.time(), self.interval)
+        while sleep_until(wake_at, lambda: self.should_stop):
+            wake_at = self._tick(script, time.time())
 
-            eventlet.sleep(random.randint(1, 5) * 0.1)
+    def _tick(self, script, now):
+        """
+        在now所在的时间点续约/抢占租约，是领导者且该时间点没执行过就触发；
+        返回下次醒来的时间
+        """
+        keys = [RedisKeys.TIMER_LEADER % self.method_name,
+                RedisKeys.TIMER_TERM % self.method_name,
+                RedisKeys.TIMER_FIRED % self.method_name]
+        boundary = int(now) // self.interval * self.interval
+        try:
+            term, flag = script(keys=keys,
+                                args=[self.node_id, int(self.lease * 1000), boundary])
+        except Exception:
+            logger.exception("[timer] %s lease error", self.method_name)
+            return next_boundary(now, self.interval)
+
+        if not term:
+            # 其他节点是领导者，租约到期后再抢
+            self.term = None
+            return next_boundary(now + flag / 1000.0, self.interval)
+
+        if term != self.term:
+            logger.info("[timer] %s leader: %s term: %s", self.method_name, self.node_id, term)
+            self.term = term
+        if not flag:
+            self.handle_timer_tick()
+        return next_boundary(now, self.interval)
 
     def handle_timer_tick(self):
         args = ()
@@ -59,14 +143,96 @@ class DistributedTimer(Entrypoint):
         self.container.spawn_worker(self, args, kwargs)
 
 
+class CronTrigger(object):
+    """
+    解析"xxxx-yy-zz aa:bb:cc"格式的触发时间，*可以代替任意一位数字
+
+    年以外的字段预先算出所有可取的值，next_fire按字段从大到小找下一个触发时间
+    """
+
+    PATTERN = re.compile(r"^([\d*]{4})-([\d*]{2})-([\d*]{2}) ([\d*]{2}):([\d*]{2}):([\d*]{2})$")
+
+    # 年份最多往后找多少年
+    MAX_YEARS = 400
+
+    def __init__(self, trigger_time):
+        match = self.PATTERN.match(trigger_time)
+        if not match:
+            raise Exception("trigger_time's format is illegal")
+
+        self.trigger_time = trigger_time
+        year, month, day, hour, minute, second = match.groups()
+        self.year = year
+        self.months = self._values(month, 1, 12)
+        self.days = self._values(day, 1, 31)
+        self.hours = self._values(hour, 0, 23)
+        self.minutes = self._values(minute, 0, 59)
+        self.seconds = self._values(second, 0, 59)
+
+    @staticmethod
+    def _match(pattern, value):
+        value = str(value).zfill(len(pattern))
+        return all(p == "*" or p == c for p, c in zip(pattern, value))
+
+    def _values(self, pattern, low, high):
+        return [v for v in range(low, high + 1) if self._match(pattern, v)]
+
+    def next_fire(self, after):
+        """
+        after之后（不含）的第一个触发时间，没有则返回None
+        """
+        after = after.replace(microsecond=0)
+        for year in range(after.year, after.year + self.MAX_YEARS):
+            if not self._match(self.year, year):
+                continue
+            for month in self.months:
+                if (year, month) < (after.year, after.month):
+                    continue
+                last_day = calendar.monthrange(year, month)[1]
+                for day in self.days:
+                    if day > last_day:
+                        break
+                    date = (year, month, day)
+                    if date < (after.year, after.month, after.day):
+                        continue
+                    for hour in self.hours:
+                        if date + (hour, ) < (after.year, after.month, after.day, after.hour):
+                            continue
+                        for minute in self.minutes:
+                            if date + (hour, minute) < (after.year, after.month, after.day,
+                                                        after.hour, after.minute):
+                                continue
+                            for second in self.seconds:
+                                fire_at = dte(year, month, day, hour, minute, second)
+                                if fire_at > after:
+                                    return fire_at
+        return None
+
+    def fires_between(self, start, end, limit=100):
+        """
+        (start, end]之间的触发时间，最多limit个
+        """
+        res = []
+        fire_at = self.next_fire(start)
+        while fire_at and fire_at <= end and len(res) < limit:
+            res.append(fire_at)
+            fire_at = self.next_fire(fire_at)
+        return res
+
+
 class DistributedCron(Entrypoint):
     """
     任务调度
+
+    触发时间只解析一次，每次算出下一个触发时间后睡到那一刻。每个触发时间在Redis里
+    有一个SET NX的幂等key，集群中只有一个节点会执行。
+    节点全部停机或者睡过头错过的触发时间记在Redis列表里，catch_up为True时补执行最近一次。
     """
 
-    def __init__(self, trigger_time):
+    def __init__(self, trigger_time, catch_up=False):
         """
         trigger_time: 触发时间，格式必须是 xxxx-yy-zz aa:bb:cc
+        catch_up: 错过触发时间后是否补执行（只补最近的一次）
 
         例子：
             @distributed_cron("****-**-** 00:01:00")
@@ -80,12 +246,10 @@ class DistributedCron(Entrypoint):
                 pass
         """
 
-        reg = "[\d|\*]{4}-[\d|\*]{2}-[\d|\*]{2} [\d|\*]{2}:[\d|\*]{2}:[\d|\*]{2}"
-        pattern = re.compile(reg)
-        if not pattern.match(trigger_time):
-            raise Exception("trigger_time's format is illegal")
-
+        self.trigger = CronTrigger(trigger_time)
         self.trigger_time = trigger_time
+        self.catch_up = catch_up
+        self.node_id = uuid.uuid4().hex
         self.should_stop = False
         self.gt = None
 
@@ -103,35 +267,54 @@ class DistributedCron(Entrypoint):
         self.gt.kill()
 
     def _run(self):
+        rds = get_redis()
+        last = rds.get(RedisKeys.CRON_LAST % self.method_name)
+        if last:
+            self._handle_missed(dte.strptime(last, FIRE_TIME_FORMAT), dte.now())
+
         while True:
-            if self.should_stop:
+            fire_at = self.trigger.next_fire(dte.now())
+            if fire_at is None:
+                logger.info("[cron] %s has no more fire time", self.method_name)
                 break
 
-            now = dte.now().strftime("%Y-%m-%d %H:%M:%S")
-            rds = get_redis()
-            t = time.time()
-            key = RedisKeys.CRON_LOCK % self.method_name
-
-            if not self._fuzzy_equal(now):
-                eventlet.sleep(0.2)
-                continue
-
-            ok = rds.set(key, t, nx=True, ex=1)
-            if ok:
-                self.handle_timer_tick()
-
-            eventlet.sleep(0.2)
+            if not sleep_until(time.mktime(fire_at.timetuple()), lambda: self.should_stop):
+                break
 
-    def _fuzzy_equal(self, time):
-        if len(time) != len(self.trigger_time):
-            return False
+            try:
+                if self._acquire(fire_at):
+                    self.handle_timer_tick()
+                self._handle_missed(fire_at, dte.now())
+            except Exception:
+                logger.exception("[cron] %s fire at %s error", self.method_name, fire_at)
 
-        for i in range(len(time)):
-            c1, c2 = time[i], self.trigger_time[i]
-            if c2 != "*" and c1 != c2:
-                return False
-        else:
-            return True
+    def _acquire(self, fire_at, missed=False):
+        """
+        抢某个触发时间的执行权，同时记录最近的触发时间
+        """
+        fire_time = fire_at.strftime(FIRE_TIME_FORMAT)
+        with pipeline() as pipe:
+            pipe.set(RedisKeys.CRON_FIRED % (self.method_name, fire_time),
+                     "%s:%s" % ("missed" if missed else "fired", self.node_id),
+                     nx=True, ex=CRON_FIRED_EXPIRE)
+            pipe.set(RedisKeys.CRON_LAST % self.method_name, fire_time)
+        return bool(pipe.results[0])
+
+    def _handle_missed(self, since, now):
+        """
+        记录(since, now]之间错过的触发时间，每个触发时间只由抢到的节点记录
+        """
+        missed = [fire_at for fire_at in self.trigger.fires_between(since, now)
+                  if self._acquire(fire_at, missed=True)]
+        if not missed:
+            return
+
+        key = RedisKeys.CRON_MISSED % self.method_name
+        batch([("rpush", key) + tuple(f.strftime(FIRE_TIME_FORMAT) for f in missed),
+               ("ltrim", key, -100, -1)])
+        logger.warning("[cron] %s missed: %s", self.method_name, missed)
+        if self.catch_up:
+            self.handle_timer_tick()
 
     def handle_timer_tick(self):
         args = ()
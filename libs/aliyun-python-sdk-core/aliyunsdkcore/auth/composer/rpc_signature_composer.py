@@ -75,12 +75,61 @@ def __get_signature(string_to_sign, secret, signer=mac1):
     return signer.get_sign_string(string_to_sign, secret + '&')
 
 
+# encoded static parameters, keyed by (access key, format, version, signer)
+_static_parameters = {}
+_STATIC_PARAMETERS_CACHE_SIZE = 64
+
+
+def __get_static_parameters(access_key_id, accept_format, version, signer):
+    cache_key = (access_key_id, accept_format, version, signer)
+    encoded = _static_parameters.get(cache_key)
+    if encoded is None:
+        parameters = {
+            "SignatureMethod": signer.get_signer_name(),
+            "SignatureType": signer.get_signer_type(),
+            "SignatureVersion": signer.get_singer_version(),
+            "AccessKeyId": access_key_id,
+        }
+        if accept_format is not None:
+            parameters["Format"] = accept_format
+        if version is not None:
+            parameters["Version"] = version
+        encoded = dict((key, __pop_standard_urlencode([(key, value)]))
+                       for key, value in parameters.items())
+        # session access keys rotate, keep the cache bounded
+        if len(_static_parameters) >= _STATIC_PARAMETERS_CACHE_SIZE:
+            _static_parameters.clear()
+        _static_parameters[cache_key] = encoded
+    return encoded
+
+
+def __encode_parameters(parameters):
+    # urlencode never leaves a raw '&' inside a key or value, so splitting
+    # the encoded list gives the 'key=value' part of each parameter
+    keys = list(parameters)
+    encoded = __pop_standard_urlencode([(key, parameters[key]) for key in keys])
+    return dict(zip(keys, encoded.split('&')))
+
+
 def get_signed_url(params, ak, secret, accept_format, method, body_params, signer=mac1):
     url_params = __refresh_sign_parameters(params, ak, accept_format, signer)
-    sign_params = dict(url_params)
+    # the access key, format, version and signature method parameters are
+    # the same for every request of a client, only encode the others
+    static = __get_static_parameters(ak, accept_format, url_params.get("Version"), signer)
+    sign_params = dict((key, value) for key, value in url_params.items() if key not in static)
     sign_params.update(body_params)
-    string_to_sign = __compose_string_to_sign(method, sign_params)
+    queries = dict(static)
+    queries.update(__encode_parameters(sign_params))
+
+    string_to_sign = method + "&%2F&" + \
+        urllib.pathname2url("&".join(queries[key] for key in sorted(queries)))
     signature = __get_signature(string_to_sign, secret, signer)
+
+    url_queries = [queries[key] for key in url_params if key not in body_params]
+    # a body parameter may shadow an url parameter of the same name
+    overridden = dict((key, value) for key, value in url_params.items() if key in body_params)
+    url_queries.extend(__encode_parameters(overridden).values())
+    url_queries.append(__pop_standard_urlencode([('Signature', signature)]))
     url_params['Signature'] = signature
-    url = '/?' + __pop_standard_urlencode(url_params)
+    url = '/?' + '&'.join(url_queries)
     return url
@@ -21,6 +21,9 @@
 import httplib
 import warnings
 import urllib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 warnings.filterwarnings("once", category=DeprecationWarning)
 
@@ -35,6 +38,7 @@ from .acs_exception.exceptions import ClientException
 from .acs_exception.exceptions import ServerException
 from .acs_exception import error_code, error_msg
 from .http.http_response import HttpResponse
+from .http.connection_pool import ConnectionPool
 from .request import AcsRequest
 from .http import format_type
 from .auth.Signer import Signer
@@ -48,6 +52,9 @@ Created on 6/15/2015
 """
 
 DEFAULT_SDK_CONNECTION_TIMEOUT_IN_SECONDS = 10
+DEFAULT_MAX_IDLE_CONNECTIONS_PER_HOST = 10
+DEFAULT_IDLE_CONNECTION_TIMEOUT_IN_SECONDS = 60
+DEFAULT_MAX_CONCURRENCY = 10
 
 
 class AcsClient:
@@ -65,7 +72,12 @@ class AcsClient:
             public_key_id=None,
             private_key=None,
             session_period=3600,
-            debug=False):
+            debug=False,
+            keep_alive=True,
+            max_idle_connections=DEFAULT_MAX_IDLE_CONNECTIONS_PER_HOST,
+            idle_timeout=DEFAULT_IDLE_CONNECTION_TIMEOUT_IN_SECONDS,
+            ssl_context=None,
+            max_concurrency=DEFAULT_MAX_CONCURRENCY):
         """
         constructor for AcsClient
         :param ak: String, access key id
@@ -73,6 +85,11 @@ class AcsClient:
         :param region_id: String, region id
         :param auto_retry: Boolean
         :param max_retry_time: Number
+        :param keep_alive: Boolean, reuse connections through a per-host pool
+        :param max_idle_connections: Number, idle connections kept per host
+        :param idle_timeout: Number, seconds before an idle connection is closed
+        :param ssl_context: ssl.SSLContext used for pooled HTTPS connections
+        :param max_concurrency: Number, requests in flight at once for submit_action()
         :return:
         """
 
@@ -96,6 +113,13 @@ class AcsClient:
             'region_id': region_id
         }
         self._signer = Signer.get_signer(credential, debug)
+        self._connection_pool = None
+        if keep_alive:
+            self._connection_pool = ConnectionPool(max_idle_connections, idle_timeout,
+                                                   ssl_context=ssl_context)
+        self._max_concurrency = max_concurrency
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
     def get_region_id(self):
         """
@@ -168,6 +192,19 @@ class AcsClient:
     def get_location_service(self):
         return self._location_service
 
+    def get_connection_pool(self):
+        return self._connection_pool
+
+    def close(self):
+        """
+        close all idle pooled connections and stop the dispatch workers
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._connection_pool is not None:
+            self._connection_pool.close()
+
     def _resolve_endpoint(self, request):
         endpoint = None
         if request.get_location_service_code() is not None:
@@ -213,7 +250,8 @@ class AcsClient:
             protocol,
             request.get_content(),
             self._port,
-            timeout=self._timeout)
+            timeout=self._timeout,
+            connection_pool=self._connection_pool)
         if body_params:
             body = urllib.urlencode(request.get_body_params())
             response.set_content(body, "utf-8", format_type.APPLICATION_FORM)
@@ -281,6 +319,32 @@ class AcsClient:
 
         return body
 
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_concurrency)
+            return self._executor
+
+    def submit_action(self, acs_request):
+        """
+        dispatch a request in the background, at most max_concurrency
+        requests of this client are in flight at the same time.
+        Under eventlet monkey patching the workers are green threads.
+        :param acs_request: AcsRequest
+        :return: concurrent.futures.Future, its result is the response body of
+                 do_action_with_exception(), or it holds the ClientException /
+                 ServerException raised for this request only
+        """
+        return self._get_executor().submit(self.do_action_with_exception, acs_request)
+
+    def submit_actions(self, acs_requests):
+        """
+        dispatch many requests, a failed request doesn't affect the others
+        :param acs_requests: iterable of AcsRequest
+        :return: list of Futures in the same order as acs_requests
+        """
+        return [self.submit_action(acs_request) for acs_request in acs_requests]
+
     def do_action(self, acs_request):
         warnings.warn(
             "do_action() method is deprecated, please use do_action_with_exception() instead.",
@@ -0,0 +1,158 @@
+# coding=utf-8
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Per-host pool of persistent HTTP/HTTPS connections.
+
+A connection is checked out by exactly one (green) thread at a time and is
+returned only after its response has been read completely, so it is safe to
+share one pool between eventlet green threads. Idle connections older than
+idle_timeout are closed instead of being reused.
+"""
+import time
+import socket
+import httplib
+import threading
+
+# errors raised while sending on a kept-alive connection that the server
+# has already closed; the request never reached the server
+STALE_SEND_ERRORS = (httplib.CannotSendRequest, socket.error)
+
+
+def _closed_before_response(e):
+    """
+    True if the server closed the connection without sending a status line,
+    which is how an idle keep-alive connection closed by the server shows up.
+    """
+    return isinstance(e, httplib.BadStatusLine) and \
+        (e.line == "''" or e.line.startswith("No status line received"))
+
+
+class ConnectionPool(object):
+
+    def __init__(self, max_idle_per_host=10, idle_timeout=60, ssl_context=None):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _new_connection(self, ssl, host, port, timeout, key_file=None, cert_file=None):
+        self.created += 1
+        if ssl:
+            kwargs = {}
+            if self.ssl_context is not None:
+                kwargs["context"] = self.ssl_context
+            return httplib.HTTPSConnection(host, port, key_file=key_file, cert_file=cert_file,
+                                           timeout=timeout, **kwargs)
+        return httplib.HTTPConnection(host, port, timeout=timeout)
+
+    def acquire(self, ssl, host, port, timeout, key_file=None, cert_file=None):
+        """
+        Return (connection, reused). The connection belongs to the caller
+        until it is passed to release() or discard().
+        """
+        key = (ssl, host, port)
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    self.reused += 1
+                    return conn, True
+                conn.close()
+        return self._new_connection(ssl, host, port, timeout, key_file, cert_file), False
+
+    def release(self, ssl, host, port, conn):
+        key = (ssl, host, port)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        conn.close()
+
+    def request(self, ssl, host, port, method, url, body, headers, timeout,
+                key_file=None, cert_file=None):
+        """
+        Send a request over a pooled connection and return
+        (status, headers, body).
+
+        A request on a reused connection is retried once on a fresh connection
+        only when it provably never reached the server: sending it failed, or
+        the server closed the connection without any status line. Timeouts and
+        other errors while waiting for the response are never retried, since
+        the server may already have processed the request.
+        """
+        conn, reused = self.acquire(ssl, host, port, timeout, key_file, cert_file)
+        try:
+            response = self._send(conn, method, url, body, headers)
+        except Exception as e:
+            self.discard(conn)
+            if not reused or not getattr(e, "stale_connection", False):
+                raise
+            conn = self._new_connection(ssl, host, port, timeout, key_file, cert_file)
+            try:
+                response = self._send(conn, method, url, body, headers)
+            except Exception:
+                self.discard(conn)
+                raise
+
+        try:
+            result = response.status, response.getheaders(), response.read()
+        except Exception:
+            self.discard(conn)
+            raise
+
+        if response.will_close:
+            self.discard(conn)
+        else:
+            self.release(ssl, host, port, conn)
+        return result
+
+    def _send(self, conn, method, url, body, headers):
+        """
+        Send the request and wait for the response headers. Errors proving
+        the request never reached the server are marked stale_connection.
+        """
+        try:
+            conn.request(method=method, url=url, body=body, headers=headers)
+        except socket.timeout:
+            raise
+        except STALE_SEND_ERRORS as e:
+            e.stale_connection = True
+            raise
+        try:
+            return conn.getresponse()
+        except httplib.BadStatusLine as e:
+            if _closed_before_response(e):
+                e.stale_connection = True
+            raise
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
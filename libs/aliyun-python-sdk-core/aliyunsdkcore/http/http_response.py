@@ -35,7 +35,8 @@ class HttpResponse(HttpRequest):
             port=None,
             key_file=None,
             cert_file=None,
-            timeout=None):
+            timeout=None,
+            connection_pool=None):
         HttpRequest.__init__(
             self,
             host=host,
@@ -50,6 +51,7 @@ class HttpResponse(HttpRequest):
         self.__port = port
         self.__connection = None
         self._timeout = timeout
+        self._connection_pool = connection_pool
         self.set_body(content)
 
     def set_ssl_enable(self, enable):
@@ -70,9 +72,26 @@ class HttpResponse(HttpRequest):
         else:
             return self.get_http_response_object()
 
+    def __pooled_response(self):
+        # keep-alive connections shared through the client's ConnectionPool
+        return self._connection_pool.request(
+            self.get_ssl_enabled(),
+            self.get_host(),
+            self.__port,
+            method=self.get_method(),
+            url=self.get_url(),
+            body=self.get_body(),
+            headers=self.get_headers(),
+            timeout=self._timeout,
+            key_file=self.__key_file,
+            cert_file=self.__cert_file)
+
     def get_http_response(self):
         if self.__port is None or self.__port == "":
             self.__port = 80
+        if self._connection_pool is not None:
+            status, headers, body = self.__pooled_response()
+            return headers, body
         try:
             self.__connection = httplib.HTTPConnection(
                 self.get_host(), self.__port, timeout=self._timeout)
@@ -90,6 +109,8 @@ class HttpResponse(HttpRequest):
     def get_http_response_object(self):
         if self.__port is None or self.__port == "":
             self.__port = 80
+        if self._connection_pool is not None:
+            return self.__pooled_response()
         try:
             self.__connection = httplib.HTTPConnection(
                 self.get_host(), self.__port, timeout=self._timeout)
@@ -105,10 +126,11 @@ class HttpResponse(HttpRequest):
             self.__close_connection()
 
     def get_https_response(self):
-        if self.__port is None or self.__port == "":
-            self.__port = 443
+        self.__port = 443
+        if self._connection_pool is not None:
+            status, headers, body = self.__pooled_response()
+            return headers, body
         try:
-            self.__port = 443
             self.__connection = httplib.HTTPSConnection(
                 self.get_host(),
                 self.__port,
@@ -127,10 +149,10 @@ class HttpResponse(HttpRequest):
             self.__close_connection()
 
     def get_https_response_object(self):
-        if self.__port is None or self.__port == "":
-            self.__port = 443
+        self.__port = 443
+        if self._connection_pool is not None:
+            return self.__pooled_response()
         try:
-            self.__port = 443
             self.__connection = httplib.HTTPSConnection(
                 self.get_host(),
                 self.__port,
@@ -59,7 +59,8 @@ setup(
     python_requires='<3',
     platforms='any',
     install_requires=[
-        'pycrypto>=2.6.1'
+        'pycrypto>=2.6.1',
+        'futures'
     ],
     classifiers=(
         'Development Status :: 5 - Production/Stable',
@@ -1,8 +1,32 @@
 # -*- coding: utf-8 -*-
 
-import logging
+"""
+日志
+
+文件日志走队列：QueueHandler只把记录放进有界队列，QueueListener在后台的
+系统线程里成批格式化、写入DaemonFileLogHandler，请求线程不会等磁盘IO；
+队列满时丢弃并计数。
+
+文件日志可以用JsonFormatter每条输出一个JSON对象，带上关联id、RPC名、订单号、设备号和耗时。
+"""
 import sys
-from datetime import datetime
+import copy
+import time
+import atexit
+import logging
+import ujson as json
+from datetime import datetime, timedelta
+from util import metrics, trace
+
+try:
+    # eventlet打过补丁后threading是绿色线程，写文件会卡住整个hub，
+    # 和eventlet.tpool一样用原始的线程和队列
+    from eventlet import patcher
+    _threading = patcher.original("threading")
+    _Queue = patcher.original("Queue")
+except ImportError:
+    import threading as _threading
+    import Queue as _Queue
 
 try:
     import colorama
@@ -23,7 +47,10 @@ unicode_type = unicode
 basestring_type = basestring
 
 
-def init_logger(logger=None, level="INFO", path="./"):
+def init_logger(logger=None, level="INFO", path="./", queue_size=10000, fmt="text"):
+    """
+    fmt: 文件日志格式，text或json
+    """
     if not logger:
         logger = logging.getLogger()
 
@@ -32,11 +59,30 @@ def init_logger(logger=None, level="INFO", path="./"):
     channel.setFormatter(LogFormatter())
     logger.addHandler(channel)
 
-    channel = DaemonFileLogHandler(path)
-    channel.setFormatter(LogFormatter())
+    channel = DaemonFileLogHandler(path, delay=1)
+    channel.setFormatter(JsonFormatter() if fmt == "json" else LogFormatter())
+    channel = queued(channel, "file", queue_size)
+    if fmt == "json":
+        # RPC上下文只在记日志的线程里拿得到，入队前记到record上
+        channel.addFilter(RpcContextFilter())
     logger.addHandler(channel)
 
 
+def queued(handler, name, queue_size=10000):
+    """
+    把handler包成异步写：返回放进logger的QueueHandler，后台线程负责写出
+    """
+    queue = _Queue.Queue(queue_size)
+    listener = QueueListener(queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    channel = QueueHandler(queue)
+    channel.setLevel(handler.level)
+    _pipelines[name] = (channel, listener)
+    return channel
+
+
 def _stderr_supports_color():
     try:
         if hasattr(sys.stderr, 'isatty') and sys.stderr.isatty():
@@ -66,41 +112,178 @@ def _safe_unicode(value):
 
 
 class DaemonFileLogHandler(logging.FileHandler):
+    """
+    按天写到<目录>/<yyyymmdd>.log；可以逐条emit，也可以由QueueListener成批emit_batch
+    """
 
-    # _LOG_FILEFORMAT = '%Y%m%d%H'
     _LOG_FILEFORMAT = '%Y%m%d'
 
     def __init__(self, filename, mode='a', encoding=None, delay=0):
+        self._rollover_at = 0
         super(DaemonFileLogHandler, self).__init__(filename, mode, encoding, delay)
 
-    def get_cur_filename(self):
-        t = datetime.now()
+    def get_cur_filename(self, t=None):
+        t = datetime.fromtimestamp(t) if t else datetime.now()
         newlogfile = "%s/%s.log" % (self.baseFilename, t.strftime(self._LOG_FILEFORMAT))
         return newlogfile
 
-    def _open(self):
+    def _open(self, t=None):
+        t = t or time.time()
+        filename = self.get_cur_filename(t)
+        # 下一次切换文件的时间：t之后的第一个零点
+        tomorrow = datetime.fromtimestamp(t).date() + timedelta(days=1)
+        self._rollover_at = time.mktime(tomorrow.timetuple())
         if self.encoding is None:
-            stream = open(self.get_cur_filename(), self.mode)
+            stream = open(filename, self.mode)
         else:
-            stream = codecs.open(self.get_cur_filename(), self.mode, self.encoding)
+            stream = codecs.open(filename, self.mode, self.encoding)
         return stream
 
-    def _get_stream(self):
+    def _get_stream(self, created):
         if self.stream is None:
-            self.stream = self._open()
-        else:
-            cur_filename = self.get_cur_filename()
-            if cur_filename != self.stream.name:
-                self.stream = self._open()
-
+            self.stream = self._open(created)
+        elif created >= self._rollover_at:
+            # 跨天：关掉旧文件再打开新文件
+            self.stream.close()
+            self.stream = None
+            self.stream = self._open(created)
         return self.stream
 
+    def _write(self, lines):
+        if not lines:
+            return
+        text = u"\n".join(_safe_unicode(line) for line in lines) + u"\n"
+        if self.encoding is None:
+            text = text.encode("utf-8")
+        self.stream.write(text)
+        self.stream.flush()
+
     def emit(self, record):
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        """
+        格式化一批记录后一次写入并flush；跨天时先把已格式化的写进旧文件
+        """
+        lines = []
+        for record in records:
+            try:
+                if self.stream is None or record.created >= self._rollover_at:
+                    self._write(lines)
+                    lines = []
+                    self._get_stream(record.created)
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
         try:
-            self._get_stream()
-        except:
+            self._write(lines)
+        except Exception:
+            self.handleError(records[-1])
+
+
+class QueueHandler(logging.Handler):
+    """
+    把日志记录放进有界队列；队列满时直接丢弃并计数，调用方不会阻塞
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 参数和异常栈在之后可能被修改或释放，入队前先转成字符串
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except _Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    后台线程从队列取记录，每次把已经排队的记录(最多batch_size条)一起交给
+    handler.emit_batch，没有emit_batch的handler逐条handle
+    """
+    _sentinel = None
+
+    def __init__(self, queue, handler, batch_size=500):
+        self.queue = queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = _threading.Thread(target=self._monitor, name="log-listener")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _monitor(self):
+        stop = False
+        while not stop:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except _Queue.Empty:
+                    break
+                if record is self._sentinel:
+                    stop = True
+                    break
+                batch.append(record)
+            self.handle(batch)
+
+    def handle(self, batch):
+        if hasattr(self.handler, "emit_batch"):
+            self.handler.emit_batch(batch)
+        else:
+            for record in batch:
+                self.handler.handle(record)
+        self.written += len(batch)
+        self.batches += 1
+
+    def stop(self, timeout=5):
+        """
+        写完已排队的记录后退出
+        """
+        if self._thread is None:
             return
-        return logging.StreamHandler.emit(self, record)
+        try:
+            self.queue.put(self._sentinel, timeout=timeout)
+        except _Queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+
+_exc_formatter = logging.Formatter()
+_pipelines = {}
+
+
+def log_stats():
+    return dict((name, {"queued": channel.queue.qsize(),
+                        "dropped": channel.dropped,
+                        "written": listener.written,
+                        "batches": listener.batches})
+                for name, (channel, listener) in _pipelines.items())
+
+
+metrics.register_gauges("log", "handler", log_stats)
 
 
 class LogFormatter(logging.Formatter):
@@ -165,6 +348,72 @@ class LogFormatter(logging.Formatter):
         return formatted.replace("\n", "\n    ")
 
 
+def _add_object_no(record):
+    # "[order](%s) ..."、"[device](%s-%s) ..."这类日志的第一个参数是订单号、设备号
+    if not record.args or not isinstance(record.args, tuple) or \
+            not isinstance(record.msg, basestring_type):
+        return
+    if record.msg.startswith("[order]") and getattr(record, "order_no", None) is None:
+        record.order_no = record.args[0]
+    elif record.msg.startswith("[device]") and getattr(record, "device_no", None) is None:
+        record.device_no = record.args[0]
+
+
+class RpcContextFilter(logging.Filter):
+    """
+    在记日志的线程里把当前RPC的名字、已执行的毫秒数、关联id和订单号、设备号记到record上，
+    之后在后台线程格式化也不会丢
+    """
+
+    def filter(self, record):
+        if getattr(record, "cid", None) is None:
+            record.cid = trace.current_id()
+        tracker = metrics.current()
+        if tracker is not None and not hasattr(record, "rpc"):
+            record.rpc = tracker.name
+            record.duration = int((record.created - tracker.start) * 1000)
+        _add_object_no(record)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出一行JSON：
+    {"ts", "level", "logger", "src", "msg", "cid", "rpc", "duration", "order_no", "device_no", "exc"}
+
+    cid(关联id)、rpc、duration来自RpcContextFilter或extra；order_no、device_no可以通过
+    extra传入，否则从"[order](%s)"、"[device](%s)"开头的日志取第一个参数。
+    没有值的字段不输出。
+    """
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "src": "%s:%s" % (record.module, record.lineno),
+            "msg": record.getMessage(),
+        }
+        _add_object_no(record)
+        for key in ("cid", "rpc", "duration", "order_no", "device_no"):
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+
+        try:
+            return json.dumps(data)
+        except Exception:
+            # 非utf-8的字节串等
+            data = dict((k, _safe_unicode(v) if isinstance(v, str) else v)
+                        for k, v in data.items())
+            return json.dumps(data)
+
+
 if __name__ == "__main__":
     logger = logging.getLogger()
     init_logger(logger, level="DEBUG")
@@ -75,9 +75,53 @@ class Command(object):
         from tests import init_data
         init_data.init_all()
 
+    def rebuild_hour_stat(self, start_date, end_date):
+        """
+        回填小时统计表，[start_date, end_date]，格式：2018-06-01
+
+        migrate建好hour_order_stat表后要从最早的订单日期回填到今天
+        """
+        from datetime import datetime, timedelta
+        from models import HourOrderStat
+        start_at = datetime.strptime(str(start_date), "%Y-%m-%d")
+        end_at = datetime.strptime(str(end_date), "%Y-%m-%d") + timedelta(days=1)
+        while start_at < end_at:
+            next_at = min(start_at + timedelta(days=1), end_at)
+            HourOrderStat.rebuild(start_at, next_at)
+            logging.info("rebuild hour stat %s done", start_at.strftime("%Y-%m-%d"))
+            start_at = next_at
+
+    def migrate(self):
+        """
+        执行未执行过的数据库迁移（补建索引等）
+        """
+        import migration
+        logging.info("migrations applied: %s", migration.run_migrations())
+
+    def check_query_plans(self):
+        """
+        EXPLAIN热点查询，有全表扫描时返回非0
+        """
+        import migration
+        scans = migration.check_query_plans()
+        if scans:
+            logging.error("full table scans: %s", scans)
+            sys.exit(1)
+        logging.info("all hot queries use indexes")
+
+    def stat_days(self, start_date, end_date, workers=4):
+        """
+        回填每日统计表，[start_date, end_date]，格式：2018-06-01
+        """
+        import datastat
+        reports = datastat.stat_days(str(start_date), str(end_date), workers=workers)
+        failed = [r["day"] for r in reports if r["errors"]]
+        logging.info("stat %s days, cost %.3fs, failed: %s",
+                     len(reports), sum(r["seconds"] for r in reports), failed)
+
 
 if __name__ == "__main__":
     autodiscover.autodiscover("./service")
-    init_logger(level=config.log_level, path=config.log_path)
+    init_logger(level=config.log_level, path=config.log_path, fmt=config.log_format)
     logging.getLogger("peewee").setLevel(getattr(logging, config.log_level.upper()))
     fire.Fire(Command)
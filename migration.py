@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+"""
+数据库迁移
+
+给已经上线的表补建索引。唯一索引建之前要先合并历史上重复写入的行，否则建
+索引会失败。每次迁移写死自己要建的索引，不能按当前的Meta.indexes同步：Meta里
+可能有后面的迁移才加的字段。
+
+MIGRATIONS按顺序登记每一次迁移，执行过的记在migration_history表里，
+run_migrations只执行还没执行过的。check_query_plans用EXPLAIN检查热点查询，
+有全表扫描就说明索引缺失或者查询写法走不了索引。
+"""
+import logging
+import peewee as pw
+
+from datetime import datetime as dte, timedelta
+from peewee import fn
+from playhouse.migrate import MySQLMigrator, SqliteMigrator, migrate
+from models import (db, BaseModel, Order, User, Item, ItemCategory, ItemBrand,
+                    SMSHistory, DayDeviceStat, DayItemStat, DayUserGroupStat,
+                    HourOrderStat)
+from const import OrderStatus, SMSStatus, SMSReceipt
+
+logger = logging.getLogger(__name__)
+
+# 需要补建索引的聚合表：(model, 唯一键, 重复行需要累加的字段, 查询索引)
+# 其余数值字段取最大值，订单类指标可以再用datastat.stat_days重算
+STAT_TABLES = [
+    (DayDeviceStat, ("day", "device"), ("flows", "stays", "clicks"),
+     [("device", "day"), ("day", "flows", "stays", "clicks")]),
+    (DayItemStat, ("day", "item"), (), [("item", "day")]),
+    (DayUserGroupStat, ("day", "user_group"), (), [("user_group", "day")]),
+]
+
+ORDER_INDEXES = [
+    (("created_at", ), False),
+    (("status", "created_at"), False),
+    (("device", "status", "created_at"), False),
+    (("user", "status", "created_at"), False),
+]
+
+
+def get_migrator():
+    if isinstance(db, pw.MySQLDatabase):
+        return MySQLMigrator(db)
+    return SqliteMigrator(db)
+
+
+def _columns(model, fields):
+    return [model._meta.fields[f].db_column for f in fields]
+
+
+def merge_duplicates(model, key, incr_fields=()):
+    """
+    按唯一键合并重复行，保留id最小的一行，返回删除的行数
+    """
+    key_fields = [getattr(model, f) for f in key]
+    number_fields = [f for f in model._meta.sorted_fields
+                     if isinstance(f, pw.IntegerField) and not isinstance(f, pw.PrimaryKeyField)
+                     and f.name not in key]
+
+    groups = model.select(*key_fields) \
+                  .group_by(*key_fields) \
+                  .having(fn.COUNT(model.id) > 1) \
+                  .tuples()
+
+    deleted = 0
+    for values in groups:
+        where = [field == value for field, value in zip(key_fields, values)]
+        columns = [fn.MIN(model.id).alias("keep")]
+        for f in number_fields:
+            agg = fn.SUM(f) if f.name in incr_fields else fn.MAX(f)
+            columns.append(agg.alias(f.name))
+        merged = model.select(*columns) \
+                      .where(*where) \
+                      .dicts() \
+                      .first()
+        keep = merged.pop("keep")
+        with db.atomic():
+            model.update(**{k: int(v or 0) for k, v in merged.items()}) \
+                 .where(model.id == keep) \
+                 .execute()
+            deleted += model.delete().where(model.id != keep, *where).execute()
+    logger.info("[migration] merge %s duplicates: %s rows deleted",
+                model._meta.db_table, deleted)
+    return deleted
+
+
+def sync_indexes(model, indexes, drop=()):
+    """
+    创建indexes里数据库还没有的索引，格式同Meta.indexes；drop为需要删除的旧索引字段
+
+    返回新建的索引名
+    """
+    table = model._meta.db_table
+    compiler = db.compiler()
+    exists = set(idx.name for idx in db.get_indexes(table))
+    migrator = get_migrator()
+
+    operations = []
+    for fields in drop:
+        name = compiler.index_name(table, _columns(model, fields))
+        if name in exists:
+            operations.append(migrator.drop_index(table, name))
+
+    created = []
+    for fields, unique in indexes:
+        columns = _columns(model, fields)
+        name = compiler.index_name(table, columns)
+        if name not in exists:
+            operations.append(migrator.add_index(table, columns, unique))
+            created.append(name)
+
+    if operations:
+        migrate(*operations)
+    logger.info("[migration] %s indexes created: %s", table, created)
+    return created
+
+
+def migrate_stat_indexes():
+    """
+    聚合表补建(day, 维度)唯一索引和查询索引，并删掉被唯一索引覆盖的day单列索引
+    """
+    res = {}
+    for model, key, incr_fields, query_indexes in STAT_TABLES:
+        merge_duplicates(model, key, incr_fields)
+        indexes = [(key, True)] + [(fields, False) for fields in query_indexes]
+        res[model._meta.db_table] = sync_indexes(model, indexes, drop=[("day", )])
+    return res
+
+
+def migrate_order_indexes():
+    """
+    订单表补建时间、状态、设备、用户的组合索引
+    """
+    return {Order._meta.db_table: sync_indexes(Order, ORDER_INDEXES)}
+
+
+def add_user_counters():
+    """
+    用户表加购买次数、兑换码计数字段，并按历史数据初始化
+    """
+    import datastat
+    table = User._meta.db_table
+    exists = set(c.name for c in db.get_columns(table))
+    migrator = get_migrator()
+    fields = [User.buy_count, User.recent_buy_count, User.redeem_total, User.redeem_used]
+    operations = [migrator.add_column(table, f.db_column, f)
+                  for f in fields if f.db_column not in exists]
+    if operations:
+        migrate(*operations)
+    return datastat.rebuild_user_counters()
+
+
+def add_item_counters():
+    """
+    商品表加销量、访问量字段，商品类型、品牌表加商品数字段，并按历史数据初始化
+    """
+    import datastat
+    migrator = get_migrator()
+    operations = []
+    for field in [Item.sales_count, Item.pv_count,
+                  ItemCategory.item_count, ItemBrand.item_count]:
+        table = field.model_class._meta.db_table
+        if field.db_column not in set(c.name for c in db.get_columns(table)):
+            operations.append(migrator.add_column(table, field.db_column, field))
+    if operations:
+        migrate(*operations)
+    return datastat.rebuild_item_counters()
+
+
+def add_sms_outbox_fields():
+    """
+    短信表加发件箱用的下次发送时间、重试次数、失败原因字段和(status, send_at)索引
+    """
+    table = SMSHistory._meta.db_table
+    exists = set(c.name for c in db.get_columns(table))
+    migrator = get_migrator()
+    fields = [SMSHistory.send_at, SMSHistory.retries, SMSHistory.error]
+    operations = [migrator.add_column(table, f.db_column, f)
+                  for f in fields if f.db_column not in exists]
+    if operations:
+        migrate(*operations)
+        # 以前是同步发送，停留在READY的是发送时异常中断的，不再补发
+        SMSHistory.update(status=SMSStatus.FAIL) \
+                  .where(SMSHistory.status == SMSStatus.READY) \
+                  .execute()
+    return {table: sync_indexes(SMSHistory, [(("status", "send_at"), False)])}
+
+
+def add_sms_receipt_field():
+    """
+    短信表加回执状态字段和回执查询索引
+
+    已有的短信不再对账，直接记为接收成功
+    """
+    table = SMSHistory._meta.db_table
+    if SMSHistory.receipt.db_column not in set(c.name for c in db.get_columns(table)):
+        migrate(get_migrator().add_column(table, SMSHistory.receipt.db_column,
+                                          SMSHistory.receipt))
+        SMSHistory.update(receipt=SMSReceipt.DELIVERED) \
+                  .where(SMSHistory.status == SMSStatus.OK) \
+                  .execute()
+    return {table: sync_indexes(SMSHistory, [(("receipt", "created_at"), False)])}
+
+
+def add_sms_receipt_checks():
+    """
+    短信表加回执查询次数字段，回执查询索引改为(receipt, send_at)
+    """
+    table = SMSHistory._meta.db_table
+    if SMSHistory.receipt_checks.db_column not in set(c.name for c in db.get_columns(table)):
+        migrate(get_migrator().add_column(table, SMSHistory.receipt_checks.db_column,
+                                          SMSHistory.receipt_checks))
+    return {table: sync_indexes(SMSHistory, [(("receipt", "send_at"), False)],
+                                drop=[("receipt", "created_at")])}
+
+
+def add_hour_order_stat():
+    """
+    建小时订单统计表
+
+    新表是空的，看板的历史销售额要在迁移之后按订单表回填：
+    python manage.py rebuild_hour_stat <最早订单日期> <今天>
+    """
+    table = HourOrderStat._meta.db_table
+    if not HourOrderStat.table_exists():
+        db.create_table(HourOrderStat)
+    return {table: sync_indexes(HourOrderStat, [(("hour", "device", "item", "pay_type"), True)])}
+
+
+MIGRATIONS = [
+    ("0001_stat_indexes", migrate_stat_indexes),
+    ("0002_order_indexes", migrate_order_indexes),
+    ("0003_user_counters", add_user_counters),
+    ("0004_item_counters", add_item_counters),
+    ("0005_sms_outbox", add_sms_outbox_fields),
+    ("0006_sms_receipt", add_sms_receipt_field),
+    ("0007_sms_receipt_checks", add_sms_receipt_checks),
+    ("0008_hour_order_stat", add_hour_order_stat),
+]
+
+
+class MigrationHistory(BaseModel):
+    """
+    已执行的迁移
+    """
+    name = pw.CharField(unique=True)
+    created_at = pw.DateTimeField(default=dte.now)
+
+    class Meta:
+        db_table = 'migration_history'
+
+
+def run_migrations():
+    """
+    按顺序执行未执行过的迁移，返回本次执行的迁移名
+    """
+    MigrationHistory.create_table(fail_silently=True)
+    done = set(m.name for m in MigrationHistory.select())
+
+    applied = []
+    for name, func in MIGRATIONS:
+        if name in done:
+            continue
+        logger.info("[migration] apply %s", name)
+        func()
+        MigrationHistory.create(name=name)
+        applied.append(name)
+    return applied
+
+
+def get_hot_queries():
+    """
+    需要走索引的热点查询
+    """
+    now = dte.now()
+    last_28_days = now - timedelta(days=28)
+    return [
+        ("cluster_heartbeat",
+         Order.select().where(Order.status.in_([OrderStatus.CREATED,
+                                                OrderStatus.DELIVERING]))),
+        ("dashboard_orders",
+         Order.select(fn.COUNT(Order.id)).where(Order.created_at >= last_28_days)),
+        ("status_orders",
+         Order.select().where(Order.status == OrderStatus.DONE,
+                              Order.created_at >= last_28_days)),
+        ("device_orders",
+         Order.select(fn.COUNT(Order.id)).where(Order.device == 1,
+                                                Order.status == OrderStatus.DONE)),
+        ("user_buys",
+         Order.select(fn.COUNT(Order.id)).where(Order.user == 1,
+                                                Order.status == OrderStatus.DONE)),
+        ("user_buys_28_days",
+         Order.select(fn.COUNT(Order.id)).where(Order.user == 1,
+                                                Order.status == OrderStatus.DONE,
+                                                Order.created_at >= last_28_days)),
+        ("device_day_stat",
+         DayDeviceStat.select().where(DayDeviceStat.device == 1,
+                                      DayDeviceStat.day >= "2018-01-01")),
+        ("item_day_stat",
+         DayItemStat.select().where(DayItemStat.item == 1,
+                                    DayItemStat.day >= "2018-01-01")),
+        ("user_group_day_stat",
+         DayUserGroupStat.select().where(DayUserGroupStat.user_group == 1,
+                                         DayUserGroupStat.day >= "2018-01-01")),
+    ]
+
+
+def explain(query):
+    """
+    返回查询计划里全表扫描的表名
+    """
+    sql, params = query.sql()
+    if isinstance(db, pw.MySQLDatabase):
+        cursor = db.execute_sql("EXPLAIN " + sql, params)
+        columns = [c[0] for c in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return [r["table"] for r in rows if r["type"] == "ALL"]
+
+    # sqlite: "SCAN order"是全表扫描，"SCAN order USING INDEX ..."是索引扫描
+    cursor = db.execute_sql("EXPLAIN QUERY PLAN " + sql, params)
+    scans = []
+    for row in cursor.fetchall():
+        detail = row[-1].split()
+        if detail[0] == "SCAN" and "USING" not in detail:
+            scans.append(detail[1].strip('"'))
+    return scans
+
+
+def check_query_plans():
+    """
+    检查热点查询，返回{查询名: 全表扫描的表}，全部走索引时返回空
+    """
+    res = {}
+    for name, query in get_hot_queries():
+        scans = explain(query)
+        if scans:
+            logger.warning("[migration] %s full scan on %s", name, scans)
+            res[name] = scans
+    return res
@@ -1,35 +1,193 @@
 # coding:utf-8
 
+import time
 import random
+import threading
 import logging
 import peewee as pw
 import ujson as json
 import const as C
 
 from datetime import datetime as dte
+from contextlib import contextmanager
 from config import config
 from const import (RedeemStatus, RoadStatus, FaultType, RoadStatusMsg, FaultMsg,
                    SupplyStatus)
 from playhouse.fields import ManyToManyField
+from playhouse.shortcuts import case
+from playhouse.pool import PooledDatabase, PooledMySQLDatabase as _PooledMySQLDatabase, \
+    MaxConnectionsExceeded
+from util import metrics
+from util.slowquery import SlowQueryRecorder
+from util.replica import ReplicaRouter
 
 logger = logging.getLogger(__name__)
 
 
+class SQLHookMixin(object):
+    """
+    每条SQL执行成功后依次调用sql_hooks里的hook(sql, params, seconds)
+
+    执行失败的（锁等待超时、连接断开等）不调用：耗时不代表查询本身慢，
+    连接也可能已经不能用了
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SQLHookMixin, self).__init__(*args, **kwargs)
+        self.sql_hooks = []
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        begin = time.time()
+        cursor = super(SQLHookMixin, self).execute_sql(sql, params, require_commit)
+        seconds = time.time() - begin
+        for hook in self.sql_hooks:
+            try:
+                hook(sql, params, seconds)
+            except Exception:
+                logger.exception("sql hook %s error", hook)
+        return cursor
+
+
+class PoolStatsMixin(object):
+    """
+    连接池统计：取连接次数、等待时间、超时次数
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PoolStatsMixin, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_wait = 0
+        self.checkout_timeouts = 0
+
+    def connect(self):
+        begin = time.time()
+        try:
+            super(PoolStatsMixin, self).connect()
+        except MaxConnectionsExceeded:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            self.checkouts += 1
+            self.checkout_wait += time.time() - begin
+
+    def pool_stats(self):
+        return {
+            "in_use": len(self._in_use),
+            "idle": len(self._connections),
+            "max": self.max_connections,
+            "checkouts": self.checkouts,
+            "checkout_wait": round(self.checkout_wait, 3),
+            "timeouts": self.checkout_timeouts,
+        }
+
+
+class MySQLDatabase(SQLHookMixin, pw.MySQLDatabase):
+    pass
+
+
+class PooledMySQLDatabase(SQLHookMixin, PoolStatsMixin, _PooledMySQLDatabase):
+    """
+    MySQL连接池：取出时ping检查，超过stale_timeout的连接归还时关闭
+    """
+
+
+class SqliteDatabase(SQLHookMixin, pw.SqliteDatabase):
+    pass
+
+
+def create_mysql_database(conf):
+    return PooledMySQLDatabase(conf.get("database", config.mysql["database"]), **{
+        'host': conf["host"],
+        'port': conf["port"],
+        'user': conf.get("user", config.mysql["user"]),
+        "password": conf.get("password", config.mysql["password"]),
+        "max_connections": config.mysql_pool["max_connections"],
+        "stale_timeout": config.mysql_pool["stale_timeout"],
+        "timeout": config.mysql_pool["timeout"],
+    })
+
+
 if config.database == "sqlite":
-    db = pw.SqliteDatabase(':memory:')
+    db = SqliteDatabase(':memory:')
+    replicas = []
 else:
-    db = pw.MySQLDatabase(config.mysql["database"], **{
-        'host': config.mysql["host"],
-        'port': config.mysql["port"],
-        'user': config.mysql["user"],
-        "password": config.mysql["password"],
-    })
+    db = create_mysql_database(config.mysql)
+    replicas = [create_mysql_database(conf) for conf in config.mysql_replicas]
+
+slow_queries = SlowQueryRecorder(db,
+                                 threshold=config.slow_query_threshold,
+                                 explain_rate=config.slow_query_explain_rate)
+for database in [db] + replicas:
+    database.sql_hooks.append(metrics.on_sql)
+    database.sql_hooks.append(slow_queries.for_database(database))
+
+# 只读RPC里的SELECT走从库
+router = ReplicaRouter(db, replicas,
+                       max_lag=config.replica_max_lag,
+                       check_interval=config.replica_check_interval)
+
+_scope = threading.local()
+
+
+@contextmanager
+def connection_scope():
+    """
+    一次RPC/定时任务使用的数据库连接
+
+    进入时从连接池取出主库连接，退出时把主库和用过的从库连接归还连接池；
+    嵌套时只有最外层生效。非连接池的数据库（测试用的sqlite）不做处理。
+    """
+    if getattr(_scope, "active", False):
+        yield
+        return
+
+    _scope.active = True
+    try:
+        if isinstance(db, PooledDatabase) and db.is_closed():
+            db.connect()
+        yield
+    finally:
+        _scope.active = False
+        for database in [db] + replicas:
+            if isinstance(database, PooledDatabase) and not database.is_closed():
+                try:
+                    database.close()
+                except Exception:
+                    logger.exception("release connection error")
+
+
+def pool_stats():
+    """
+    各连接池的统计，key为primary、replica-0、replica-1...
+    """
+    res = {}
+    for name, database in [("primary", db)] + \
+            [("replica-%s" % i, r) for i, r in enumerate(replicas)]:
+        if isinstance(database, PoolStatsMixin):
+            res[name] = database.pool_stats()
+    return res
+
+
+metrics.register_gauges("db_pool", "pool", pool_stats)
 
 
 class BaseModel(pw.Model):
     class Meta:
         database = db
 
+    @classmethod
+    def select(cls, *selection):
+        query = super(BaseModel, cls).select(*selection)
+        query.database = router.read_database()
+        return query
+
+    @classmethod
+    def raw(cls, sql, *params):
+        query = super(BaseModel, cls).raw(sql, *params)
+        if sql.lstrip()[:6].upper() == "SELECT":
+            query.database = router.read_database()
+        return query
+
     @classmethod
     def get_or_none(cls, *args, **kwargs):
         query = []
@@ -57,6 +215,51 @@ class BaseModel(pw.Model):
                 obj.save()
         return obj
 
+    @classmethod
+    def insert_or_update(cls, rows, conflict=None, replace=(), incr=()):
+        """
+        批量写入，唯一键冲突时更新已有记录：replace里的字段覆盖，incr里的字段累加
+
+        MySQL用INSERT ... ON DUPLICATE KEY UPDATE，sqlite用ON CONFLICT DO UPDATE；
+        conflict是sqlite需要的唯一键字段，默认取Meta.indexes里第一个唯一索引
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+
+        database = cls._meta.database
+        quote = database.compiler().quote
+        sql, params = cls.insert_many(rows).sql()
+        if isinstance(database, pw.MySQLDatabase):
+            sql += " ON DUPLICATE KEY UPDATE "
+            new_value = "VALUES(%s)"
+        else:
+            if not conflict:
+                conflict = [fields for fields, unique in cls._meta.indexes if unique][0]
+            sql += " ON CONFLICT (%s) DO UPDATE SET " % \
+                ", ".join(quote(cls._meta.fields[f].db_column) for f in conflict)
+            new_value = "excluded.%s"
+
+        updates = []
+        for name in replace:
+            column = quote(cls._meta.fields[name].db_column)
+            updates.append("%s = %s" % (column, new_value % column))
+        for name in incr:
+            column = quote(cls._meta.fields[name].db_column)
+            updates.append("%s = %s + %s" % (column, column, new_value % column))
+        sql += ", ".join(updates)
+        return database.execute_sql(sql, params).rowcount
+
+    @classmethod
+    def incr_counters(cls, pk, **deltas):
+        """
+        累加计数字段，deltas可以为负数
+        """
+        if not pk:
+            return
+        values = dict((k, getattr(cls, k) + v) for k, v in deltas.items())
+        cls.update(**values).where(cls._meta.primary_key == pk).execute()
+
     @property
     def key(self):
         return self.id
@@ -86,6 +289,44 @@ class Image(BaseModel):
         }
 
 
+def prefetch_status_counts(objs, field, used_status):
+    """
+    用一条GROUP BY统计一页活动下的码总数和已使用数，存到obj._counts
+
+    field是子表指向活动的外键，例如Redeem.activity
+    """
+    model = field.model_class
+    counts = dict((o.id, {"total": 0, "used": 0}) for o in objs)
+    if not counts:
+        return objs
+    qs = model.select(field, model.status, pw.fn.COUNT(model.id)) \
+              .where(field.in_(list(counts))) \
+              .group_by(field, model.status) \
+              .tuples()
+    for pk, status, cnt in qs:
+        counts[pk]["total"] += cnt
+        if status == used_status:
+            counts[pk]["used"] += cnt
+    for o in objs:
+        o._counts = counts[o.id]
+    return objs
+
+
+def prefetch_images(objs, *names):
+    """
+    用一次查询加载objs里指向Image的外键字段names，避免逐行查询
+    """
+    ids = set(o._data.get(n) for o in objs for n in names) - set([None])
+    if not ids:
+        return objs
+    images = dict((img.id, img) for img in Image.select().where(Image.id.in_(list(ids))))
+    for o in objs:
+        for n in names:
+            if o._data.get(n) in images:
+                setattr(o, n, images[o._data[n]])
+    return objs
+
+
 class Video(BaseModel):
 
     id = pw.PrimaryKeyField()
@@ -362,6 +603,7 @@ class ItemCategory(BaseModel):
                                    related_name="itemcategory_set1")
     image = pw.ForeignKeyField(Image, null=True,
                                related_name="itemcategory_set2")
+    item_count = pw.IntegerField(default=0)             # 商品数
     created_at = pw.DateTimeField(default=dte.now)
 
     class Meta:
@@ -375,7 +617,7 @@ class ItemCategory(BaseModel):
                             if self.thumbnail else "",
             "image": self.image.to_dict(base_url=base_url)
                             if self.image else "",
-            "itemCount": self.item_set.count(),
+            "itemCount": self.item_count,
             "createdAt": self.created_at.strftime("%Y-%m-%d %H:%M:%S")
         }
 
@@ -394,13 +636,14 @@ class ItemBrand(BaseModel):
     """
     id = pw.PrimaryKeyField()
     name = pw.CharField(unique=True)
+    item_count = pw.IntegerField(default=0)             # 商品数
     created_at = pw.DateTimeField(default=dte.now)
 
     def to_dict(self):
         return {
             "id": self.id,
             "name": self.name,
-            "itemCount": self.item_set.count(),
+            "itemCount": self.item_count,
             "createdAt": self.created_at.strftime("%Y-%m-%d %H:%M:%S")
         }
 
@@ -418,20 +661,60 @@ class Item(BaseModel):
     basic_price = pw.IntegerField(default=0)            # 价格；建议价; 并不是最终出售价格
     cost_price = pw.IntegerField(default=0)             # 成本价
     description = pw.CharField(null=True)               # 商品描述
+    sales_count = pw.IntegerField(default=0)            # 销量：出货成功的订单数
+    pv_count = pw.IntegerField(default=0)               # 访问量：下单数
     updated_at = pw.DateTimeField(default=dte.now)
     created_at = pw.DateTimeField(default=dte.now)
 
     class Meta:
         db_table = 'item'
 
+    @classmethod
+    def refresh_item_counts(cls, categories=(), brands=()):
+        """
+        重算指定商品类型、品牌的商品数，商品增删改后调用
+        """
+        for model, field, ids in [(ItemCategory, cls.category, categories),
+                                  (ItemBrand, cls.brand, brands)]:
+            ids = set(i for i in ids if i)
+            if not ids:
+                continue
+            counts = dict(cls.select(field, pw.fn.COUNT(cls.id))
+                             .where(field.in_(list(ids)))
+                             .group_by(field)
+                             .tuples())
+            for pk in ids:
+                model.update(item_count=counts.get(pk, 0)).where(model.id == pk).execute()
+
+    @classmethod
+    def prefetch_relations(cls, items):
+        """
+        一次性加载一页商品的缩略图、商品类型图片，避免to_dict逐行查询
+
+        商品类型、品牌需要在查询时join进来
+        """
+        if not items:
+            return items
+        through = cls.thumbnails.get_through_model()
+        thumbnails = {}
+        for obj in through.select(through, Image) \
+                          .join(Image) \
+                          .where(through.item.in_([o.id for o in items])):
+            thumbnails.setdefault(obj.item_id, []).append(obj.image)
+        for o in items:
+            o._thumbnails = thumbnails.get(o.id, [])
+        prefetch_images([o.category for o in items], "thumbnail", "image")
+        return items
+
     def to_dict(self, base_url=""):
-        pv = self.order_set.count()
-        sales = self.order_set.where(Order.status == C.OrderStatus.DONE).count()
+        thumbnails = getattr(self, "_thumbnails", None)
+        if thumbnails is None:
+            thumbnails = self.thumbnails
         return {
             "id": self.id,
             "no": self.no,
-            "sales": sales,         # 销量
-            "pv": pv,               # 访问量
+            "sales": self.sales_count,      # 销量
+            "pv": self.pv_count,            # 访问量
             "name": self.name,
             "category": self.category.to_dict(base_url=base_url),
             "brand": self.brand.to_dict() if self.brand else {},
@@ -440,7 +723,7 @@ class Item(BaseModel):
             "createdAt": self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
             "updatedAt": self.updated_at.strftime("%Y-%m-%d %H:%M:%S"),
             "thumbnails": [obj.to_dict(base_url=base_url)
-                           for obj in self.thumbnails]
+                           for obj in thumbnails]
         }
 
 
@@ -499,6 +782,10 @@ class User(BaseModel):
     birthday = pw.DateTimeField(null=True)
     first_buy_at = pw.DateTimeField(null=True)
     last_buy_at = pw.DateTimeField(null=True)
+    buy_count = pw.IntegerField(default=0)              # 购买次数（出货成功的订单）
+    recent_buy_count = pw.IntegerField(default=0)       # 近RECENT_BUY_DAYS天购买次数，每天刷新
+    redeem_total = pw.IntegerField(default=0)           # 分到的兑换码数
+    redeem_used = pw.IntegerField(default=0)            # 已使用的兑换码数
     created_at = pw.DateTimeField(default=dte.now)      # 创建时间
 
     class Meta:
@@ -553,11 +840,31 @@ class RedeemActivity(BaseModel):
                 "id": item.id,
                 "name": item.name,
             },
-            "total": self.redeem_set.count(),
-            "used": self.redeem_set.where(Redeem.status == RedeemStatus.USED).count(),
+            "total": self.counts["total"],
+            "used": self.counts["used"],
             "createdAt": self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
         }
 
+    @property
+    def counts(self):
+        if not hasattr(self, "_counts"):
+            prefetch_status_counts([self], Redeem.activity, RedeemStatus.USED)
+        return self._counts
+
+    @classmethod
+    def select_for_list(cls):
+        """
+        列表查询，join用户群和商品
+        """
+        return cls.select(cls, UserGroup, Item) \
+                  .join(UserGroup) \
+                  .switch(cls) \
+                  .join(Item)
+
+    @classmethod
+    def prefetch_counts(cls, objs):
+        return prefetch_status_counts(objs, Redeem.activity, RedeemStatus.USED)
+
 
 class Redeem(BaseModel):
     "兑换码"
@@ -604,11 +911,31 @@ class VoiceActivity(BaseModel):
                 "id": item.id,
                 "name": item.name,
             } if item else {},
-            "total": self.voiceword_set.count(),
-            "used": self.voiceword_set.where(VoiceWord.status == RedeemStatus.USED).count(),
+            "total": self.counts["total"],
+            "used": self.counts["used"],
             "limit": self.limit,
         }
 
+    @property
+    def counts(self):
+        if not hasattr(self, "_counts"):
+            prefetch_status_counts([self], VoiceWord.activity, RedeemStatus.USED)
+        return self._counts
+
+    @classmethod
+    def select_for_list(cls):
+        """
+        列表查询，join设备群和商品
+        """
+        return cls.select(cls, DeviceGroup, Item) \
+                  .join(DeviceGroup) \
+                  .switch(cls) \
+                  .join(Item, pw.JOIN.LEFT_OUTER)
+
+    @classmethod
+    def prefetch_counts(cls, objs):
+        return prefetch_status_counts(objs, VoiceWord.activity, RedeemStatus.USED)
+
     @property
     def name(self):
         return self.code
@@ -655,6 +982,12 @@ class Order(BaseModel):
 
     class Meta:
         db_table = 'order'
+        indexes = (
+            (('created_at', ), False),                      # 看板按时间范围统计
+            (('status', 'created_at'), False),              # 按状态扫描订单
+            (('device', 'status', 'created_at'), False),    # 单台设备的成交
+            (('user', 'status', 'created_at'), False),      # 用户购买次数
+        )
 
     @classmethod
     def generate_order_no(self):
@@ -730,6 +1063,17 @@ class SMSHistory(BaseModel):
     tplparam = pw.CharField()                               # 模板参数
     biz_id = pw.CharField(default="")                       # 短信接口返回的回执id
     created_at = pw.DateTimeField(default=dte.now)          # 创建时间
+    send_at = pw.DateTimeField(default=dte.now)             # 下次发送时间；发送成功后为实际发送时间
+    retries = pw.IntegerField(default=0)                    # 已重试次数
+    error = pw.CharField(default="")                        # 最近一次失败原因
+    receipt = pw.IntegerField(default=C.SMSReceipt.UNKNOWN)     # 回执状态
+    receipt_checks = pw.IntegerField(default=0)             # 查询回执没有对上的次数
+
+    class Meta:
+        indexes = (
+            (("status", "send_at"), False),
+            (("receipt", "send_at"), False),
+        )
 
 
 class DayDeviceStat(BaseModel):
@@ -738,7 +1082,7 @@ class DayDeviceStat(BaseModel):
 
     聚合表
     """
-    day = pw.CharField(index=True)      # eg: 2019-09-12
+    day = pw.CharField()                # eg: 2019-09-12
     device = pw.ForeignKeyField(Device)
     flows = pw.IntegerField(default=0)                      # 人流量
     stays = pw.IntegerField(default=0)                      # 停留人数
@@ -752,9 +1096,12 @@ class DayDeviceStat(BaseModel):
     visitors = pw.IntegerField(default=0)                            # 商品访客数
     created_at = pw.DateTimeField(default=dte.now)                   # 创建时间
 
-    indexes = (
-        (('day', 'device'), True),
-    )
+    class Meta:
+        indexes = (
+            (('day', 'device'), True),
+            (('device', 'day'), False),                     # 单台设备按日期查询
+            (('day', 'flows', 'stays', 'clicks'), False),   # 看板人流汇总，覆盖索引
+        )
 
 
 class DayItemStat(BaseModel):
@@ -763,7 +1110,7 @@ class DayItemStat(BaseModel):
 
     聚合表
     """
-    day = pw.CharField(index=True)                          # eg: 2019-09-12
+    day = pw.CharField()                                    # eg: 2019-09-12
     item = pw.ForeignKeyField(Item)
     sales_volume = pw.IntegerField(default=0)                        # 销售额
     sales_quantity = pw.IntegerField(default=0)                      # 销售个数
@@ -773,9 +1120,11 @@ class DayItemStat(BaseModel):
     visitors = pw.IntegerField(default=0)                            # 商品访客数
     created_at = pw.DateTimeField(default=dte.now)                   # 创建时间
 
-    indexes = (
-        (('day', 'item'), True),
-    )
+    class Meta:
+        indexes = (
+            (('day', 'item'), True),
+            (('item', 'day'), False),                       # 单个商品按日期查询
+        )
 
 
 class DayUserGroupStat(BaseModel):
@@ -784,7 +1133,7 @@ class DayUserGroupStat(BaseModel):
 
     聚合表
     """
-    day = pw.CharField(index=True)                          # eg: 2019-09-12
+    day = pw.CharField()                                    # eg: 2019-09-12
     user_group = pw.ForeignKeyField(UserGroup)
     users = pw.IntegerField(default=0)                      # 用户数
     registers = pw.IntegerField(default=0)                  # 用户增加量; 净增购买用户
@@ -795,9 +1144,11 @@ class DayUserGroupStat(BaseModel):
     users_pay = pw.IntegerField(default=0)                  # 支付用户数
     created_at = pw.DateTimeField(default=dte.now)          # 创建时间
 
-    indexes = (
-        (('day', 'user_group'), True),
-    )
+    class Meta:
+        indexes = (
+            (('day', 'user_group'), True),
+            (('user_group', 'day'), False),                 # 单个用户群按日期查询
+        )
 
 
 class DayStat(BaseModel):
@@ -817,6 +1168,87 @@ class DayStat(BaseModel):
     created_at = pw.DateTimeField(default=dte.now)          # 创建时间
 
 
+class HourOrderStat(BaseModel):
+    """
+    按小时的订单统计，维度：设备、商品、支付类型
+
+    聚合表；订单出货成功、退款时增量更新，hour取订单创建时间所在的整点
+    """
+    hour = pw.DateTimeField()                               # eg: 2019-09-12 13:00:00
+    device = pw.ForeignKeyField(Device)
+    item = pw.ForeignKeyField(Item)
+    pay_type = pw.IntegerField(default=0)                   # 支付类型
+    orders_pay = pw.IntegerField(default=0)                 # 成交笔数
+    sales_volume = pw.IntegerField(default=0)               # 销售额
+    sales_quantity = pw.IntegerField(default=0)             # 销售个数
+    orders_refund = pw.IntegerField(default=0)              # 退款笔数
+    refund_money = pw.IntegerField(default=0)               # 退款金额
+    updated_at = pw.DateTimeField(default=dte.now)
+    created_at = pw.DateTimeField(default=dte.now)          # 创建时间
+
+    class Meta:
+        db_table = 'hour_order_stat'
+        indexes = (
+            (('hour', 'device', 'item', 'pay_type'), True),
+        )
+
+    @staticmethod
+    def truncate_hour(t):
+        return t.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def incr(cls, order, **deltas):
+        """
+        给订单所在的小时累加统计数，deltas可以为负数
+        """
+        row = dict(hour=cls.truncate_hour(order.created_at),
+                   device=order.device_id,
+                   item=order.item_id,
+                   pay_type=order.pay_type or 0,
+                   updated_at=dte.now(),
+                   **deltas)
+        cls.insert_or_update([row], replace=["updated_at"], incr=deltas.keys())
+
+    @classmethod
+    def rebuild(cls, start_at, end_at):
+        """
+        根据订单表重算[start_at, end_at)区间的小时统计，用于回填历史数据
+        """
+        start_at = cls.truncate_hour(start_at)
+        end_at = cls.truncate_hour(end_at)
+        if config.database == "sqlite":
+            hour = pw.fn.strftime("%Y-%m-%d %H:00:00", Order.created_at)
+        else:
+            hour = pw.fn.DATE_FORMAT(Order.created_at, "%Y-%m-%d %H:00:00")
+        pay_type = pw.fn.COALESCE(Order.pay_type, 0)
+        done = Order.status == C.OrderStatus.DONE
+        refunded = Order.status == C.OrderStatus.REFUNDED
+        now = dte.now()
+
+        query = Order.select(hour,
+                             Order.device,
+                             Order.item,
+                             pay_type,
+                             pw.fn.SUM(case(None, [(done, 1)], 0)),
+                             pw.fn.SUM(case(None, [(done, Order.pay_money)], 0)),
+                             pw.fn.SUM(case(None, [(done, Order.item_amount)], 0)),
+                             pw.fn.SUM(case(None, [(refunded, 1)], 0)),
+                             pw.fn.SUM(case(None, [(refunded, Order.refund_money)], 0)),
+                             pw.Param(now),
+                             pw.Param(now)) \
+                     .where(Order.created_at >= start_at,
+                            Order.created_at < end_at,
+                            Order.status.in_([C.OrderStatus.DONE, C.OrderStatus.REFUNDED])) \
+                     .group_by(hour, Order.device, Order.item, pay_type)
+
+        with db.atomic():
+            cls.delete().where(cls.hour >= start_at, cls.hour < end_at).execute()
+            cls.insert_from([cls.hour, cls.device, cls.item, cls.pay_type,
+                             cls.orders_pay, cls.sales_volume, cls.sales_quantity,
+                             cls.orders_refund, cls.refund_money,
+                             cls.updated_at, cls.created_at], query).execute()
+
+
 class AddressAdmin(BaseModel):
     """
     点位方管理员-点位
@@ -917,6 +1349,7 @@ MODEL_TABLES = [
     DayDeviceStat,
     DayUserGroupStat,
     DayStat,
+    HourOrderStat,
     Admin,
     AddressAdmin,
     SponsorItem,
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from const import PayType
+from util import trace
 from alipay import AliPay
 from wxpay import WXPay
 
@@ -16,6 +17,7 @@ class PayManager:
             return None
 
     @classmethod
+    @trace.traced("pay.precreate")
     def precreate(cls, pay_type, order_no, price, notify_url, item_info, device_info):
         payobj = cls.get_pay_obj(pay_type)
         if not payobj:
@@ -24,6 +26,7 @@ class PayManager:
         return data
 
     @classmethod
+    @trace.traced("pay.refund")
     def refund(cls, pay_type, order_no, money):
         payobj = cls.get_pay_obj(pay_type)
         if not payobj:
@@ -31,6 +34,7 @@ class PayManager:
         return payobj.refund(order_no, money)
 
     @classmethod
+    @trace.traced("pay.query_trade")
     def query_trade(cls, pay_type, order_no):
         payobj = cls.get_pay_obj(pay_type)
         if not payobj:
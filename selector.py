@@ -337,7 +337,11 @@ class UserSelectorProxy(SelectorProxy):
     attribute_selectors = {
         "username": ("用户名", StringSelector),
         "mobile": ("手机号", StringSelector),
-        "created_at": ("注册时间", DateSelector)
+        "created_at": ("注册时间", DateSelector),
+        "buy_count": ("购买次数", NumberSelector),
+        "recent_buy_count": ("近28天购买次数", NumberSelector),
+        "redeem_total": ("兑换码数", NumberSelector),
+        "redeem_used": ("已用兑换码数", NumberSelector),
     }
 
 
@@ -1,17 +1,60 @@
 # -*- coding: utf-8 -*-
+import ujson as json
 import logging
 import nameko.rpc
 
+from functools import wraps
+
+from nameko.timer import timer
+from nameko.web.handlers import http
+from config import config
+from util import metrics
+from util.trace import Correlation
+
 logger = logging.getLogger()
 
+metrics.patch_http()
+
 
 class BaseService(object):
 
-    def do_page(self, qs, page, item_parser=None, page_size=10):
+    # 关联id，从调用头取或新生成，之后发出的调用都会带上
+    correlation = Correlation()
+
+    @http("GET", "/metrics")
+    def get_metrics(self, request):
+        "本进程RPC指标，Prometheus格式"
+        return metrics.render()
+
+    @timer(interval=config.metrics_log_interval)
+    def log_metrics(self):
+        "定时输出本进程RPC指标和慢查询汇总"
+        from models import slow_queries
+
+        stats = metrics.summary()
+        if stats:
+            logger.info("[metrics] %s", json.dumps(stats))
+
+        gauges = metrics.collect_gauges()
+        if any(gauges.values()):
+            logger.info("[metrics] gauges: %s", json.dumps(gauges))
+
+        slow = slow_queries.report(limit=10)
+        if slow:
+            logger.info("[slowquery] top: %s dropped: %s",
+                        json.dumps(slow), slow_queries.dropped)
+
+    def do_page(self, qs, page, item_parser=None, page_size=10, prefetch=None):
+        """
+        分页；prefetch(objs)在解析前对整页数据做批量加载
+        """
         page = max(1, page)
         total_count = qs.count()
         items = []
-        for obj in qs.paginate(page, page_size):
+        objs = list(qs.paginate(page, page_size))
+        if prefetch:
+            prefetch(objs)
+        for obj in objs:
             if item_parser:
                 items.append(item_parser(obj))
             else:
@@ -43,15 +86,17 @@ def transaction_rpc(func):
     """
     统一异常处理 & 统一异常日志 & 事务回滚
     """
-    from models import db
+    from models import db, connection_scope
 
     @nameko.rpc.rpc
     def wrap(*args, **kwargs):
-        with db.atomic() as txn:
+        with metrics.track(func.__name__) as tracker, connection_scope(), \
+                db.atomic() as txn:
             try:
                 res = func(*args, **kwargs)
             except Exception:
                 logger.exception("execute %s error!", func.__name__)
+                tracker.error = True
                 txn.rollback()
                 return {"resultCode": -1, "resultMsg": "执行失败"}
         return res
@@ -62,13 +107,43 @@ def rpc(func):
     """
     统一异常处理 & 统一异常日志
     """
+    from models import connection_scope
 
     @nameko.rpc.rpc
     def wrap(*args, **kwargs):
-        try:
-            res = func(*args, **kwargs)
-        except Exception:
-            logger.exception("execute %s error!", func.__name__)
-            return {"resultCode": -1, "resultMsg": "执行失败"}
+        with metrics.track(func.__name__) as tracker, connection_scope():
+            try:
+                res = func(*args, **kwargs)
+            except Exception:
+                logger.exception("execute %s error!", func.__name__)
+                tracker.error = True
+                return {"resultCode": -1, "resultMsg": "执行失败"}
         return res
     return wrap
+
+
+def readonly_rpc(func):
+    """
+    只读的统计、报表类RPC，查询走从库，其余同rpc
+    """
+    from models import router
+
+    @rpc
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        with router.readonly():
+            return func(*args, **kwargs)
+    return wrap
+
+
+def with_connection(func):
+    """
+    定时任务等非RPC入口使用，结束后归还数据库连接
+    """
+    from models import connection_scope
+
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        with connection_scope():
+            return func(*args, **kwargs)
+    return wrap
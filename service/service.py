@@ -14,9 +14,9 @@ from models import (Device, Supplyer, Admin, UserGroup, ApkVersion, Advertisemen
                     RedeemActivity, ItemCategory, VoiceActivity, Order,
                     AddressType, DeviceCategory, DeviceGroup, SupplyList,
                     DayItemStat, DayDeviceStat, DayUserGroupStat, DayStat, User,
-                    AddressAdmin, SponsorItem, SponsorAddress)
-from util import md5, xml_to_dict
-from base import BaseService, rpc, transaction_rpc
+                    AddressAdmin, SponsorItem, SponsorAddress, prefetch_images, router)
+from util import md5, xml_to_dict, trace
+from base import BaseService, rpc, transaction_rpc, readonly_rpc, with_connection
 from selector import (UserSelectorProxy, SelectorProxy, ItemSelectorProxy,
                       ItemBrandSelectorProxy, ItemCategorySelectorProxy,
                       OrderSelectorProxy, DeviceSelectorProxy, RoadSelectorProxy,
@@ -26,6 +26,8 @@ from const import (OrderStatus, PayStatus, PayType, SupplyStatus, RedeemStatus,
 from pay.manager import PayManager
 from biz import OrderBiz, DeviceBiz, MarktingBiz
 from sms.helper import SMSHelper
+from sms import outbox, receipt
+from dashboard import DashboardAggregator
 from entrypoint import distributed_timer, distributed_cron
 
 logger = logging.getLogger()
@@ -36,12 +38,15 @@ class InvboxService(BaseService):
     name = "invbox"
 
     @distributed_timer(interval=20)
+    @with_connection
     def cluster_heartbeat(self):
         "每20秒触发一次执行"
         logger.info("[cluster_heartbeat]")
 
-        for o in Order.select().where(Order.status.not_in(
-                [OrderStatus.DONE, OrderStatus.REFUNDED, OrderStatus.CLOSED])):
+        # 用IN列出未结束的状态，NOT IN走不了status索引
+        for o in Order.select().where(Order.status.in_(
+                [OrderStatus.CREATED, OrderStatus.DELIVERING,
+                 OrderStatus.DELIVER_FAILED, OrderStatus.DELIVER_TIMEOUT])):
             biz = OrderBiz(order=o)
             biz.refresh_pay_status()
 
@@ -53,19 +58,29 @@ class InvboxService(BaseService):
             biz = OrderBiz(order=o)
             biz.check_deliver_timeout()
 
-    @distributed_cron("****-**-** 00:01:00")
+    @distributed_timer(interval=2)
+    @with_connection
+    def send_sms_outbox(self):
+        "每2秒批量发送一次发件箱里的短信"
+        outbox.send_pending()
+
+    @distributed_timer(interval=60)
+    @with_connection
+    def reconcile_sms_receipts(self):
+        "每分钟按号码批量查询一次短信回执"
+        receipt.reconcile()
+
+    @distributed_cron("****-**-** 00:01:00", catch_up=True)
+    @with_connection
     def stat_lastday_data(self):
         logger.info("[stat_lastday_data]")
         last_day = dte.now() - timedelta(days=1)
-        try:
-            stat.stat_device_by_day(last_day)
-        except:
-            logger.exception("")
+        stat.stat_day(last_day)
 
         try:
-            stat.stat_item_by_day(last_day)
-        except:
-            logger.exception("")
+            stat.refresh_recent_buy_counts()
+        except Exception:
+            logger.exception("[stat_lastday_data] refresh recent buy counts failed")
 
     @rpc
     def check_login(self, username, password):
@@ -200,7 +215,7 @@ class InvboxService(BaseService):
         helper = SMSHelper()
         smsobj = helper.send_login_message(mobile)
 
-        if smsobj.status == C.SMSStatus.OK:
+        if smsobj.status != C.SMSStatus.FAIL:
             info = json.loads(smsobj.tplparam)
             code = info["code"]
             rds.set(key, code, ex=expire_seconds)
@@ -310,12 +325,10 @@ class InvboxService(BaseService):
                                 if obj.first_buy_at else "",
                 "lastBuyAt": obj.last_buy_at.strftime("%Y-%m-%d %H:%M:%S")
                                 if obj.last_buy_at else "",
-                "buyCount": Order.select().where(Order.user == obj, Order.status == OrderStatus.DONE).count(),
-                "buyCountOf28Days": Order.select().where(Order.user == obj,
-                                                         Order.created_at >= dte.now() - timedelta(days=28),
-                                                         Order.status == OrderStatus.DONE).count(),
-                "redeemTotal": obj.redeem_set.count(),
-                "redeemUsed": obj.redeem_set.where(Redeem.status == RedeemStatus.USED).count(),
+                "buyCount": obj.buy_count,
+                "buyCountOf28Days": obj.recent_buy_count,
+                "redeemTotal": obj.redeem_total,
+                "redeemUsed": obj.redeem_used,
                 "createdAt": obj.created_at.strftime("%Y-%m-%d %H:%M:%S"),
             }
 
@@ -750,6 +763,7 @@ class InvboxService(BaseService):
             page,
             item_parser=lambda obj: ItemCategory.to_dict(obj, base_url=base_url),
             page_size=page_size,
+            prefetch=lambda objs: prefetch_images(objs, "thumbnail", "image"),
         )
 
     @rpc
@@ -902,11 +916,18 @@ class InvboxService(BaseService):
 
     @rpc
     def get_items(self, page=1, page_size=10, base_url="", query=[]):
+        qs = ItemSelectorProxy(query).select() \
+                                     .select(Item, ItemCategory, ItemBrand) \
+                                     .switch(Item) \
+                                     .join(ItemCategory) \
+                                     .switch(Item) \
+                                     .join(ItemBrand)
         return self.do_page(
-            ItemSelectorProxy(query).select(),
+            qs,
             page,
             page_size=page_size,
             item_parser=lambda obj: Item.to_dict(obj, base_url=base_url),
+            prefetch=Item.prefetch_relations,
         )
 
     @rpc
@@ -952,6 +973,7 @@ class InvboxService(BaseService):
         at.save()
         at.thumbnails.clear()
         at.thumbnails.add(list(set(thumbnails)))
+        Item.refresh_item_counts(categories=[at.category_id], brands=[at.brand_id])
         data = {
             "resultCode": 0,
             "resultMsg": "成功",
@@ -961,10 +983,13 @@ class InvboxService(BaseService):
 
     @transaction_rpc
     def modify_items(self, info_list):
+        categories, brands = set(), set()
         for d in info_list:
             obj = Item.get_or_none(Item.id == d["id"])
             if not obj:
                 continue
+            categories.update([obj.category_id, d["category"]])
+            brands.update([obj.brand_id, d["brand"]])
 
             tmp = Item.get_or_none(name=d["name"])
             if tmp and tmp.id != obj.id:
@@ -984,6 +1009,7 @@ class InvboxService(BaseService):
 
             obj.thumbnails.clear()
             obj.thumbnails.add(list(set(d["thumbnails"])))
+        Item.refresh_item_counts(categories=categories, brands=brands)
         return {
             "resultCode": 0,
             "resultMsg": "修改成功"
@@ -991,14 +1017,25 @@ class InvboxService(BaseService):
 
     @transaction_rpc
     def delete_items(self, ids):
+        groups = list(Item.select(Item.category, Item.brand).where(Item.id.in_(ids)).tuples())
         q = Item.delete().where(Item.id.in_(ids))
         q.execute()
+        Item.refresh_item_counts(categories=[c for c, _ in groups],
+                                 brands=[b for _, b in groups])
 
         return {
             "resultCode": 0,
             "resultMsg": "删除成功"
         }
 
+    @rpc
+    def get_order_trace(self, order_no):
+        "订单从创建到出货各阶段的耗时分段，按开始时间排序"
+        return {
+            "orderNo": order_no,
+            "spans": trace.get_spans(order_no=order_no),
+        }
+
     @rpc
     def get_order_detail(self, order_no):
         biz = OrderBiz(order_no=order_no)
@@ -1212,10 +1249,12 @@ class InvboxService(BaseService):
                 item_parser=_parser
             )
         else:
-            return self.do_export(
-                qs=OrderSelectorProxy(query).select(),
-                item_parser=_parser
-            )
+            # 导出数据量大，走从库
+            with router.readonly():
+                return self.do_export(
+                    qs=OrderSelectorProxy(query).select(),
+                    item_parser=_parser
+                )
 
     @rpc
     def order_overview(self, start_date, end_date, page=1):
@@ -1869,10 +1908,11 @@ class InvboxService(BaseService):
     @rpc
     def get_redeem_activities(self, page=1, page_size=10):
         return self.do_page(
-            RedeemActivity.select(),
+            RedeemActivity.select_for_list(),
             page,
             item_parser=lambda obj: RedeemActivity.to_dict(obj),
             page_size=page_size,
+            prefetch=RedeemActivity.prefetch_counts,
         )
 
     @transaction_rpc
@@ -1948,10 +1988,11 @@ class InvboxService(BaseService):
     @rpc
     def get_voice_activities(self, page=1, page_size=10):
         return self.do_page(
-            VoiceActivity.select(),
+            VoiceActivity.select_for_list(),
             page,
             item_parser=lambda obj: VoiceActivity.to_dict(obj),
             page_size=page_size,
+            prefetch=VoiceActivity.prefetch_counts,
         )
 
     @transaction_rpc
@@ -2208,7 +2249,7 @@ class InvboxService(BaseService):
             "resultMsg": "成功",
         }
 
-    @rpc
+    @readonly_rpc
     def stat_overview_of_item(self, start_date, end_date, item=None):
         "关键指标"
         qs = DayItemStat.select().where(DayItemStat.day >= start_date,
@@ -2257,7 +2298,7 @@ class InvboxService(BaseService):
             "conversion": "%.2f%%" % (conversion * 100)
         }
 
-    @rpc
+    @readonly_rpc
     def stat_overview_of_order(self, start_date, end_date, item=None):
         "关键指标"
         qs = DayItemStat.select().where(DayItemStat.day >= start_date,
@@ -2302,7 +2343,7 @@ class InvboxService(BaseService):
                             if int(total.total_orders_pay) else 0,
         }
 
-    @rpc
+    @readonly_rpc
     def stat_overview_of_device(self, start_date, end_date, device=None):
         "关键指标"
         qs = DayDeviceStat.select().where(DayDeviceStat.day >= start_date,
@@ -2352,7 +2393,7 @@ class InvboxService(BaseService):
             "conversion": "%.2f%%" % (conversion * 100)
         }
 
-    @rpc
+    @readonly_rpc
     def stat_overview_of_user(self, start_date, end_date, user_group=None):
         "关键指标"
 
@@ -2403,7 +2444,7 @@ class InvboxService(BaseService):
             "retention": "%.2f%%" % (retention * 100),
         }
 
-    @rpc
+    @readonly_rpc
     def stat_day_of_item(self, start_date, end_date):
         total_qs = DayItemStat.select(DayItemStat.item,
                                       fn.SUM(DayItemStat.clicks).alias("total_clicks"),
@@ -2436,7 +2477,7 @@ class InvboxService(BaseService):
             "items": items
         }
 
-    @rpc
+    @readonly_rpc
     def stat_day_of_user(self, start_date, end_date):
         qs = DayUserGroupStat.select(DayUserGroupStat.user_group,
                                      fn.SUM(DayUserGroupStat.users).alias("total_users"),
@@ -2471,7 +2512,7 @@ class InvboxService(BaseService):
             "items": items
         }
 
-    @rpc
+    @readonly_rpc
     def stat_trend_of_user(self, start_date, end_date, user_group=None):
         """
         商品趋势：
@@ -2517,7 +2558,7 @@ class InvboxService(BaseService):
             "days": items,
         }
 
-    @rpc
+    @readonly_rpc
     def stat_trend_of_device(self, start_date, end_date, device=None):
         """
         商品趋势：
@@ -2550,7 +2591,7 @@ class InvboxService(BaseService):
             "days": items,
         }
 
-    @rpc
+    @readonly_rpc
     def stat_trend_of_item(self, start_date, end_date, item=None):
         """
         商品趋势：
@@ -2584,7 +2625,7 @@ class InvboxService(BaseService):
             "days": items,
         }
 
-    @rpc
+    @readonly_rpc
     def stat_trend_of_order(self, start_date, end_date):
         """
         商品趋势：
@@ -2622,7 +2663,7 @@ class InvboxService(BaseService):
             "days": items,
         }
 
-    @rpc
+    @readonly_rpc
     def stat_conversion_of_order(self, start_date, end_date):
         """
         分布转化率
@@ -2994,7 +3035,7 @@ class InvboxService(BaseService):
                 # res.update(obj_admin.to_dict())
                 return res
 
-    @rpc
+    @readonly_rpc
     def get_flow_stats(self, page=1, base_url="", page_size=10, query=[], export=False, admin_info=None):
         role = admin_info.get("role")
         admin_id = admin_info.get("id")
@@ -3067,652 +3108,181 @@ class InvboxService(BaseService):
                 item_parser=_parser
             )
 
-    @rpc
+    @readonly_rpc
     def dashboard_flow_volume(self):
-        # 現在
-        now = dte.now()
-        # 當日
-        from_day = dte(now.year, now.month, now.day, 0, 0, 0)
-        # 當周
-        week_first_day = now - timedelta(now.weekday())
-        from_week = dte(week_first_day.year, week_first_day.month, week_first_day.day, 0, 0, 0)
-        # 當年
-        from_year = dte(now.year, 1, 1, 0, 0, 0)
-
-        date_params = {
-            "today": from_day,
-            "week": from_week,
-            "year": from_year
-        }
-
-        flow_volume_date = {
-            "today": {
-                "flows": 0,
-                "stays": 0,
-                "clicks": 0,
-                "usersPay": 0,
-                "staysConversion": 0,
-                "clicksConversion": 0,
-                "payConversion": 0,
-                "startTime": "",
-                "endTime": ""
-            },
-            "week": {
-                "flows": 0,
-                "stays": 0,
-                "clicks": 0,
-                "usersPay": 0,
-                "staysConversion": 0,
-                "clicksConversion": 0,
-                "payConversion": 0,
-                "startTime": "",
-                "endTime": ""
-            },
-            "year": {
-                "flows": 0,
-                "stays": 0,
-                "clicks": 0,
-                "usersPay": 0,
-                "staysConversion": 0,
-                "clicksConversion": 0,
-                "payConversion": 0,
-                "startTime": "",
-                "endTime": ""
-            },
-            "avg_device": {
-                "flows": 0,
-                "stays": 0,
-                "clicks": 0,
-                "usersPay": 0,
-                "startTime": "",
-                "endTime": ""
-            }
-        }
-        # online_device = Device.select().where(Device.online is True).count()
-        query = [[
-            {
-                "operator": "是",
-                "attribute": "online",
-                "value": True
-            }
-        ]]
-
-        for zoom, date in date_params.items():
-            user_buy_qs = Order.select(fn.COUNT(fn.DISTINCT(Order.user)).alias("total_users_pay"))\
-                .where(Order.pay_status != PayStatus.UNPAY,
-                       Order.pay_status != PayStatus.CLOSED,
-                       Order.created_at >= date,
-                       Order.created_at <= now)
-            user_buy_total = user_buy_qs.first()
-            flow_volume_date[zoom]["usersPay"] = int(user_buy_total.total_users_pay)
-
-            qs = DayDeviceStat.select().where(DayDeviceStat.created_at >= date,
-                                              DayDeviceStat.created_at <= now)
-            total_qs = qs.select(
-                fn.sum(DayDeviceStat.flows).alias("total_flows"),
-                fn.sum(DayDeviceStat.stays).alias("total_stays"),
-                fn.sum(DayDeviceStat.clicks).alias("total_clicks"),
-                # fn.sum(DayDeviceStat.users_pay).alias("total_users_pay"),
-            )
-            flow_volume_date[zoom]["startTime"] = date.strftime("%Y-%m-%d %H:%M:%S")
-            flow_volume_date[zoom]["endTime"] = now.strftime("%Y-%m-%d %H:%M:%S")
-            if not total_qs.count():
-                continue
-            total = total_qs.first()
-
-            stays_conversion = (float(total.total_stays) / int(total.total_flows)) if int(total.total_flows) else 0
-            clicks_conversion = (float(total.total_clicks) / int(total.total_stays)) if int(total.total_stays) else 0
-            pay_conversion = (float(user_buy_total.total_users_pay) / int(total.total_clicks)) \
-                if int(total.total_clicks) else 0
-
-            flow_volume_date[zoom]["flows"] = int(total.total_flows)
-            flow_volume_date[zoom]["stays"] = int(total.total_stays)
-            flow_volume_date[zoom]["clicks"] = int(total.total_clicks)
-
-            # flow_volume_date[zoom]["usersPay"] = int(total.total_users_pay)
-
-            flow_volume_date[zoom]["staysConversion"] = "%.2f%%" % (stays_conversion * 100)
-            flow_volume_date[zoom]["clicksConversion"] = "%.2f%%" % (clicks_conversion * 100)
-            flow_volume_date[zoom]["payConversion"] = "%.2f%%" % (pay_conversion * 100)
-
-            online_device = Device.select().where(Device.heartbeat_at >= date).count()
-            if zoom == "week" and online_device:
-                # print("online_device:", online_device)
-                flow_volume_date["avg_device"]["flows"] = int(total.total_flows / online_device)
-                flow_volume_date["avg_device"]["stays"] = int(total.total_stays / online_device)
-                flow_volume_date["avg_device"]["clicks"] = int(total.total_clicks / online_device)
-                flow_volume_date["avg_device"]["usersPay"] = int(user_buy_total.total_users_pay / online_device)
-                flow_volume_date["avg_device"]["startTime"] = date.strftime("%Y-%m-%d %H:%M:%S")
-                flow_volume_date["avg_device"]["endTime"] = now.strftime("%Y-%m-%d %H:%M:%S")
+        agg = DashboardAggregator()
+        order_totals = agg.order_totals()
+        stat_totals = agg.device_stat_totals()
+        device_totals = agg.device_totals()
+        end_time = agg.now.strftime("%Y-%m-%d %H:%M:%S")
+
+        flow_volume_date = {}
+        for zoom, date in agg.windows.items():
+            total = stat_totals[zoom]
+            users_pay = order_totals[zoom]["users_pay"]
+
+            stays_conversion = (float(total["stays"]) / total["flows"]) if total["flows"] else 0
+            clicks_conversion = (float(total["clicks"]) / total["stays"]) if total["stays"] else 0
+            pay_conversion = (float(users_pay) / total["clicks"]) if total["clicks"] else 0
+
+            flow_volume_date[zoom] = {
+                "flows": total["flows"],
+                "stays": total["stays"],
+                "clicks": total["clicks"],
+                "usersPay": users_pay,
+                "staysConversion": "%.2f%%" % (stays_conversion * 100),
+                "clicksConversion": "%.2f%%" % (clicks_conversion * 100),
+                "payConversion": "%.2f%%" % (pay_conversion * 100),
+                "startTime": date.strftime("%Y-%m-%d %H:%M:%S"),
+                "endTime": end_time,
+            }
+
+        avg_device = {
+            "flows": 0,
+            "stays": 0,
+            "clicks": 0,
+            "usersPay": 0,
+            "startTime": "",
+            "endTime": ""
+        }
+        online_device = device_totals["week"]["online"]
+        if online_device:
+            week = flow_volume_date["week"]
+            avg_device.update({
+                "flows": int(week["flows"] / online_device),
+                "stays": int(week["stays"] / online_device),
+                "clicks": int(week["clicks"] / online_device),
+                "usersPay": int(week["usersPay"] / online_device),
+                "startTime": week["startTime"],
+                "endTime": end_time,
+            })
+        flow_volume_date["avg_device"] = avg_device
 
         return flow_volume_date
 
-    @rpc
+    @readonly_rpc
     def dashboard_flow_volume_rank(self):
-        # 現在
-        now = dte.now()
-        # 當日
-        from_day = dte(now.year, now.month, now.day, 0, 0, 0)
-        # 當周
-        week_first_day = now - timedelta(now.weekday())
-        from_week = dte(week_first_day.year, week_first_day.month, week_first_day.day, 0, 0, 0)
-        # 當年
-        from_year = dte(now.year, 1, 1, 0, 0, 0)
-
-        date_params = {
-            "today": from_day,
-            "week": from_week,
-            "year": from_year
-        }
-        top_5_rank = {
-            "today": {
-                "flows": {
-                    "device": [],
-                    "count": []
-                },
-                "stays": {
-                    "device": [],
-                    "count": []
-                },
-                "clicks": {
-                    "device": [],
-                    "count": []
+        agg = DashboardAggregator()
+        ranks = agg.device_stat_ranks()
+
+        top_5_rank = {}
+        for zoom in agg.windows:
+            top_5_rank[zoom] = {}
+            for metric in ("flows", "stays", "clicks"):
+                rank = ranks[zoom][metric]
+                top_5_rank[zoom][metric] = {
+                    "device": [address for address, _ in rank],
+                    "count": [count for _, count in rank],
                 }
-            },
-            "week": {
-                "flows": {
-                    "device": [],
-                    "count": []
-                },
-                "stays": {
-                    "device": [],
-                    "count": []
-                },
-                "clicks": {
-                    "device": [],
-                    "count": []
-                },
-            },
-            "year": {
-                "flows": {
-                    "device": [],
-                    "count": []
-                },
-                "stays": {
-                    "device": [],
-                    "count": []
-                },
-                "clicks": {
-                    "device": [],
-                    "count": []
-                },
-            },
-        }
-        for zoom, date in date_params.items():
-            # 經過
-            flows_qs = DayDeviceStat.select(Device, fn.SUM(DayDeviceStat.flows).alias("sum_flows"))\
-                .join(Device, JOIN.LEFT_OUTER)\
-                .where(DayDeviceStat.created_at >= date,
-                       DayDeviceStat.created_at <= now)\
-                .group_by(DayDeviceStat.device) \
-                .order_by(fn.SUM(DayDeviceStat.flows).desc())
-            if flows_qs.count() >= 5:
-                flows_rank = 5
-            else:
-                flows_rank = flows_qs.count()
-
-            flows_list = []
-            flows_device_list = []
-            for obj in flows_qs:
-                # print(obj.device.name, obj.flows)
-                flows_device_list.append(obj.device.address)
-                flows_list.append(int(obj.sum_flows))
-            top_5_rank[zoom]["flows"]["device"] = flows_device_list[:flows_rank]
-            top_5_rank[zoom]["flows"]["count"] = flows_list[:flows_rank]
-
-            # 停留
-            stays_qs = DayDeviceStat.select(Device, fn.SUM(DayDeviceStat.stays).alias("sum_stays")) \
-                .join(Device, JOIN.LEFT_OUTER) \
-                .where(DayDeviceStat.created_at >= date,
-                       DayDeviceStat.created_at <= now) \
-                .group_by(DayDeviceStat.device) \
-                .order_by(fn.SUM(DayDeviceStat.stays).desc())
-            if stays_qs.count() >= 5:
-                stays_rank = 5
-            else:
-                stays_rank = stays_qs.count()
-
-            rank_stays_list = []
-            rank_devive_name_list = []
-
-            for obj in stays_qs:
-                # print(obj.device.name, obj.stays)
-                rank_devive_name_list.append(obj.device.address)
-                rank_stays_list.append(int(obj.sum_stays))
-
-            # 點擊
-            top_5_rank[zoom]["stays"]["device"] = rank_devive_name_list[:stays_rank]
-            top_5_rank[zoom]["stays"]["count"] = rank_stays_list[:stays_rank]
-
-            clicks_qs = DayDeviceStat.select(Device, fn.SUM(DayDeviceStat.clicks).alias("sum_clicks")) \
-                .join(Device, JOIN.LEFT_OUTER) \
-                .where(DayDeviceStat.created_at >= date,
-                       DayDeviceStat.created_at <= now) \
-                .group_by(DayDeviceStat.device) \
-                .order_by(fn.SUM(DayDeviceStat.clicks).desc())
-            if clicks_qs.count() >= 5:
-                rank = 5
-            else:
-                rank = clicks_qs.count()
-            rank_clicks_list = []
-            rank_device_clicks_list = []
-            for obj in clicks_qs:
-                # print(obj.device.name, obj.clicks)
-                rank_device_clicks_list.append(obj.device.address)
-                rank_clicks_list.append(int(obj.sum_clicks))
-            top_5_rank[zoom]["clicks"]["device"] = rank_device_clicks_list[:rank]
-            top_5_rank[zoom]["clicks"]["count"] = rank_clicks_list[:rank]
-
         return top_5_rank
 
-    @rpc
+    @readonly_rpc
     def dashboard_user_stats(self):
-        # 現在
-        now = dte.now()
-        # 當日
-        from_day = dte(now.year, now.month, now.day, 0, 0, 0)
-        # 當周
-        week_first_day = now - timedelta(now.weekday())
-        from_week = dte(week_first_day.year, week_first_day.month, week_first_day.day, 0, 0, 0)
-        # 當年
-        from_year = dte(now.year, 1, 1, 0, 0, 0)
-
-        date_params = {
-            "today": from_day,
-            "week": from_week,
-            "year": from_year
-        }
+        agg = DashboardAggregator()
+        user_totals = agg.user_totals()
+        order_totals = agg.order_totals()
 
-        user_stats = {
-            "today": {
-                "newUsers": 0,
-                "newFans": 0,
-                "fansBuyRate": 0
-            },
-            "week": {
-                "newUsers": 0,
-                "newFans": 0,
-                "fansBuyRate": 0
-            },
-            "year": {
-                "newUsers": 0,
-                "newFans": 0,
-                "fansBuyRate": 0
-            },
-        }
-        for zoom, date in date_params.items():
-            new_user_qs = User.select().where(User.created_at >= date,
-                                              User.created_at <= now,
-                                              User.mobile == "",
-                                              User.first_buy_at.is_null(False))
-            new_fans_qs = User.select().where(User.created_at >= date,
-                                              User.created_at <= now,
-                                              User.mobile != "")
-
-            fans_buy_qs = Order.select()\
-                .join(User, JOIN.LEFT_OUTER)\
-                .where(
-                Order.created_at >= date,
-                Order.created_at <= now,
-                Order.status == OrderStatus.DONE,
-                User.mobile != "",
-            )
-            print(fans_buy_qs.count())
-            total_buy_qs = Order.select() \
-                .join(User, JOIN.LEFT_OUTER) \
-                .where(Order.created_at >= date,
-                       Order.created_at <= now,
-                       Order.status == OrderStatus.DONE
-                       )
-            print(total_buy_qs.count())
-            fans_buy_rate = (float(fans_buy_qs.count()) / int(total_buy_qs.count())) if int(total_buy_qs.count()) else 0
-
-            user_stats[zoom]["newUsers"] = new_user_qs.count() or 0
-            user_stats[zoom]["newFans"] = new_fans_qs.count() or 0
-            user_stats[zoom]["fansBuyRate"] = "%.2f%%" % (fans_buy_rate * 100)
+        user_stats = {}
+        for zoom in agg.windows:
+            total_buys = order_totals[zoom]["total_buys"]
+            fans_buys = order_totals[zoom]["fans_buys"]
+            fans_buy_rate = (float(fans_buys) / total_buys) if total_buys else 0
 
+            user_stats[zoom] = {
+                "newUsers": user_totals[zoom]["new_users"],
+                "newFans": user_totals[zoom]["new_fans"],
+                "fansBuyRate": "%.2f%%" % (fans_buy_rate * 100),
+            }
         return user_stats
 
-    @rpc
+    @readonly_rpc
     def dashboard_device_stats(self):
-        # 現在
-        now = dte.now()
-        # 當日
-        from_day = dte(now.year, now.month, now.day, 0, 0, 0)
-        device_stats = {
-            "involved_device": {
-                "count": 0
-            },
-            "online_device": {
-                "count": 0,
-                'rate': 0
-            },
-            "active_device": {
-                "count": 0,
-                'rate': 0
-            },
-            "nonactive_device": {
-                "count": 0,
-                'rate': 0
-            }
-        }
+        agg = DashboardAggregator()
+        device_totals = agg.device_totals()
+        sales_totals = agg.sales_totals()
 
-        # query = [[
-        #     {
-        #         "operator": "是",
-        #         "attribute": "online",
-        #         "value": True
-        #     }
-        # ]]
-        #
-        # online_device = int(DeviceSelectorProxy(query).select().count())
-        online_device = Device.select()\
-            .where(Device.involved == 1,
-                   Device.heartbeat_at >= dte(now.year, now.month, now.day, 0, 0, 0))\
-            .count()
-
-        # device_online_qs = Device.select().where(Device.online is True)
-        device_involved_qs = Device.select().where(Device.involved == 1)
-        device_active_qs = Order.select(fn.Count(fn.Distinct(Order.device)).alias("active_device"))\
-            .where(Order.created_at >= from_day,
-                   Order.created_at <= now,
-                   Order.status == OrderStatus.DONE
-                   )
-
-        involved_device_count = int(device_involved_qs.count()) if device_involved_qs.count() else 0
-        online_device_count = online_device
-        active_device_count = int(device_active_qs.first().active_device) if device_active_qs.first().active_device else 0
+        involved_device_count = device_totals["involved"]
+        online_device_count = device_totals["today"]["online_involved"]
+        active_device_count = sales_totals["today"]["active_devices"]
 
         online_device_rate = (float(online_device_count) / involved_device_count) \
             if involved_device_count else 0
         active_device_rate = (float(active_device_count) / online_device_count) \
             if online_device_count else 0
-        nonactive_device_rate = float(online_device_count-active_device_count) / online_device_count \
+        nonactive_device_rate = float(online_device_count - active_device_count) / online_device_count \
             if online_device_count else 0
 
-        device_stats["involved_device"]["count"] = involved_device_count
-        device_stats["online_device"]["count"] = online_device_count
-        device_stats["online_device"]["rate"] = "%.2f%%" % (online_device_rate * 100)
-        device_stats["active_device"]["count"] = active_device_count
-        device_stats["active_device"]["rate"] = "%.2f%%" % (active_device_rate * 100)
-        device_stats["nonactive_device"]["count"] = online_device_count - active_device_count
-        device_stats["nonactive_device"]["rate"] = "%.2f%%" % (nonactive_device_rate * 100)
-
-        return device_stats
-
-    @rpc
-    def dashboard_sales_stats(self):
-        # 現在
-        now = dte.now()
-        # 當日
-        from_day = dte(now.year, now.month, now.day, 0, 0, 0)
-        # 當周
-        week_first_day = now - timedelta(now.weekday())
-        from_week = dte(week_first_day.year, week_first_day.month, week_first_day.day, 0, 0, 0)
-        # 當年
-        from_year = dte(now.year, 1, 1, 0, 0, 0)
-
-        date_params = {
-            "today": from_day,
-            "week": from_week,
-            "year": from_year
-        }
-        sales_stats = {
-            "today": {
-                "sales_amount": 0,
-                "item_amount": 0,
-                "avg_amount": 0
+        return {
+            "involved_device": {
+                "count": involved_device_count
             },
-            "week": {
-                "sales_amount": 0,
-                "item_amount": 0,
-                "avg_amount": 0,
-                "sale_per_device": 0,
-                "item_per_device": 0
+            "online_device": {
+                "count": online_device_count,
+                "rate": "%.2f%%" % (online_device_rate * 100)
             },
-            "year": {
-                "sales_amount": 0,
-                "item_amount": 0,
-                "avg_amount": 0
+            "active_device": {
+                "count": active_device_count,
+                "rate": "%.2f%%" % (active_device_rate * 100)
             },
-        }
-        query = [[
-            {
-                "operator": "是",
-                "attribute": "online",
-                "value": True
+            "nonactive_device": {
+                "count": online_device_count - active_device_count,
+                "rate": "%.2f%%" % (nonactive_device_rate * 100)
             }
-        ]]
-
-        # online_device = int(DeviceSelectorProxy(query).select().count())
-
-        for zoom, date in date_params.items():
-            online_device = Device.select() \
-                .where(Device.involved == 1,
-                       Device.heartbeat_at >= date)\
-                .count()
-            sale_qs = Order.select(fn.SUM(Order.pay_money).alias("sales_amount"),
-                                   fn.SUM(Order.item_amount).alias("item_amount")) \
-                .where(Order.status == OrderStatus.DONE,
-                       Order.created_at >= date,
-                       Order.created_at <= now)
-            if sale_qs.count() < 1:
-                return sales_stats
-            else:
-                sales_amount = int(sale_qs.first().sales_amount)
-                item_amount = int(sale_qs.first().item_amount)
-                avg_amount = int(sales_amount / item_amount) if item_amount else 0
-                sales_stats[zoom]["sales_amount"] = sales_amount
-                sales_stats[zoom]["item_amount"] = item_amount
-                sales_stats[zoom]["avg_amount"] = avg_amount
-            if zoom == "week":
-                sale_per_device = (float(sales_amount) / online_device) if online_device else 0
-                item_per_device = (float(item_amount) / online_device) if online_device else 0
-                sales_stats[zoom]["sale_per_device"] = "%.2f" % sale_per_device
-                sales_stats[zoom]["item_per_device"] = "%.2f" % item_per_device
+        }
+
+    @readonly_rpc
+    def dashboard_sales_stats(self):
+        agg = DashboardAggregator()
+        sales_totals = agg.sales_totals()
+        device_totals = agg.device_totals()
+
+        sales_stats = {}
+        for zoom in agg.windows:
+            sales_amount = sales_totals[zoom]["sales_amount"]
+            item_amount = sales_totals[zoom]["item_amount"]
+            sales_stats[zoom] = {
+                "sales_amount": sales_amount,
+                "item_amount": item_amount,
+                "avg_amount": int(sales_amount / item_amount) if item_amount else 0
+            }
+
+        online_device = device_totals["week"]["online_involved"]
+        week = sales_stats["week"]
+        sale_per_device = (float(week["sales_amount"]) / online_device) if online_device else 0
+        item_per_device = (float(week["item_amount"]) / online_device) if online_device else 0
+        week["sale_per_device"] = "%.2f" % sale_per_device
+        week["item_per_device"] = "%.2f" % item_per_device
 
         return sales_stats
 
-    @rpc
+    @readonly_rpc
     def dashboard_item_device_rank(self):
-        # 現在
-        now = dte.now()
-        # 當日
-        from_day = dte(now.year, now.month, now.day, 0, 0, 0)
-        # 當周
-        week_first_day = now - timedelta(now.weekday())
-        from_week = dte(week_first_day.year, week_first_day.month, week_first_day.day, 0, 0, 0)
-        # 當年
-        from_year = dte(now.year, 1, 1, 0, 0, 0)
-
-        date_params = {
-            "today": from_day,
-            "week": from_week,
-            "year": from_year
-        }
-        item_device_rank = {
-            "today": {
-                "itemSales": [],
-                "topSalesItems": [],
-                "itemAmount": [],
-                "topAmountItems": [],
-                "deviceSales": [],
-                "topSalesDevice": [],
-                "deviceAmount": [],
-                "topAmountDevices": [],
-                "userBuys": [],
-                "topUsers": []
-            },
-            "week": {
-                "itemSales": [],
-                "topSalesItems": [],
-                "itemAmount": [],
-                "topAmountItems": [],
-                "deviceSales": [],
-                "topSalesDevice": [],
-                "deviceAmount": [],
-                "topAmountDevices": [],
-                "userBuys": [],
-                "topUsers": []
-            },
-            "year": {
-                "itemSales": [],
-                "topSalesItems": [],
-                "itemAmount": [],
-                "topAmountItems": [],
-                "deviceSales": [],
-                "topSalesDevice": [],
-                "deviceAmount": [],
-                "topAmountDevices": [],
-                "userBuys": [],
-                "topUsers": []
-            }
-        }
-        for zoom, date in date_params.items():
-            # 產品銷售金額排行
-            sale_qs = Order.select(Item, fn.SUM(Order.pay_money).alias("item_sale"))\
-                .join(Item)\
-                .where(Order.created_at >= date,
-                       Order.created_at <= now,
-                       Order.redeem.is_null(True),
-                       Order.status == OrderStatus.DONE
-                       )\
-                .group_by(Order.item)\
-                .order_by(fn.SUM(Order.pay_money).desc())
-
-            if sale_qs.count() >= 5:
-                sale_rank = 5
-            else:
-                sale_rank = sale_qs.count()
-
-            # print(sale_qs.count())
-
-            sale_list = []
-            top_sale_item_list = []
-            for obj in sale_qs:
-                sale_list.append(float(obj.item_sale))
-                top_sale_item_list.append(str(obj.item.name))
-
-            item_device_rank[zoom]["itemSales"] = sale_list[:sale_rank]
-            item_device_rank[zoom]["topSalesItems"] = top_sale_item_list[:sale_rank]
-
-            # 產品銷售量排行
-            amount_qs = Order.select(Item, fn.SUM(Order.item_amount).alias("item_amount"))\
-                .join(Item)\
-                .where(Order.created_at >= date,
-                       Order.created_at <= now,
-                       Order.redeem.is_null(True),
-                       Order.status == OrderStatus.DONE
-                       )\
-                .group_by(Order.item)\
-                .order_by(fn.SUM(Order.item_amount).desc())
-            if amount_qs.count() >= 5:
-                amount_rank = 5
-            else:
-                amount_rank = sale_qs.count()
-
-            # print(amount_qs.count())
-            amount_list = []
-            top_amount_item_list = []
-            for obj in amount_qs:
-                amount_list.append(float(obj.item_amount))
-                top_amount_item_list.append(str(obj.item.name))
-
-            item_device_rank[zoom]["itemAmount"] = amount_list[:amount_rank]
-            item_device_rank[zoom]["topAmountItems"] = top_amount_item_list[:amount_rank]
-
-            # 單機銷售金額排行
-            sale_qs = Order.select(Device, fn.SUM(Order.pay_money).alias("device_sale")) \
-                .join(Device) \
-                .where(Order.created_at >= date,
-                       Order.created_at <= now,
-                       Order.redeem.is_null(True),
-                       Order.status == OrderStatus.DONE
-                       ) \
-                .group_by(Order.device) \
-                .order_by(fn.SUM(Order.pay_money).desc())
-
-            if sale_qs.count() >= 5:
-                sale_rank = 5
-            else:
-                sale_rank = sale_qs.count()
-
-            # print(sale_qs.count())
-            sale_list = []
-            top_sale_device_list = []
-            for obj in sale_qs:
-                sale_list.append(float(obj.device_sale))
-                top_sale_device_list.append(str(obj.device.address))
-
-            item_device_rank[zoom]["deviceSales"] = sale_list[:sale_rank]
-            item_device_rank[zoom]["topSalesDevice"] = top_sale_device_list[:sale_rank]
-
-            # 單機銷售量排行
-            amount_qs = Order.select(Device, fn.SUM(Order.item_amount).alias("device_amount")) \
-                .join(Device) \
-                .where(Order.created_at >= date,
-                       Order.created_at <= now,
-                       Order.redeem.is_null(True),
-                       Order.status == OrderStatus.DONE
-                       ) \
-                .group_by(Order.device) \
-                .order_by(fn.SUM(Order.item_amount).desc())
-
-            if amount_qs.count() >= 5:
-                amount_rank = 5
-            else:
-                amount_rank = sale_qs.count()
-
-            # print(amount_qs.count())
-            amount_list = []
-            top_amount_device_list = []
-            for obj in amount_qs:
-                amount_list.append(float(obj.device_amount))
-                top_amount_device_list.append(str(obj.device.address))
-
-            item_device_rank[zoom]["deviceAmount"] = amount_list[:amount_rank]
-            item_device_rank[zoom]["topAmountDevices"] = top_amount_device_list[:amount_rank]
-
-            # 用戶
-            user_qs = Order.select(User, fn.COUNT(Order.id).alias("users_buys")) \
-                .join(User) \
-                .where(Order.created_at >= date,
-                       Order.created_at <= now,
-                       Order.redeem.is_null(True),
-                       Order.status == OrderStatus.DONE
-                       ) \
-                .group_by(Order.user) \
-                .order_by(fn.COUNT(Order.id).desc())
-
-            if amount_qs.count() >= 5:
-                user_rank = 5
-            else:
-                user_rank = sale_qs.count()
-
-            # print(amount_qs.count())
-
-            buy_list = []
-            top_user_list = []
-            for obj in user_qs:
-                buy_list.append(float(obj.users_buys))
-                top_user_list.append(obj.user.id)
-
-            item_device_rank[zoom]["userBuys"] = buy_list[:user_rank]
-            item_device_rank[zoom]["topUsers"] = top_user_list[:user_rank]
-
+        agg = DashboardAggregator()
+        ranks = agg.order_ranks()
+
+        item_device_rank = {}
+        for zoom in agg.windows:
+            rank = ranks[zoom]
+            item_device_rank[zoom] = {
+                # 產品銷售金額排行
+                "itemSales": [v for _, v in rank["item_sales"]],
+                "topSalesItems": [str(name) for name, _ in rank["item_sales"]],
+                # 產品銷售量排行
+                "itemAmount": [v for _, v in rank["item_amount"]],
+                "topAmountItems": [str(name) for name, _ in rank["item_amount"]],
+                # 單機銷售金額排行
+                "deviceSales": [v for _, v in rank["device_sales"]],
+                "topSalesDevice": [str(address) for address, _ in rank["device_sales"]],
+                # 單機銷售量排行
+                "deviceAmount": [v for _, v in rank["device_amount"]],
+                "topAmountDevices": [str(address) for address, _ in rank["device_amount"]],
+                # 用戶
+                "userBuys": [v for _, v in rank["user_buys"]],
+                "topUsers": [uid for uid, _ in rank["user_buys"]],
+            }
         return item_device_rank
 
-    @rpc
+    @readonly_rpc
     def dashboard_pay_conversion_trend(self):
         now = dte.now()
         # 當周
@@ -3839,7 +3409,7 @@ class InvboxService(BaseService):
         helper = SMSHelper()
         smsobj = helper.send_wechat_message(mobile)
 
-        if smsobj.status == C.SMSStatus.OK:
+        if smsobj.status != C.SMSStatus.FAIL:
             info = json.loads(smsobj.tplparam)
             code = info["code"]
             rds.set(key, code, ex=expire_seconds)
@@ -3872,14 +3442,14 @@ class InvboxService(BaseService):
 
         day = dte.now().strftime("%Y-%m-%d")
         if stype == "flow":
-            dds = DayDeviceStat.get_or_create(device=device, day=day)
-            dds.flows = dds.flows + data["count"]
-            dds.save()
+            incr = {"flows": data["count"]}
         elif stype == "stays":
-            dds = DayDeviceStat.get_or_create(device=device, day=day)
-            dds.stays = dds.stays + data["count"]
-            dds.save()
+            incr = {"stays": data["count"]}
         elif stype == "lockPageClick":
-            dds = DayDeviceStat.get_or_create(device=device, day=day)
-            dds.clicks = dds.clicks + 1
-            dds.save()
\ No newline at end of file
+            incr = {"clicks": 1}
+        else:
+            incr = None
+        if incr:
+            # 一条语句完成插入或累加，并发上报不会重复建行或丢计数
+            DayDeviceStat.insert_or_update([dict(incr, device=device, day=day)],
+                                           incr=incr.keys())
@@ -2,9 +2,11 @@
 
 import sys
 from aliyunsdkdysmsapi.request.v20170525 import SendSmsRequest
+from aliyunsdkdysmsapi.request.v20170525 import SendBatchSmsRequest
 from aliyunsdkdysmsapi.request.v20170525 import QuerySendDetailsRequest
 from aliyunsdkcore.client import AcsClient
 import uuid
+import json
 from aliyunsdkcore.profile import region_provider
 
 """
@@ -50,12 +52,40 @@ def send_sms(biz_id, phone_numbers, sign_name, template_code, template_param=Non
     return smsResponse
 
 
+def _batch_request(phone_numbers, sign_names, template_code, template_params):
+    batchRequest = SendBatchSmsRequest.SendBatchSmsRequest()
+    batchRequest.set_TemplateCode(template_code)
+    batchRequest.set_PhoneNumberJson(json.dumps(phone_numbers))
+    batchRequest.set_SignNameJson(json.dumps(sign_names, ensure_ascii=False))
+    batchRequest.set_templateParamJson(json.dumps(template_params, ensure_ascii=False))
+    return batchRequest
+
+
+def send_batch_sms(phone_numbers, sign_names, template_code, template_params):
+    """
+    批量发送同一模板的短信，一次最多100个号码；
+    phone_numbers、sign_names、template_params一一对应
+    """
+    batchRequest = _batch_request(phone_numbers, sign_names, template_code, template_params)
+    batchResponse = acs_client.do_action_with_exception(batchRequest)
+    return batchResponse
+
+
+def submit_batch_sms(phone_numbers, sign_names, template_code, template_params):
+    """
+    同send_batch_sms，但在后台发送，返回Future；同时在途的请求数受acs_client限制
+    """
+    batchRequest = _batch_request(phone_numbers, sign_names, template_code, template_params)
+    return acs_client.submit_action(batchRequest)
+
+
 def query_send_detail(biz_id, phone_number, page_size, current_page, send_date):
     queryRequest = QuerySendDetailsRequest.QuerySendDetailsRequest()
     # 查询的手机号码
     queryRequest.set_PhoneNumber(phone_number)
-    # 可选 - 流水号
-    queryRequest.set_BizId(biz_id)
+    # 可选 - 流水号，不填时查该号码当天的全部短信
+    if biz_id:
+        queryRequest.set_BizId(biz_id)
     # 必填 - 发送日期 支持30天内记录查询，格式yyyyMMdd
     queryRequest.set_SendDate(send_date)
     # 必填-当前页码从1开始计数
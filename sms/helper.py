@@ -1,14 +1,12 @@
 # -*- coding: utf-8 -*-
 
-import alisms
 import const as C
 import random
 import logging
 import json
-import time
 
 from models import SMSHistory
-from util import thread_call_out
+from util import trace
 
 LOGIN_VALID_CODE = "SMS_138690015"
 SUPPLY_NOTIFY_CODE = "SMS_139981231"
@@ -16,65 +14,35 @@ LACK_ITEM_WARNING = "SMS_139981244"
 FINSH_SUPPLY_CODE = "SMS_139976197"
 REDEEM_CREATE_CODE = "SMS_139971026"
 
+SIGN_NAME = "小粉盒"
+
 logger = logging.getLogger(__name__)
 
 
 class SMSHelper(object):
 
+    @trace.traced("sms.enqueue")
     def _send_sms(self, mobile, tpl_code, data):
+        """
+        写入发件箱，由定时任务sms.outbox.send_pending批量发送
+
+        在事务里调用时，事务回滚短信也不会发出
+        """
         obj = SMSHistory(status=C.SMSStatus.READY,
                          mobile=mobile,
                          tplcode=tpl_code,
                          tplparam=json.dumps(data),
                          channel=C.SMSChannel.ALI)
         obj.save()
-
-        res = alisms.send_sms(obj.id, mobile, "小粉盒", tpl_code,
-                              template_param=json.dumps(data))
-        res = json.loads(res)
-
-        logger.info("[alisms](SendSMS) mobile:%s tpl_code:%s tpl_param:%s response:%s",
-                    mobile, tpl_code, data, res)
-
-        if res["Code"].upper() == "OK":
-            obj.status = C.SMSStatus.OK
-            obj.biz_id = res["BizId"]
-        else:
-            obj.status = C.SMSStatus.FAIL
-        obj.save()
+        logger.info("[alisms](Enqueue) mobile:%s tpl_code:%s tpl_param:%s cid:%s",
+                    mobile, tpl_code, data, trace.current_id())
         return obj
 
-    @staticmethod
-    def refresh(smsobj, sleep=0):
-        if not isinstance(smsobj, SMSHistory):
-            smsobj = SMSHistory.get_or_none(id=smsobj)
-
-        if not smsobj:
-            return
-
-        if sleep:
-            time.sleep(sleep)
-
-        sdate = smsobj.created_at.strftime("%Y%m%d")
-        res = alisms.query_send_detail(smsobj.biz_id, smsobj.mobile, 10, 1, sdate)
-        logger.info("[alisms](QuerySendDetails) mobile:%s bizid:%s response:%s",
-                    smsobj.mobile, smsobj.biz_id, res)
-
-        res = json.loads(res)
-        detail = res["SmsSendDetailDTOs"]["SmsSendDetailDTO"]
-        if not detail:
-            return
-
-        detail = detail[0]
-        smsobj.content = detail["Content"]
-        smsobj.save()
-
     def send_login_message(self, mobile):
         "发送登录验证短信"
 
         code = "%06d" % random.randrange(100001, 999999)
         smsobj = self._send_sms(mobile, LOGIN_VALID_CODE, {"code": code})
-        thread_call_out(SMSHelper.refresh, smsobj.id, sleep=10)
         return smsobj
 
     def send_wechat_message(self, mobile):
@@ -82,7 +50,6 @@ class SMSHelper(object):
 
         code = "%06d" % random.randrange(100001, 999999)
         smsobj = self._send_sms(mobile, LOGIN_VALID_CODE, {"code": code})
-        thread_call_out(SMSHelper.refresh, smsobj.id, sleep=10)
         return smsobj
 
     def send_supply_message(self, device, supplylist):
@@ -96,7 +63,6 @@ class SMSHelper(object):
         }
 
         smsobj = self._send_sms(supplyer.mobile, SUPPLY_NOTIFY_CODE, params)
-        thread_call_out(SMSHelper.refresh, smsobj.id, sleep=10)
         return smsobj
 
     def send_lack_warning(self, device):
@@ -127,7 +93,6 @@ class SMSHelper(object):
         }
 
         smsobj = self._send_sms(supplyer.mobile, LACK_ITEM_WARNING, params)
-        thread_call_out(SMSHelper.refresh, smsobj.id, sleep=10)
         return smsobj
 
     def send_finish_supply_message(self, supplylist):
@@ -138,7 +103,6 @@ class SMSHelper(object):
         }
 
         smsobj = self._send_sms(supplyer.mobile, FINSH_SUPPLY_CODE, params)
-        thread_call_out(SMSHelper.refresh, smsobj.id, sleep=10)
         return smsobj
 
     def send_redeem_message(self, redeem):
@@ -150,11 +114,9 @@ class SMSHelper(object):
         }
 
         smsobj = self._send_sms(redeem.user.mobile, REDEEM_CREATE_CODE, params)
-        thread_call_out(SMSHelper.refresh, smsobj.id, sleep=10)
         return smsobj
 
 
 if __name__ == "__main__":
     helper = SMSHelper()
     obj = helper.send_login_message("13064754229")
-    helper.refresh(SMSHistory.get_or_none(id=3))
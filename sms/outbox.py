@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+短信发件箱
+
+SMSHelper只把短信写进SMSHistory(READY)，send_pending定时取出到期的短信，
+按模板分组，每组最多BATCH_SIZE条用SendBatchSms一次发出，结果按批整体更新状态。
+各批并发发送（并发数受alisms.acs_client限制），某一批出错不影响其它批。
+
+阿里云会因为批里一个号码的错误(NUMBER_ERRORS，如号码非法、单号码限流)拒绝整批，
+这类错误重试也不会成功：把这批拆成两半重新发送，直到找出出错的单条记为失败，
+同批的其它短信照常发出。余额不足、模板或签名不合法等账号、模板级别的错误拆开
+也一样失败，和网络等其它错误一样整批按退避时间重试。
+
+取出时先把状态改成SENDING并把send_at推后CLAIM_SECONDS，进程中途挂掉的话
+到期后会被重新取出；发送失败的按退避时间重试，超过MAX_RETRIES次记为失败。
+"""
+import time
+import json
+import logging
+import const as C
+import alisms
+
+from datetime import datetime as dte, timedelta
+from models import SMSHistory
+from helper import SIGN_NAME
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100            # SendBatchSms一次最多100个号码
+MAX_RETRIES = 3
+RETRY_DELAYS = [10, 60, 300]    # 第n次重试前等待的秒数
+CLAIM_SECONDS = 120         # 取出后多久没有结果视为发送中断，重新发送
+BATCHES_PER_SECOND = 10     # 每秒最多调用几次批量接口
+
+
+class RateLimiter(object):
+    """
+    简单限速：两次调用之间至少间隔1/rate秒
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.last = 0
+
+    def wait(self):
+        left = self.last + self.interval - time.time()
+        if left > 0:
+            time.sleep(left)
+        self.last = time.time()
+
+
+limiter = RateLimiter(BATCHES_PER_SECOND)
+
+
+def claim_pending(limit=1000, now=None):
+    """
+    取出到期待发送的短信，返回取到的记录
+    """
+    now = now or dte.now()
+    due = (SMSHistory.status << [C.SMSStatus.READY, C.SMSStatus.SENDING]) & \
+          (SMSHistory.send_at <= now)
+    ids = [obj.id for obj in SMSHistory.select(SMSHistory.id)
+                                       .where(due)
+                                       .order_by(SMSHistory.send_at)
+                                       .limit(limit)]
+    if not ids:
+        return []
+
+    # MySQL的DATETIME不存毫秒，取整后才能用相等条件查回来
+    claim_until = now.replace(microsecond=0) + timedelta(seconds=CLAIM_SECONDS)
+    SMSHistory.update(status=C.SMSStatus.SENDING, send_at=claim_until) \
+              .where(SMSHistory.id << ids, due) \
+              .execute()
+    return list(SMSHistory.select()
+                          .where(SMSHistory.id << ids,
+                                 SMSHistory.status == C.SMSStatus.SENDING,
+                                 SMSHistory.send_at == claim_until))
+
+
+def submit_batch(tpl_code, objs):
+    """
+    在后台发送一批同模板的短信，返回Future
+    """
+    limiter.wait()
+    return alisms.submit_batch_sms([obj.mobile for obj in objs],
+                                   [SIGN_NAME] * len(objs),
+                                   tpl_code,
+                                   [json.loads(obj.tplparam) for obj in objs])
+
+
+# 只和批里某个号码或某条内容有关的错误码
+NUMBER_ERRORS = set([
+    "isv.MOBILE_NUMBER_ILLEGAL",
+    "isv.BUSINESS_LIMIT_CONTROL",
+    "isv.DAY_LIMIT_CONTROL",
+    "isv.BLACK_KEY_CONTROL_LIMIT",
+    "isv.PARAM_LENGTH_LIMIT",
+    "isv.PARAM_NOT_SUPPORT_URL",
+])
+
+
+def is_number_error(code):
+    """
+    单个号码的错误，重试不会成功
+    """
+    return code in NUMBER_ERRORS
+
+
+def batch_result(tpl_code, objs, future):
+    """
+    等待一批短信发送完成，返回(是否成功, 回执id或错误信息, 是否可以重试)
+    """
+    try:
+        res = json.loads(future.result())
+    except Exception as e:
+        logger.exception("[alisms](SendBatchSms) tpl_code:%s error", tpl_code)
+        return False, str(e)[:200], True
+
+    logger.info("[alisms](SendBatchSms) tpl_code:%s count:%s response:%s",
+                tpl_code, len(objs), res)
+    code = res.get("Code", "")
+    if code.upper() == "OK":
+        return True, res["BizId"], False
+    return False, ("%s: %s" % (code, res.get("Message")))[:200], not is_number_error(code)
+
+
+def mark_result(objs, ok, result, now=None, retry=True):
+    """
+    按批更新发送结果：成功的记回执id，send_at记为发送时间now，用来对账回执；
+    失败的按重试次数分组推后或记为失败；retry为False时直接记为失败
+    """
+    now = now or dte.now()
+    ids = [obj.id for obj in objs]
+    if ok:
+        SMSHistory.update(status=C.SMSStatus.OK, biz_id=result, error="", send_at=now) \
+                  .where(SMSHistory.id << ids) \
+                  .execute()
+        return
+    if not retry:
+        SMSHistory.update(status=C.SMSStatus.FAIL, error=result) \
+                  .where(SMSHistory.id << ids) \
+                  .execute()
+        return
+
+    by_retries = {}
+    for obj in objs:
+        by_retries.setdefault(obj.retries, []).append(obj.id)
+    for retries, ids in by_retries.items():
+        if retries >= MAX_RETRIES:
+            fields = {"status": C.SMSStatus.FAIL, "error": result}
+        else:
+            delay = RETRY_DELAYS[min(retries, len(RETRY_DELAYS) - 1)]
+            fields = {"status": C.SMSStatus.READY, "error": result,
+                      "retries": retries + 1,
+                      "send_at": now + timedelta(seconds=delay)}
+        SMSHistory.update(**fields).where(SMSHistory.id << ids).execute()
+
+
+def send_pending(limit=1000):
+    """
+    发送到期的短信，返回{"sent": 成功条数, "failed": 失败条数}
+    """
+    groups = {}
+    for obj in claim_pending(limit):
+        groups.setdefault(obj.tplcode, []).append(obj)
+
+    report = {"sent": 0, "failed": 0}
+    batches = []
+
+    def submit(tpl_code, batch):
+        submit_at = dte.now()
+        try:
+            future = submit_batch(tpl_code, batch)
+        except Exception as e:
+            logger.exception("[alisms](SendBatchSms) tpl_code:%s submit error", tpl_code)
+            mark_result(batch, False, str(e)[:200])
+            report["failed"] += len(batch)
+            return
+        batches.append((tpl_code, batch, future, submit_at))
+
+    for tpl_code, objs in groups.items():
+        for i in range(0, len(objs), BATCH_SIZE):
+            submit(tpl_code, objs[i: i + BATCH_SIZE])
+
+    while batches:
+        tpl_code, batch, future, submit_at = batches.pop(0)
+        ok, result, retry = batch_result(tpl_code, batch, future)
+        if not ok and not retry and len(batch) > 1:
+            # 号码错误可能只是其中一个号码引起的，拆开重发找出这一条
+            half = len(batch) // 2
+            submit(tpl_code, batch[:half])
+            submit(tpl_code, batch[half:])
+            continue
+        mark_result(batch, ok, result, now=submit_at, retry=retry)
+        report["sent" if ok else "failed"] += len(batch)
+    if groups:
+        logger.info("[alisms] outbox %s", report)
+    return report
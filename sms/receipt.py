@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+短信回执对账
+
+定时把已发送、还没有最终回执的短信按(手机号, 发送日期)分组，每组用QuerySendDetails
+分页查一次当天发给该号码的全部短信，再按模板和发送时间对应回SMSHistory，
+回执状态和短信内容按批用CASE一次更新。发送日期取发件箱实际发出的时间send_at，
+重试、退避可能让短信在创建的第二天才发出。
+
+当天的详情里也有已经对完账的短信，匹配时把该号码当天发出的短信全部带上，
+先被之前的短信对上的详情不会再对到别的短信上。
+
+回执到了接收成功/失败就不再查询；超过RECEIPT_DAYS天还没有最终回执、
+或者连续MAX_CHECKS次都没对上详情的也不再查。
+"""
+import json
+import logging
+import const as C
+import alisms
+
+from datetime import datetime as dte, timedelta
+from playhouse.shortcuts import case
+from models import SMSHistory
+from outbox import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50              # QuerySendDetails一页最多50条
+MAX_PAGES = 10
+RECEIPT_DAYS = 3            # 只对账最近几天的短信
+MAX_GROUPS = 200            # 每次对账最多查多少个(手机号, 日期)
+QUERIES_PER_SECOND = 10
+CLOCK_SKEW = 60             # 本机与短信平台的时钟误差，秒
+MAX_CHECKS = 10             # 查询几次都没对上详情就不再查
+
+FINAL_RECEIPTS = [C.SMSReceipt.FAIL, C.SMSReceipt.DELIVERED]
+
+limiter = RateLimiter(QUERIES_PER_SECOND)
+
+
+def pending_groups(now=None, limit=MAX_GROUPS):
+    """
+    需要对账的短信，返回{(手机号, yyyymmdd): [SMSHistory, ...]}
+    """
+    since = (now or dte.now()) - timedelta(days=RECEIPT_DAYS)
+    qs = SMSHistory.select() \
+                   .where(SMSHistory.receipt << [C.SMSReceipt.UNKNOWN, C.SMSReceipt.WAITING],
+                          SMSHistory.send_at >= since,
+                          SMSHistory.status == C.SMSStatus.OK,
+                          SMSHistory.receipt_checks < MAX_CHECKS) \
+                   .order_by(SMSHistory.send_at)
+    groups = {}
+    for obj in qs:
+        key = (obj.mobile, obj.send_at.strftime("%Y%m%d"))
+        if key not in groups and len(groups) >= limit:
+            continue
+        groups.setdefault(key, []).append(obj)
+    return groups
+
+
+def sent_on_day(mobile, send_date):
+    """
+    某号码某天发出的全部短信，包括已经对完账的
+    """
+    start = dte.strptime(send_date, "%Y%m%d")
+    return list(SMSHistory.select()
+                          .where(SMSHistory.mobile == mobile,
+                                 SMSHistory.status == C.SMSStatus.OK,
+                                 SMSHistory.send_at >= start,
+                                 SMSHistory.send_at < start + timedelta(days=1)))
+
+
+def query_details(mobile, send_date):
+    """
+    分页查询某号码某天的全部发送详情
+    """
+    details = []
+    for page in range(1, MAX_PAGES + 1):
+        limiter.wait()
+        res = json.loads(alisms.query_send_detail(None, mobile, PAGE_SIZE, page, send_date))
+        if res.get("Code", "").upper() != "OK":
+            logger.warning("[alisms](QuerySendDetails) mobile:%s date:%s response:%s",
+                           mobile, send_date, res)
+            break
+        items = res["SmsSendDetailDTOs"]["SmsSendDetailDTO"]
+        details.extend(items)
+        if len(items) < PAGE_SIZE or len(details) >= int(res.get("TotalCount", 0)):
+            break
+    return details
+
+
+def match_details(objs, details):
+    """
+    按模板和发送时间把发送详情对应到短信：每条短信取同模板、发送时间不早于send_at
+    的最早一条详情（容忍CLOCK_SKEW秒的时钟误差），返回[(SMSHistory, 详情), ...]
+
+    objs要包含当天该号码的全部短信，否则还没对账的短信可能对到别的短信的详情上
+    """
+    unmatched = sorted(details, key=lambda d: d.get("SendDate", ""))
+    res = []
+    for obj in sorted(objs, key=lambda o: (o.send_at, o.id)):
+        sent = (obj.send_at - timedelta(seconds=CLOCK_SKEW)).strftime("%Y-%m-%d %H:%M:%S")
+        for detail in unmatched:
+            if detail.get("TemplateCode") == obj.tplcode and detail.get("SendDate", "") >= sent:
+                unmatched.remove(detail)
+                res.append((obj, detail))
+                break
+    return res
+
+
+def save_receipts(matched):
+    """
+    按批更新回执状态和短信内容，返回更新的条数
+    """
+    changed = [(obj, detail) for obj, detail in matched
+               if int(detail["SendStatus"]) != obj.receipt or
+               (detail.get("Content") or obj.content) != obj.content]
+    if not changed:
+        return 0
+
+    ids = [obj.id for obj, _ in changed]
+    receipts = [(obj.id, int(detail["SendStatus"])) for obj, detail in changed]
+    contents = [(obj.id, detail.get("Content") or obj.content) for obj, detail in changed]
+    SMSHistory.update(receipt=case(SMSHistory.id, receipts),
+                      content=case(SMSHistory.id, contents)) \
+              .where(SMSHistory.id << ids) \
+              .execute()
+    return len(changed)
+
+
+def reconcile(now=None):
+    """
+    对账一轮，返回{"groups": 查询的组数, "updated": 更新的短信数, "final": 到达最终状态的短信数}
+    """
+    report = {"groups": 0, "updated": 0, "final": 0}
+    for (mobile, send_date), objs in pending_groups(now).items():
+        try:
+            details = query_details(mobile, send_date)
+        except Exception:
+            logger.exception("[alisms] query details of %s %s error", mobile, send_date)
+            continue
+
+        pending = set(obj.id for obj in objs)
+        matched = match_details(sent_on_day(mobile, send_date), details)
+        matched = [(obj, detail) for obj, detail in matched if obj.id in pending]
+        missed = pending - set(obj.id for obj, _ in matched)
+        if missed:
+            SMSHistory.update(receipt_checks=SMSHistory.receipt_checks + 1) \
+                      .where(SMSHistory.id << list(missed)) \
+                      .execute()
+
+        report["groups"] += 1
+        report["updated"] += save_receipts(matched)
+        report["final"] += sum(1 for _, d in matched if int(d["SendStatus"]) in FINAL_RECEIPTS)
+
+    if report["groups"]:
+        logger.info("[alisms] reconcile receipts %s", report)
+    return report
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+测试共用的fixture
+"""
+import pytest
+
+from models import create_tables, drop_tables
+
+
+@pytest.fixture(scope="module")
+def init_db(request):
+    """
+    整个模块共用一套表，模块结束时删除；用pytestmark = pytest.mark.usefixtures("init_db")引入
+    """
+    create_tables()
+
+    def fin():
+        drop_tables()
+    request.addfinalizer(fin)
@@ -5,7 +5,7 @@ import random
 import ujson as json
 
 from util import md5
-from const import OrderStatus, PayStatus
+from const import OrderStatus, PayStatus, PayType
 from datetime import datetime as dte, timedelta
 from biz import MarktingBiz, DeviceBiz
 
@@ -430,3 +430,28 @@ def init_all():
             users_pay=60,
         )
         obj.save()
+
+
+def create_device(no, category=None, **kwargs):
+    "测试用设备，名称、地址默认同编号"
+    if category is None:
+        category = M.DeviceCategory.get_or_create(name="型号-1")
+    kwargs.setdefault("name", no)
+    kwargs.setdefault("address", no)
+    return M.Device.create(no=no, category=category, **kwargs)
+
+
+def create_item(name, **kwargs):
+    "测试用商品，类别、品牌共用同一个"
+    kwargs.setdefault("category", M.ItemCategory.get_or_create(name="卫生巾"))
+    kwargs.setdefault("brand", M.ItemBrand.get_or_create(name="In-V"))
+    return M.Item.create(name=name, **kwargs)
+
+
+def create_order(no, device, item, user=None, money=0, amount=1,
+                 status=OrderStatus.DONE, pay_status=PayStatus.PAIED, **kwargs):
+    "测试用订单，默认已出货的微信支付订单，单价即支付金额"
+    kwargs.setdefault("pay_type", PayType.WX)
+    return M.Order.create(no=no, device=device, item=item, user=user,
+                          pay_money=money, price=money, item_amount=amount,
+                          status=status, pay_status=pay_status, **kwargs)
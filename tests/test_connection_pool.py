@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+aliyunsdkcore长连接池的重试
+"""
+import os
+import sys
+import time
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "libs", "aliyun-python-sdk-core"))
+
+from aliyunsdkcore.http.connection_pool import ConnectionPool  # noqa
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        self.server.received.append(self.path)
+        if self.path == "/slow":
+            time.sleep(0.5)
+        body = "OK"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == "/close":
+            # 没有Connection: close，客户端会把连接放回池里
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    server.received = []
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    yield server
+    server.shutdown()
+
+
+def post(pool, server, path, timeout=5):
+    return pool.request(False, "127.0.0.1", server.server_address[1], "POST", path,
+                        "a=1", {"Content-Type": "application/x-www-form-urlencoded"}, timeout)
+
+
+def test_no_retry_on_timeout(server):
+    pool = ConnectionPool()
+    assert post(pool, server, "/ok", timeout=0.2)[0] == 200
+
+    # 复用的连接上等响应超时，服务端可能已经处理过，不能重发
+    with pytest.raises(socket.timeout):
+        post(pool, server, "/slow", timeout=0.2)
+    time.sleep(0.5)
+    assert server.received == ["/ok", "/slow"]
+    assert (pool.created, pool.reused) == (1, 1)
+
+
+def test_retry_closed_connection(server):
+    pool = ConnectionPool()
+    assert post(pool, server, "/close")[0] == 200
+    time.sleep(0.1)
+
+    # 服务端已经关闭了空闲连接，没收到请求，换新连接重发一次
+    assert post(pool, server, "/ok")[0] == 200
+    assert server.received == ["/close", "/ok"]
+    assert (pool.created, pool.reused) == (2, 1)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+看板接口
+"""
+import pytest
+import dashboard
+import models as M
+
+from functools import partial
+from datetime import datetime as dte
+from nameko.testing.services import worker_factory
+from service import service as service_module
+from service.service import InvboxService
+from const import OrderStatus, PayStatus, PayType
+from tests.init_data import create_device, create_item, create_order
+
+# 周三中午；本周从6月11日开始
+NOW = dte(2018, 6, 13, 12, 0, 0)
+
+pytestmark = pytest.mark.usefixtures("init_db")
+
+
+@pytest.fixture(scope="module")
+def data():
+    devices = {}
+    for name, involved, heartbeat_at in [("A1", True, dte(2018, 6, 13, 11)),
+                                         ("A2", True, dte(2018, 6, 13, 8)),
+                                         ("A3", False, dte(2018, 6, 11, 10)),
+                                         ("A4", True, dte(2018, 6, 13, 10)),
+                                         ("A5", True, dte(2018, 6, 1))]:
+        devices[name] = create_device(name, involved=involved, heartbeat_at=heartbeat_at)
+    items = dict((name, create_item(name)) for name in ("i1", "i2"))
+
+    users = {
+        # 今天注册的粉丝
+        "u1": M.User.create(username="u1", mobile="13000000001", created_at=dte(2018, 6, 13, 9)),
+        # 本周、本年的新用户（无手机号且已购买）
+        "u2": M.User.create(username="u2", created_at=dte(2018, 6, 11, 9),
+                            first_buy_at=dte(2018, 6, 11, 10)),
+        "u4": M.User.create(username="u4", created_at=dte(2018, 2, 1),
+                            first_buy_at=dte(2018, 3, 1)),
+        # 没有购买过的不算新用户
+        "u3": M.User.create(username="u3", created_at=dte(2018, 6, 13, 8)),
+    }
+
+    def _order(no, created_at, device, item, user, money, **kwargs):
+        return create_order(no, devices[device], items[item], users[user] if user else None,
+                            money, created_at=created_at, **kwargs)
+
+    _order("1", dte(2018, 6, 13, 9, 10), "A1", "i1", "u1", 300, amount=2)
+    _order("2", dte(2018, 6, 13, 10, 20), "A1", "i2", "u1", 100)
+    _order("3", dte(2018, 6, 13, 11), "A2", "i1", "u2", 200)
+    _order("4", dte(2018, 6, 11, 10), "A2", "i2", "u2", 500)
+    _order("5", dte(2018, 3, 1), "A1", "i1", "u4", 1000, amount=4)
+    _order("6", dte(2018, 4, 1), "A2", "i2", "u2", 50)
+    # 退款、未支付、去年的订单不算销售
+    _order("7", dte(2018, 6, 13, 8), "A1", "i1", "u3", 100,
+           status=OrderStatus.REFUNDED, pay_status=PayStatus.REFUND)
+    _order("8", dte(2018, 6, 13, 8), "A2", "i2", None, 0,
+           status=OrderStatus.CREATED, pay_status=PayStatus.UNPAY)
+    _order("9", dte(2017, 12, 31), "A1", "i1", "u1", 700)
+    M.HourOrderStat.rebuild(dte(2017, 1, 1), NOW)
+
+    for device, day, flows, stays, clicks in [("A1", "2018-06-13", 100, 40, 10),
+                                              ("A2", "2018-06-13", 50, 30, 20),
+                                              ("A1", "2018-06-11", 200, 10, 5),
+                                              ("A2", "2018-02-01", 1000, 0, 0)]:
+        M.DayDeviceStat.create(device=devices[device], day=day, flows=flows, stays=stays,
+                               clicks=clicks)
+    return devices, items, users
+
+
+@pytest.fixture
+def invbox(data, monkeypatch):
+    monkeypatch.setattr(service_module, "DashboardAggregator",
+                        partial(dashboard.DashboardAggregator, now=NOW))
+    dashboard.clear_cache()
+    return worker_factory(InvboxService)
+
+
+def test_sales_stats(invbox):
+    res = invbox.dashboard_sales_stats()
+    assert res["today"] == {"sales_amount": 600, "item_amount": 4, "avg_amount": 150}
+    assert res["week"] == {"sales_amount": 1100, "item_amount": 5, "avg_amount": 220,
+                           "sale_per_device": "366.67", "item_per_device": "1.67"}
+    assert res["year"] == {"sales_amount": 2150, "item_amount": 10, "avg_amount": 215}
+
+
+def test_device_stats(invbox):
+    assert invbox.dashboard_device_stats() == {
+        "involved_device": {"count": 4},
+        "online_device": {"count": 3, "rate": "75.00%"},
+        "active_device": {"count": 2, "rate": "66.67%"},
+        "nonactive_device": {"count": 1, "rate": "33.33%"},
+    }
+
+
+def test_flow_volume(invbox):
+    res = invbox.dashboard_flow_volume()
+    # 同一用户今天两次购买只算一个支付用户，退款订单的用户也算
+    assert res["today"] == {
+        "flows": 150, "stays": 70, "clicks": 30, "usersPay": 3,
+        "staysConversion": "46.67%", "clicksConversion": "42.86%", "payConversion": "10.00%",
+        "startTime": "2018-06-13 00:00:00", "endTime": "2018-06-13 12:00:00",
+    }
+    assert (res["week"]["flows"], res["week"]["usersPay"], res["week"]["startTime"]) == \
+        (350, 3, "2018-06-11 00:00:00")
+    assert (res["year"]["flows"], res["year"]["usersPay"], res["year"]["payConversion"]) == \
+        (1350, 4, "11.43%")
+    # 本周人流按本周在线的4台设备平均
+    assert res["avg_device"] == {"flows": 87, "stays": 20, "clicks": 8, "usersPay": 0,
+                                 "startTime": "2018-06-11 00:00:00",
+                                 "endTime": "2018-06-13 12:00:00"}
+
+
+def test_flow_volume_rank(invbox):
+    res = invbox.dashboard_flow_volume_rank()
+    assert res["today"]["flows"] == {"device": ["A1", "A2"], "count": [100, 50]}
+    assert res["today"]["clicks"] == {"device": ["A2", "A1"], "count": [20, 10]}
+    assert res["year"]["flows"] == {"device": ["A2", "A1"], "count": [1050, 300]}
+
+
+def test_user_stats(invbox):
+    assert invbox.dashboard_user_stats() == {
+        "today": {"newUsers": 0, "newFans": 1, "fansBuyRate": "66.67%"},
+        "week": {"newUsers": 1, "newFans": 1, "fansBuyRate": "50.00%"},
+        "year": {"newUsers": 2, "newFans": 1, "fansBuyRate": "33.33%"},
+    }
+
+
+def test_item_device_rank(invbox, data):
+    _, _, users = data
+    res = invbox.dashboard_item_device_rank()
+
+    today = res["today"]
+    assert (today["topSalesItems"], today["itemSales"]) == (["i1", "i2"], [500, 100])
+    assert (today["topAmountItems"], today["itemAmount"]) == (["i1", "i2"], [3, 1])
+    assert (today["topSalesDevice"], today["deviceSales"]) == (["A1", "A2"], [400, 200])
+    assert (today["topAmountDevices"], today["deviceAmount"]) == (["A1", "A2"], [3, 1])
+    assert (today["topUsers"], today["userBuys"]) == ([users["u1"].id, users["u2"].id], [2, 1])
+
+    year = res["year"]
+    assert (year["topSalesItems"], year["itemSales"]) == (["i1", "i2"], [1500, 650])
+    assert (year["topSalesDevice"], year["deviceSales"]) == (["A1", "A2"], [1400, 750])
+    assert (year["topUsers"], year["userBuys"]) == \
+        ([users["u2"].id, users["u1"].id, users["u4"].id], [3, 2, 1])
+
+
+def test_cached(invbox, data, monkeypatch):
+    devices, items, _ = data
+
+    class Clock(object):
+        now = 1000.0
+
+        def time(self):
+            return self.now
+
+    clock = Clock()
+    monkeypatch.setattr(dashboard, "time", clock)
+    assert invbox.dashboard_sales_stats()["today"]["sales_amount"] == 600
+
+    order = M.Order.create(no="10", created_at=dte(2018, 6, 13, 11, 30), device=devices["A4"],
+                           item=items["i1"], pay_money=400, price=400, item_amount=1,
+                           status=OrderStatus.DONE, pay_status=PayStatus.PAIED,
+                           pay_type=PayType.WX)
+    M.HourOrderStat.incr(order, orders_pay=1, sales_volume=400, sales_quantity=1)
+    try:
+        # 缓存期内各看板接口共用同一份结果
+        clock.now += dashboard.CACHE_SECONDS - 1
+        assert invbox.dashboard_sales_stats()["today"]["sales_amount"] == 600
+        assert invbox.dashboard_device_stats()["active_device"]["count"] == 2
+
+        clock.now += 2
+        assert invbox.dashboard_sales_stats()["today"]["sales_amount"] == 1000
+        assert invbox.dashboard_device_stats()["active_device"]["count"] == 3
+    finally:
+        M.HourOrderStat.incr(order, orders_pay=-1, sales_volume=-400, sales_quantity=-1)
+        order.delete_instance()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+每日统计
+"""
+import pytest
+import datastat
+import models as M
+
+from datetime import datetime as dte, timedelta
+from const import OrderStatus, PayStatus
+from tests.init_data import create_device, create_item, create_order
+
+DAY = dte.now() - timedelta(days=1)
+
+pytestmark = pytest.mark.usefixtures("init_db")
+
+
+@pytest.fixture(scope="module")
+def data():
+    item = create_item("商品1")
+    device = create_device("123456", name="测试-1")
+    users = [M.User.create(username="user-%s" % i, created_at=DAY) for i in range(3)]
+    M.UserGroup.create(name="全部", condition="[]")
+
+    def _order(no, user, status, pay_status, money, amount=1, created_at=DAY):
+        return create_order(no, device, item, user, money, amount, status, pay_status,
+                            created_at=created_at)
+
+    _order("1", users[0], OrderStatus.DONE, PayStatus.PAIED, 300, amount=2)
+    _order("2", users[0], OrderStatus.DONE, PayStatus.PAIED, 100)
+    _order("3", users[1], OrderStatus.REFUNDED, PayStatus.REFUND, 100)
+    _order("4", None, OrderStatus.CREATED, PayStatus.UNPAY, 0)
+    _order("5", users[2], OrderStatus.DONE, PayStatus.PAIED, 500,
+           created_at=DAY - timedelta(days=1))
+
+    # 实时累加的人流数据
+    M.DayDeviceStat.create(day=DAY.strftime("%Y-%m-%d"), device=device, flows=7)
+    return device, item
+
+
+def test_stat_day(data):
+    device, item = data
+    day = DAY.strftime("%Y-%m-%d")
+
+    for i in range(2):      # 重复执行结果不变
+        report = datastat.stat_day(DAY)
+        assert report["errors"] == {}
+        assert report["rows"] == {"device": 1, "item": 1, "user_group": 1, "day": 1}
+
+        assert M.DayDeviceStat.select().where(M.DayDeviceStat.day == day).count() == 1
+        ds = M.DayDeviceStat.get(day=day, device=device)
+        assert (ds.sales_volume, ds.sales_quantity, ds.orders_pay, ds.users_pay) == (400, 3, 3, 2)
+        assert (ds.item_clicks, ds.flows) == (4, 7)
+
+        its = M.DayItemStat.get(day=day, item=item)
+        assert (its.sales_volume, its.orders_pay, its.clicks) == (400, 3, 4)
+
+        st = M.DayStat.get(day=day)
+        assert (st.users, st.registers, st.actives, st.users_pay) == (3, 3, 1, 2)
+
+        ugs = M.DayUserGroupStat.get(day=day)
+        assert (ugs.users, ugs.actives, ugs.sales_volume) == (3, 1, 400)
+
+
+def test_stat_days(data):
+    device, _ = data
+    start = (DAY - timedelta(days=1)).strftime("%Y-%m-%d")
+    reports = datastat.stat_days(start, DAY.strftime("%Y-%m-%d"), workers=1)
+    assert [r["day"] for r in reports] == [start, DAY.strftime("%Y-%m-%d")]
+    assert M.DayDeviceStat.get(day=start, device=device).sales_volume == 500
+
+
+def test_insert_or_update(data):
+    device, _ = data
+    day = "2018-06-01"
+    for i in range(3):
+        M.DayDeviceStat.insert_or_update([{"day": day, "device": device.id, "flows": 2}],
+                                         incr=["flows"])
+    assert M.DayDeviceStat.select().where(M.DayDeviceStat.day == day).count() == 1
+    assert M.DayDeviceStat.get(day=day, device=device).flows == 6
+
+
+def test_user_counters(data):
+    import datastat
+    from biz import OrderBiz
+
+    user = M.User.get(username="user-0")
+    M.User.update(buy_count=99, recent_buy_count=99).execute()
+    datastat.rebuild_user_counters()
+    user = M.User.get(id=user.id)
+    assert (user.buy_count, user.recent_buy_count) == (2, 2)
+
+    # 出货成功、退款实时更新
+    order = M.Order.get(no="2")
+    OrderBiz(order=order).refund_success(100)
+    user = M.User.get(id=user.id)
+    assert (user.buy_count, user.recent_buy_count) == (1, 1)
+
+    # 超出28天的订单滚出近期购买次数
+    datastat.refresh_recent_buy_counts(now=dte.now() + timedelta(days=30))
+    assert M.User.get(id=user.id).recent_buy_count == 0
+
+
+def test_item_counters(data):
+    _, item = data
+    datastat.rebuild_item_counters()
+    item = M.Item.get(id=item.id)
+    assert (item.sales_count, item.pv_count) == (2, 5)
+    assert M.ItemCategory.get(id=item.category_id).item_count == 1
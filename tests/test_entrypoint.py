@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+分布式定时任务
+"""
+import time
+import pytest
+
+from datetime import datetime as dte
+from entrypoint import next_boundary, sleep_until, CronTrigger, DistributedTimer, \
+    TIMER_LEASE_SCRIPT
+from util.rds import RedisKeys
+
+
+def test_next_boundary():
+    assert next_boundary(100, 20) == 120
+    assert next_boundary(119.9, 20) == 120
+    assert next_boundary(120, 20) == 140
+
+
+def test_sleep_until():
+    begin = time.time()
+    assert sleep_until(begin + 0.05, lambda: False)
+    assert time.time() - begin >= 0.05
+
+    # 停止时立即返回
+    assert not sleep_until(time.time() + 10, lambda: True)
+
+
+def test_cron_trigger():
+    daily = CronTrigger("****-**-** 00:01:00")
+    assert daily.next_fire(dte(2018, 6, 1, 0, 0, 59)) == dte(2018, 6, 1, 0, 1)
+    assert daily.next_fire(dte(2018, 6, 1, 0, 1)) == dte(2018, 6, 2, 0, 1)
+    assert daily.next_fire(dte(2018, 12, 31, 12)) == dte(2019, 1, 1, 0, 1)
+
+    once = CronTrigger("2018-06-01 08:00:00")
+    assert once.next_fire(dte(2018, 1, 1)) == dte(2018, 6, 1, 8)
+    assert once.next_fire(dte(2018, 6, 1, 8)) is None
+
+    # 单个字符的通配，没有31号的月份跳过
+    trigger = CronTrigger("****-**-31 **:*5:00")
+    assert trigger.next_fire(dte(2018, 6, 1)) == dte(2018, 7, 31, 0, 5)
+    assert trigger.next_fire(dte(2018, 7, 31, 0, 5, 30)) == dte(2018, 7, 31, 0, 15)
+
+    every_second = CronTrigger("****-**-** **:**:**")
+    assert every_second.next_fire(dte(2018, 6, 1, 23, 59, 59, 500)) == dte(2018, 6, 2)
+
+    # 错过的触发时间
+    assert daily.fires_between(dte(2018, 6, 1, 0, 1), dte(2018, 6, 3, 12)) == \
+        [dte(2018, 6, 2, 0, 1), dte(2018, 6, 3, 0, 1)]
+
+    with pytest.raises(Exception):
+        CronTrigger("2018-06-01 8:00:00")
+
+
+class RecordTimer(DistributedTimer):
+
+    def __init__(self, interval):
+        super(RecordTimer, self).__init__(interval)
+        self.method_name = "test_timer"
+        self.fired = []
+
+    def handle_timer_tick(self):
+        self.fired.append(self.term)
+
+
+@pytest.fixture
+def lease_script():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    rds = fakeredis.FakeStrictRedis()
+    rds.flushall()
+    return rds, rds.register_script(TIMER_LEASE_SCRIPT)
+
+
+def test_timer_lease(lease_script):
+    rds, script = lease_script
+    leader, follower = RecordTimer(10), RecordTimer(10)
+    leader_key = RedisKeys.TIMER_LEADER % "test_timer"
+
+    assert leader._tick(script, 1000) == 1010
+    assert leader.fired == [1]
+
+    # 其他节点等租约快到期再来抢
+    wake_at = follower._tick(script, 1000.5)
+    assert wake_at == next_boundary(1000.5 + leader.lease, 10)
+    assert (follower.term, follower.fired) == (None, [])
+
+    # 同一个时间点不重复执行；续约刷新租约时间
+    rds.pexpire(leader_key, 1000)
+    assert leader._tick(script, 1005) == 1010
+    assert leader.fired == [1]
+    assert rds.pttl(leader_key) > 1000
+    assert leader._tick(script, 1010) == 1020
+    assert leader.fired == [1, 1]
+
+
+def test_timer_takeover(lease_script):
+    rds, script = lease_script
+    leader, follower = RecordTimer(10), RecordTimer(10)
+    leader.lease = follower.lease = 0.05
+
+    leader._tick(script, 1000)
+    assert follower._tick(script, 1000) > 1000 and follower.fired == []
+
+    # 租约过期后被其他节点接管，任期加一；已经执行过的时间点不再执行
+    time.sleep(0.1)
+    follower._tick(script, 1000)
+    assert (follower.term, follower.fired) == (2, [])
+    follower._tick(script, 1010)
+    assert follower.fired == [2]
+
+    # 旧领导者恢复后拿不到租约
+    leader._tick(script, 1010)
+    leader._tick(script, 1020)
+    assert (leader.term, leader.fired) == (None, [1])
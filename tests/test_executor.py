@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+后台任务执行器
+"""
+import time
+import pytest
+import threading
+
+from util.executor import BoundedExecutor, QueueFull
+
+
+def test_submit():
+    executor = BoundedExecutor("test-submit", workers=2)
+    assert executor.submit(lambda x: x * 2, 21).result(timeout=1) == 42
+
+    # 异常记录在Future里并计数
+    future = executor.submit(lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        future.result(timeout=1)
+    stats = executor.stats()
+    assert (stats["submitted"], stats["completed"], stats["errors"]) == (2, 2, 1)
+
+
+def test_queue_full():
+    executor = BoundedExecutor("test-full", workers=1, queue_size=1, submit_timeout=0.01)
+    event = threading.Event()
+    executor.submit(event.wait, 1)
+    time.sleep(0.05)                # 等工作线程取走第一个任务
+
+    executor.submit(lambda: None)
+    with pytest.raises(QueueFull):
+        executor.submit(lambda: None)
+    assert executor.stats()["rejected"] == 1
+    event.set()
+
+
+def test_call_later():
+    executor = BoundedExecutor("test-later", workers=1)
+    done = []
+
+    begin = time.time()
+    later = executor.call_later(0.1, done.append, "later")
+    # 延迟任务等待期间不占用工作线程
+    executor.submit(done.append, "now").result(timeout=1)
+    assert done == ["now"]
+    assert executor.stats()["delayed"] == 1
+
+    later.result(timeout=1)
+    assert done == ["now", "later"]
+    assert time.time() - begin >= 0.1
+
+    # 到期前取消的不会执行
+    future = executor.call_later(0.05, done.append, "cancelled")
+    assert future.cancel()
+    time.sleep(0.1)
+    assert done == ["now", "later"]
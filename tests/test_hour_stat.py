@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+小时订单统计
+"""
+import pytest
+import models as M
+
+from datetime import datetime as dte
+from biz import OrderBiz
+from const import OrderStatus, PayType
+from tests.init_data import create_device, create_item, create_order
+
+START_AT = dte(2018, 6, 13)
+END_AT = dte(2018, 6, 14)
+
+pytestmark = pytest.mark.usefixtures("init_db")
+
+
+@pytest.fixture(scope="module")
+def data():
+    devices = [create_device(no) for no in ("H1", "H2")]
+    items = [create_item(name) for name in ("i1", "i2")]
+    user = M.User.create(username="h1", mobile="13000000011")
+
+    orders = {}
+    for no, created_at, device, item, pay_type, money, amount in [
+            ("h1", dte(2018, 6, 13, 9, 5), 0, 0, PayType.WX, 300, 2),
+            ("h2", dte(2018, 6, 13, 9, 50), 0, 0, PayType.WX, 100, 1),
+            ("h3", dte(2018, 6, 13, 9, 30), 0, 0, PayType.ALIPAY, 200, 1),
+            ("h4", dte(2018, 6, 13, 10, 10), 1, 1, PayType.WX, 500, 3),
+            ("h5", dte(2018, 6, 13, 11, 0), 0, 1, PayType.WX, 80, 1)]:
+        orders[no] = create_order(no, devices[device], items[item], user, money, amount,
+                                  status=OrderStatus.DELIVERING, pay_type=pay_type,
+                                  created_at=created_at)
+    for order in orders.values():
+        OrderBiz(order=order).deliver_success()
+    return orders
+
+
+def snapshot():
+    return sorted((s.hour, s.device_id, s.item_id, s.pay_type, s.orders_pay, s.sales_volume,
+                   s.sales_quantity, s.orders_refund, s.refund_money)
+                  for s in M.HourOrderStat.select())
+
+
+def bucket(order):
+    S = M.HourOrderStat
+    return S.get(S.hour == S.truncate_hour(order.created_at), S.device == order.device_id,
+                 S.item == order.item_id, S.pay_type == order.pay_type)
+
+
+def test_incr_matches_rebuild(data):
+    incr_rows = snapshot()
+    assert len(incr_rows) == 4
+    assert (dte(2018, 6, 13, 9), data["h1"].device_id, data["h1"].item_id, PayType.WX,
+            2, 400, 3, 0, 0) in incr_rows
+
+    M.HourOrderStat.rebuild(START_AT, END_AT)
+    assert snapshot() == incr_rows
+
+
+def test_refund_after_deliver(data):
+    before = dict((row[:4], row) for row in snapshot())
+    order = data["h2"]
+    key = (dte(2018, 6, 13, 9), order.device_id, order.item_id, order.pay_type)
+
+    # 退款扣回的是订单创建时所在的9点，不是退款时间
+    OrderBiz(order=order).refund_success(100)
+    after = dict((row[:4], row) for row in snapshot())
+    assert after[key] == key + (1, 300, 2, 1, 100)
+    assert dict((k, v) for k, v in after.items() if k != key) == \
+        dict((k, v) for k, v in before.items() if k != key)
+
+    # 重复的退款通知不再扣减
+    OrderBiz(order=order).refund_success(100)
+    assert bucket(order).orders_pay == 1
+
+    incr_rows = snapshot()
+    M.HourOrderStat.rebuild(START_AT, END_AT)
+    assert snapshot() == incr_rows
+
+
+def test_rebuild_idempotent(data):
+    M.HourOrderStat.rebuild(START_AT, END_AT)
+    rows = snapshot()
+    M.HourOrderStat.rebuild(START_AT, END_AT)
+    M.HourOrderStat.rebuild(dte(2018, 6, 13, 9), dte(2018, 6, 13, 10))
+    assert snapshot() == rows
+    assert M.HourOrderStat.select().count() == len(rows)
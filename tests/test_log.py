@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+异步文件日志
+"""
+import os
+import sys
+import time
+import ujson as json
+import logging
+
+from util import metrics
+from log import DaemonFileLogHandler, LogFormatter, QueueHandler, QueueListener, _Queue, \
+    JsonFormatter, RpcContextFilter
+
+
+def make_record(msg, args=(), created=None):
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, msg, args, None)
+    if created:
+        record.created = created
+    return record
+
+
+def test_rollover(tmpdir):
+    handler = DaemonFileLogHandler(str(tmpdir), delay=1)
+    handler.setFormatter(LogFormatter(color=False))
+
+    now = time.time()
+    handler.emit_batch([make_record(u"今天 %s", (1,), now), make_record("today 2", created=now)])
+    old = handler.stream
+    # 同一批里跨天的记录写到新文件，旧文件被关闭
+    tomorrow = handler._rollover_at + 1
+    handler.emit_batch([make_record("today 3", created=now), make_record("tomorrow", created=tomorrow)])
+    assert old.closed
+    handler.close()
+
+    today = open(handler.get_cur_filename(now)).read().splitlines()
+    assert [line.split("] ")[1] for line in today] == ["今天 1", "today 2", "today 3"]
+    assert "tomorrow" in open(handler.get_cur_filename(tomorrow)).read()
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_queue(tmpdir):
+    handler = DaemonFileLogHandler(str(tmpdir), delay=1)
+    handler.setFormatter(LogFormatter(color=False))
+    queue = _Queue.Queue(3)
+    channel = QueueHandler(queue)
+
+    # 后台线程还没启动，队列满了就丢弃
+    args = {"n": 0}
+    for i in range(5):
+        args["n"] = i
+        channel.handle(make_record("n=%(n)s", (args,)))
+    assert channel.dropped == 2
+
+    # 参数在入队时已经格式化，之后被修改不影响
+    args["n"] = 100
+    listener = QueueListener(queue, handler)
+    listener.start()
+    listener.stop()
+    assert (listener.written, listener.batches) == (3, 1)
+
+    lines = open(handler.get_cur_filename()).read().splitlines()
+    assert [line.split("] ")[1] for line in lines] == ["n=0", "n=1", "n=2"]
+
+
+def test_json_format():
+    formatter = JsonFormatter()
+    context = RpcContextFilter()
+
+    with metrics.track("create_order"):
+        record = make_record("[order](%s) 创建成功", ("20180701000001",))
+        context.filter(record)
+    # 入队后参数被清掉也能取到订单号
+    record.msg, record.args = record.getMessage(), None
+    data = json.loads(formatter.format(record))
+    assert data["rpc"] == "create_order"
+    assert data["order_no"] == "20180701000001"
+    assert data["msg"] == u"[order](20180701000001) 创建成功"
+    assert data["duration"] >= 0 and "device_no" not in data
+
+    record = make_record("[device](%s-%s) 库存减少1个", ("D001", "R01"))
+    record.order_no = "20180701000002"
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        record.exc_info = sys.exc_info()
+    data = json.loads(formatter.format(record))
+    assert (data["device_no"], data["order_no"]) == ("D001", "20180701000002")
+    assert "ZeroDivisionError" in data["exc"] and "rpc" not in data
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+数据库迁移与查询计划
+"""
+import pytest
+import models
+import migration
+
+from models import db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def migration_history(init_db, request):
+
+    def fin():
+        db.drop_tables([migration.MigrationHistory], safe=True)
+    request.addfinalizer(fin)
+
+
+def test_run_migrations():
+    assert migration.run_migrations() == [name for name, _ in migration.MIGRATIONS]
+    assert migration.run_migrations() == []
+
+
+def test_hot_queries_use_index():
+    assert migration.check_query_plans() == {}
+
+    # 删掉索引后应该能检查出全表扫描
+    db.execute_sql('DROP INDEX "order_status_created_at"')
+    try:
+        assert "cluster_heartbeat" in migration.check_query_plans()
+    finally:
+        migration.migrate_order_indexes()
+    assert migration.check_query_plans() == {}
+
+
+def test_migration_indexes_fixed():
+    # 每次迁移只建自己的索引，不能提前给后面迁移才加的字段建索引
+    db.execute_sql('DROP INDEX "smshistory_receipt_send_at"')
+    assert migration.add_sms_outbox_fields() == {"smshistory": []}
+    assert migration.add_sms_receipt_checks() == {"smshistory": ["smshistory_receipt_send_at"]}
+
+
+def test_add_hour_order_stat():
+    db.drop_tables([models.HourOrderStat])
+    assert migration.add_hour_order_stat() == \
+        {"hour_order_stat": ["hour_order_stat_hour_device_id_item_id_pay_type"]}
+    assert models.HourOrderStat.select().count() == 0
+    assert migration.add_hour_order_stat() == {"hour_order_stat": []}
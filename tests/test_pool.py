@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+数据库连接池
+"""
+import models as M
+
+from playhouse.pool import PooledSqliteDatabase
+from util import metrics
+
+
+class PooledDatabase(M.PoolStatsMixin, PooledSqliteDatabase):
+    pass
+
+
+def test_connection_scope(tmpdir):
+    pooled = PooledDatabase(str(tmpdir.join("pool.db")), max_connections=2)
+    M.replicas.append(pooled)
+    try:
+        with M.connection_scope():
+            pooled.execute_sql("SELECT 1")
+            with M.connection_scope():      # 嵌套时不归还
+                pooled.execute_sql("SELECT 1")
+            assert pooled.pool_stats()["in_use"] == 1
+
+        stats = pooled.pool_stats()
+        assert (stats["in_use"], stats["idle"], stats["checkouts"]) == (0, 1, 1)
+
+        # 连接复用
+        with M.connection_scope():
+            pooled.execute_sql("SELECT 1")
+        assert pooled.pool_stats()["idle"] == 1
+
+        assert 'invbox_db_pool_in_use{pool="replica-0"} 0' in metrics.render()
+    finally:
+        M.replicas.remove(pooled)
+        pooled.close_all()
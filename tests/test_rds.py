@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Redis连接池
+"""
+import os
+import time
+import redis
+import pytest
+
+from util.rds import ConnectionPool
+
+
+class FakeConnection(object):
+
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+        self.alive = True
+        self.disconnected = False
+        self.commands = []
+
+    def send_command(self, *args):
+        if not self.alive:
+            raise redis.ConnectionError("closed")
+        self.commands.append(args)
+
+    def read_response(self):
+        return "PONG"
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+def test_connection_pool():
+    pool = ConnectionPool(connection_class=FakeConnection, max_connections=2,
+                          timeout=0.01, health_check_interval=30)
+
+    conn = pool.get_connection("GET")
+    assert pool.pool_stats() == {"created": 1, "idle": 0, "in_use": 1, "max": 2}
+    pool.release(conn)
+    assert pool.pool_stats()["idle"] == 1
+
+    # 刚用过的连接直接复用，不PING
+    assert pool.get_connection("GET") is conn
+    assert conn.commands == []
+
+    # 空闲太久的先PING，PING不通的断开
+    pool.release(conn)
+    conn.last_used = time.time() - 60
+    assert pool.get_connection("GET") is conn
+    assert conn.commands == [("PING", )]
+
+    pool.release(conn)
+    conn.last_used = time.time() - 60
+    conn.alive = False
+    assert pool.get_connection("GET") is conn
+    assert conn.disconnected
+
+    # 连接池满时等待超时
+    pool.get_connection("GET")
+    with pytest.raises(redis.ConnectionError):
+        pool.get_connection("GET")
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+从库路由
+"""
+import models as M
+
+from util.replica import ReplicaRouter
+
+
+class FakeRouter(ReplicaRouter):
+
+    def __init__(self, *args, **kwargs):
+        super(FakeRouter, self).__init__(*args, **kwargs)
+        self.lags = {}
+        self.checks = 0
+
+    def get_lag(self, database):
+        self.checks += 1
+        return self.lags.get(database)
+
+
+def test_read_database():
+    router = FakeRouter("primary", ["r1", "r2"], max_lag=5, check_interval=60)
+    router.lags = {"r1": 0, "r2": 3}
+
+    # readonly范围外都走主库
+    assert router.read_database() == "primary"
+
+    with router.readonly():
+        assert [router.read_database() for i in range(4)] == ["r1", "r2", "r1", "r2"]
+        with router.readonly(False):     # 嵌套不会关掉只读
+            assert router.read_database() in ("r1", "r2")
+    assert router.read_database() == "primary"
+
+    # 延迟检查结果有缓存
+    assert router.checks == 2
+
+    # 延迟过大、复制中断的从库不用，都不可用时退回主库
+    router.reset()
+    router.lags = {"r1": 10, "r2": None}
+    with router.readonly():
+        assert router.read_database() == "primary"
+
+    router.reset()
+    router.lags = {"r1": 10, "r2": 1}
+    with router.readonly():
+        assert set(router.read_database() for i in range(4)) == set(["r2"])
+
+
+def test_model_select():
+    replica = M.SqliteDatabase(":memory:")
+    router = M.router
+    origin = router.replicas, router.get_lag
+    router.replicas = [replica]
+    router.get_lag = lambda database: 0
+    try:
+        with router.readonly():
+            assert M.Item.select().database is replica
+            assert M.Item.select().where(M.Item.id == 1).clone().database is replica
+            assert M.Item.raw("SELECT * FROM item").database is replica
+        assert M.Item.select().database is M.db
+        assert M.Item.update(name="x").database is M.db
+    finally:
+        router.replicas, router.get_lag = origin
+        router.reset()
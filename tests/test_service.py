@@ -114,3 +114,126 @@ def test_supplyer(invbox):
     assert res["items"][1]["name"] == adds[1]["name"]
     assert res["items"][0]["mobile"] == adds[0]["mobile"]
     assert res["items"][1]["mobile"] == "13064754339"
+
+
+def test_item_list_queries(invbox):
+    """
+    商品、品牌列表每页的查询数与条数无关，商品数随增删改更新
+    """
+    import models as M
+    from playhouse.test_utils import count_queries
+
+    images = [M.Image.create(md5="item-%s" % i, url="/media/image/%s.png" % i)
+              for i in range(3)]
+    category = M.ItemCategory.create(name="卫生巾", thumbnail=images[0], image=images[1])
+    brand = M.ItemBrand.create(name="In-V")
+    for i in range(6):
+        res = invbox.add_item("商品%s" % i, "", category.id, brand.id,
+                              [images[2].id], 100, 80)
+        assert res["resultCode"] == 0
+
+    with count_queries() as counter:
+        res = invbox.get_items(page=1, page_size=5)
+    assert len(res["items"]) == 5
+    assert res["items"][0]["category"]["itemCount"] == 6
+    assert res["items"][0]["brand"]["itemCount"] == 6
+    assert len(res["items"][0]["thumbnails"]) == 1
+    assert counter.count == 4
+
+    with count_queries() as counter:
+        res = invbox.get_brands(page=1, page_size=5)
+    assert res["items"][0]["itemCount"] == 6
+    assert counter.count == 2
+
+    invbox.delete_items([res["id"] for res in invbox.get_items(page_size=2)["items"]])
+    assert M.ItemCategory.get(id=category.id).item_count == 4
+    assert M.ItemBrand.get(id=brand.id).item_count == 4
+
+
+def test_activity_list_queries(invbox):
+    """
+    兑换码、口令活动列表：每页固定3条查询（总数、列表、分组统计）
+    """
+    import models as M
+    from datetime import datetime as dte, timedelta
+    from const import RedeemStatus
+    from playhouse.test_utils import count_queries
+
+    item = M.Item.select().first()
+    user_group = M.UserGroup.create(name="全部用户")
+    device_group = M.DeviceGroup.create(name="全部设备")
+    device = M.Device.create(no="activity-1", name="activity-1",
+                             category=M.DeviceCategory.create(name="activity"))
+    start_at, end_at = dte.now(), dte.now() + timedelta(days=10)
+    for i in range(4):
+        ra = M.RedeemActivity.create(name="兑换活动%s" % i, item=item, user_group=user_group,
+                                     valid_start_at=start_at, valid_end_at=end_at)
+        va = M.VoiceActivity.create(code="口令%s" % i, item=item, device_group=device_group,
+                                    valid_start_at=start_at, valid_end_at=end_at, limit=10)
+        for j in range(i):
+            M.Redeem.create(code="%s%s" % (i, j), activity=ra,
+                            status=RedeemStatus.USED if j % 2 else RedeemStatus.UNUSE)
+            M.VoiceWord.create(activity=va, device=device, status=RedeemStatus.USED)
+
+    with count_queries() as counter:
+        res = invbox.get_redeem_activities(page=1, page_size=10)
+    assert counter.count == 3
+    stats = dict((d["name"], (d["total"], d["used"])) for d in res["items"])
+    assert stats[u"兑换活动3"] == (3, 1)
+    assert stats[u"兑换活动0"] == (0, 0)
+
+    with count_queries() as counter:
+        res = invbox.get_voice_activities(page=1, page_size=10)
+    assert counter.count == 3
+    stats = dict((d["code"], (d["total"], d["used"])) for d in res["items"])
+    assert stats[u"口令2"] == (2, 2)
+
+
+def test_rpc_metrics(invbox):
+    """
+    RPC指标：调用次数、SQL条数、Prometheus输出
+    """
+    from util import metrics
+
+    metrics.reset()
+    invbox.get_brands(page=1, page_size=5)
+    invbox.get_brands(page=1, page_size=5)
+
+    stats = metrics.get_stats("get_brands")
+    assert stats.wall.count == 2
+    assert stats.sql.sum == 4
+    assert stats.redis.sum == 0
+    assert 'invbox_rpc_sql_statements_count{rpc="get_brands"} 2' in metrics.render()
+    assert metrics.summary()["get_brands"]["avg_sql"] == 2
+
+
+def test_log_metrics_slow_rpc(invbox):
+    """
+    耗时超过最大分桶的RPC，定时指标日志照常输出
+    """
+    from util import metrics
+    from service import base
+
+    class ListHandler(logging.Handler):
+
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    metrics.reset()
+    metrics._record(metrics.Tracker("slow_rpc"), 12)
+    assert metrics.summary()["slow_rpc"]["p99"] == metrics.TIME_BUCKETS[-1] * 1000
+
+    handler = ListHandler()
+    level = base.logger.level
+    base.logger.addHandler(handler)
+    base.logger.setLevel(logging.INFO)
+    try:
+        invbox.log_metrics()
+    finally:
+        base.logger.removeHandler(handler)
+        base.logger.setLevel(level)
+    assert any('"slow_rpc"' in msg for msg in handler.messages)
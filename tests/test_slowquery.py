@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+慢查询记录
+"""
+import logging
+import pytest
+import peewee as pw
+import models as M
+
+from util import metrics
+from util import slowquery
+from util.slowquery import fingerprint, SlowQueryRecorder
+
+pytestmark = pytest.mark.usefixtures("init_db")
+
+
+def test_fingerprint():
+    fp = fingerprint("SELECT * FROM t WHERE a = 'x''y' AND b IN (%s, %s, %s) AND c > 10")
+    assert fp == "SELECT * FROM t WHERE a = ? AND b IN (?+) AND c > ?"
+    assert fingerprint("SELECT * FROM t WHERE b IN (?)") == "SELECT * FROM t WHERE b IN (?+)"
+
+
+def test_recorder():
+    recorder = SlowQueryRecorder(M.db, threshold=0)
+    M.db.sql_hooks.append(recorder)
+    try:
+        with metrics.track("get_orders"):
+            for ids in ([1], [1, 2, 3]):
+                list(M.Order.select().where(M.Order.status.in_(ids)))
+    finally:
+        M.db.sql_hooks.remove(recorder)
+
+    report = recorder.report()
+    assert len(report) == 1
+    assert report[0]["count"] == 2
+    assert report[0]["rpcs"] == {"get_orders": 2}
+    assert report[0]["explain"]
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_recorder_replica():
+    replica = M.SqliteDatabase(":memory:")
+    replica.execute_sql("CREATE TABLE only_on_replica (id INTEGER PRIMARY KEY)")
+    recorder = SlowQueryRecorder(M.db, threshold=0)
+    replica.sql_hooks.append(recorder.for_database(replica))
+    replica.execute_sql("SELECT * FROM only_on_replica WHERE id = ?", (1, ))
+
+    # 在执行SQL的从库上EXPLAIN，主库没有这张表
+    report = recorder.report()
+    assert report[0]["fingerprint"] == "SELECT * FROM only_on_replica WHERE id = ?"
+    assert report[0]["explain"]
+
+
+def test_recorder_skip():
+    recorder = SlowQueryRecorder(M.db, threshold=0)
+    handler = ListHandler()
+    M.db.sql_hooks.append(recorder)
+    slowquery.logger.addHandler(handler)
+    try:
+        list(M.SMSHistory.select().where(M.SMSHistory.mobile == "13064754229"))
+        # 执行失败的不算慢查询
+        with pytest.raises(pw.OperationalError):
+            M.db.execute_sql("SELECT * FROM not_exists WHERE id = ?", (1, ))
+    finally:
+        M.db.sql_hooks.remove(recorder)
+        slowquery.logger.removeHandler(handler)
+
+    report = recorder.report()
+    assert len(report) == 1 and "not_exists" not in report[0]["sample"]
+    # 日志里不记参数
+    assert len(handler.messages) == 1
+    assert "13064754229" not in handler.messages[0]
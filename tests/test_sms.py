@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+短信发件箱
+"""
+import pytest
+import ujson as json
+import models as M
+
+from datetime import datetime as dte, timedelta
+from concurrent.futures import Future
+from const import SMSStatus
+from sms import outbox
+from sms.helper import SMSHelper, LOGIN_VALID_CODE, REDEEM_CREATE_CODE
+
+pytestmark = pytest.mark.usefixtures("init_db")
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """
+    记录批量发送接口的调用，按模板返回responses里的结果
+    """
+    calls = []
+    responses = {}
+
+    def submit_batch_sms(phone_numbers, sign_names, template_code, template_params):
+        calls.append((template_code, phone_numbers, template_params))
+        future = Future()
+        response = responses[template_code]
+        if callable(response):
+            response = response(phone_numbers)
+        if isinstance(response, Exception):
+            future.set_exception(response)
+        else:
+            future.set_result(json.dumps(response))
+        return future
+
+    monkeypatch.setattr(outbox.alisms, "submit_batch_sms", submit_batch_sms)
+    monkeypatch.setattr(outbox, "limiter", outbox.RateLimiter(1000))
+    return calls, responses
+
+
+def test_send_pending(sent):
+    calls, responses = sent
+    helper = SMSHelper()
+    for i in range(3):
+        obj = helper._send_sms("1306475420%s" % i, LOGIN_VALID_CODE, {"code": "00000%s" % i})
+        assert obj.status == SMSStatus.READY
+    helper._send_sms("13064754210", REDEEM_CREATE_CODE, {"code": "abc"})
+
+    responses[LOGIN_VALID_CODE] = {"Code": "OK", "BizId": "biz-1"}
+    responses[REDEEM_CREATE_CODE] = {"Code": "isp.SYSTEM_ERROR", "Message": "system error"}
+    assert outbox.send_pending() == {"sent": 3, "failed": 1}
+
+    # 同模板合并成一次调用
+    assert sorted(len(c[1]) for c in calls) == [1, 3]
+    assert set(o.biz_id for o in M.SMSHistory.select()
+                                             .where(M.SMSHistory.status == SMSStatus.OK)) == \
+        set(["biz-1"])
+
+    # 失败的等重试时间到了才会再发
+    assert outbox.send_pending() == {"sent": 0, "failed": 0}
+    failed = M.SMSHistory.get(tplcode=REDEEM_CREATE_CODE)
+    assert (failed.status, failed.retries) == (SMSStatus.READY, 1)
+
+
+def test_batch_error(sent):
+    calls, responses = sent
+    M.SMSHistory.delete().execute()
+    helper = SMSHelper()
+    helper._send_sms("13064754220", LOGIN_VALID_CODE, {"code": "000000"})
+    helper._send_sms("13064754221", REDEEM_CREATE_CODE, {"code": "abc"})
+
+    # 一批请求出错不影响其它批
+    responses[LOGIN_VALID_CODE] = IOError("timed out")
+    responses[REDEEM_CREATE_CODE] = {"Code": "OK", "BizId": "biz-2"}
+    assert outbox.send_pending() == {"sent": 1, "failed": 1}
+    failed = M.SMSHistory.get(tplcode=LOGIN_VALID_CODE)
+    assert (failed.status, failed.error) == (SMSStatus.READY, "timed out")
+    assert M.SMSHistory.get(tplcode=REDEEM_CREATE_CODE).status == SMSStatus.OK
+
+
+def test_business_error(sent):
+    calls, responses = sent
+    M.SMSHistory.delete().execute()
+    helper = SMSHelper()
+    bad = "1306475423"
+    for i in range(4):
+        helper._send_sms("1306475423%s" % i if i else bad, LOGIN_VALID_CODE, {"code": "00000%s" % i})
+    helper._send_sms("13064754239", REDEEM_CREATE_CODE, {"code": "abc"})
+
+    # 一个非法号码导致整批被拒，拆开重发后其它号码照常发出
+    responses[LOGIN_VALID_CODE] = lambda phones: \
+        {"Code": "isv.MOBILE_NUMBER_ILLEGAL", "Message": "illegal"} if bad in phones else \
+        {"Code": "OK", "BizId": "biz-%s" % len(phones)}
+    responses[REDEEM_CREATE_CODE] = {"Code": "isv.BUSINESS_LIMIT_CONTROL", "Message": "limit"}
+    assert outbox.send_pending() == {"sent": 3, "failed": 2}
+    assert [len(c[1]) for c in calls if c[0] == LOGIN_VALID_CODE] == [4, 2, 2, 1, 1]
+
+    # 业务错误不重试
+    failed = M.SMSHistory.select().where(M.SMSHistory.status == SMSStatus.FAIL)
+    assert sorted((o.mobile, o.retries) for o in failed) == [(bad, 0), ("13064754239", 0)]
+    assert M.SMSHistory.select().where(M.SMSHistory.status == SMSStatus.OK).count() == 3
+
+
+def test_account_error(sent):
+    calls, responses = sent
+    M.SMSHistory.delete().execute()
+    helper = SMSHelper()
+    for i in range(4):
+        helper._send_sms("1306475424%s" % i, LOGIN_VALID_CODE, {"code": "00000%s" % i})
+    helper._send_sms("13064754249", REDEEM_CREATE_CODE, {"code": "abc"})
+
+    # 余额不足、模板不合法不拆批，整批按退避时间重试
+    responses[LOGIN_VALID_CODE] = {"Code": "isv.AMOUNT_NOT_ENOUGH", "Message": "amount"}
+    responses[REDEEM_CREATE_CODE] = {"Code": "isv.SMS_TEMPLATE_ILLEGAL", "Message": "template"}
+    assert outbox.send_pending() == {"sent": 0, "failed": 5}
+    assert sorted(len(c[1]) for c in calls) == [1, 4]
+    assert sorted((o.status, o.retries) for o in M.SMSHistory.select()) == \
+        [(SMSStatus.READY, 1)] * 5
+
+
+def test_retry():
+    M.SMSHistory.delete().execute()
+    obj = SMSHelper()._send_sms("13064754229", LOGIN_VALID_CODE, {"code": "123456"})
+
+    now = dte.now()
+    for i in range(outbox.MAX_RETRIES + 1):
+        claimed = outbox.claim_pending(now=now)
+        assert [o.id for o in claimed] == [obj.id]
+        # 取出后不会被重复取出
+        assert outbox.claim_pending(now=now) == []
+
+        outbox.mark_result(claimed, False, "timeout", now=now)
+        obj = M.SMSHistory.get(id=obj.id)
+        now = obj.send_at
+    assert (obj.status, obj.retries, obj.error) == (SMSStatus.FAIL, outbox.MAX_RETRIES, "timeout")
+    assert outbox.claim_pending(now=now + timedelta(days=1)) == []
+
+
+def test_reclaim():
+    M.SMSHistory.delete().execute()
+    obj = SMSHelper()._send_sms("13064754229", LOGIN_VALID_CODE, {"code": "123456"})
+    assert outbox.claim_pending()
+
+    # 发送中断的到期后重新取出
+    later = dte.now() + timedelta(seconds=outbox.CLAIM_SECONDS + 1)
+    assert [o.id for o in outbox.claim_pending(now=later)] == [obj.id]
+
+
+def test_reconcile(monkeypatch):
+    from sms import receipt
+    from const import SMSReceipt
+
+    M.SMSHistory.delete().execute()
+    helper = SMSHelper()
+    objs = [helper._send_sms("13064754229", LOGIN_VALID_CODE, {"code": "00000%s" % i})
+            for i in range(3)]
+    other = helper._send_sms("13064754220", LOGIN_VALID_CODE, {"code": "123456"})
+    M.SMSHistory.update(status=SMSStatus.OK, biz_id="biz-1").execute()
+
+    send_date = dte.now().strftime("%Y-%m-%d %H:%M:%S")
+    status = {"13064754229": [SMSReceipt.DELIVERED, SMSReceipt.FAIL, SMSReceipt.WAITING],
+              "13064754220": [SMSReceipt.DELIVERED]}
+    queries = []
+
+    def query_send_detail(biz_id, phone_number, page_size, current_page, send_date_):
+        queries.append((phone_number, current_page))
+        details = [{"PhoneNum": phone_number, "TemplateCode": LOGIN_VALID_CODE,
+                    "SendDate": send_date, "SendStatus": s, "Content": "content-%s" % i}
+                   for i, s in enumerate(status[phone_number])]
+        return json.dumps({"Code": "OK", "TotalCount": len(details),
+                           "SmsSendDetailDTOs": {"SmsSendDetailDTO": details}})
+
+    monkeypatch.setattr(receipt.alisms, "query_send_detail", query_send_detail)
+    monkeypatch.setattr(receipt, "limiter", outbox.RateLimiter(1000))
+
+    # 每个号码查一次
+    assert receipt.reconcile() == {"groups": 2, "updated": 4, "final": 3}
+    assert sorted(queries) == [("13064754220", 1), ("13064754229", 1)]
+    assert [M.SMSHistory.get(id=o.id).receipt for o in objs] == status["13064754229"]
+    assert M.SMSHistory.get(id=objs[0].id).content == "content-0"
+
+    # 到了最终状态的不再查询
+    del queries[:]
+    status["13064754229"] = [SMSReceipt.DELIVERED]
+    assert receipt.reconcile()["groups"] == 1
+    assert queries == [("13064754229", 1)]
+    assert M.SMSHistory.get(id=other.id).receipt == SMSReceipt.DELIVERED
+
+
+def test_reconcile_same_day(monkeypatch):
+    from sms import receipt
+    from const import SMSReceipt
+
+    M.SMSHistory.delete().execute()
+    helper = SMSHelper()
+    now = dte.now().replace(microsecond=0)
+    midnight = now.replace(hour=0, minute=0, second=0)
+
+    # 第一条已经对完账，30秒后重发的验证码还没有回执
+    first = helper._send_sms("13064754229", LOGIN_VALID_CODE, {"code": "000001"})
+    resent = helper._send_sms("13064754229", LOGIN_VALID_CODE, {"code": "000002"})
+    M.SMSHistory.update(status=SMSStatus.OK, send_at=midnight + timedelta(hours=1)) \
+                .where(M.SMSHistory.id == first.id).execute()
+    M.SMSHistory.update(receipt=SMSReceipt.DELIVERED, content="content-1") \
+                .where(M.SMSHistory.id == first.id).execute()
+    M.SMSHistory.update(status=SMSStatus.OK, send_at=midnight + timedelta(hours=1, seconds=30)) \
+                .where(M.SMSHistory.id == resent.id).execute()
+    # 前一天创建、过了零点才发出的按发出的日期查
+    late = helper._send_sms("13064754220", LOGIN_VALID_CODE, {"code": "000003"})
+    M.SMSHistory.update(status=SMSStatus.OK, created_at=midnight - timedelta(minutes=1),
+                        send_at=midnight + timedelta(minutes=1)) \
+                .where(M.SMSHistory.id == late.id).execute()
+    # 一直对不上的
+    lost = helper._send_sms("13064754221", LOGIN_VALID_CODE, {"code": "000004"})
+    M.SMSHistory.update(status=SMSStatus.OK, send_at=now).where(M.SMSHistory.id == lost.id).execute()
+
+    def detail(send_at, status, content):
+        return {"TemplateCode": LOGIN_VALID_CODE, "SendDate": send_at.strftime("%Y-%m-%d %H:%M:%S"),
+                "SendStatus": status, "Content": content}
+
+    details = {
+        "13064754229": [detail(midnight + timedelta(hours=1, seconds=1), SMSReceipt.DELIVERED,
+                               "content-1"),
+                        detail(midnight + timedelta(hours=1, seconds=31), SMSReceipt.FAIL,
+                               "content-2")],
+        "13064754220": [detail(midnight + timedelta(minutes=1), SMSReceipt.DELIVERED,
+                               "content-3")],
+        "13064754221": [],
+    }
+    queries = []
+
+    def query_send_detail(biz_id, phone_number, page_size, current_page, send_date):
+        queries.append((phone_number, send_date))
+        items = details[phone_number]
+        return json.dumps({"Code": "OK", "TotalCount": len(items),
+                           "SmsSendDetailDTOs": {"SmsSendDetailDTO": items}})
+
+    monkeypatch.setattr(receipt.alisms, "query_send_detail", query_send_detail)
+    monkeypatch.setattr(receipt, "limiter", outbox.RateLimiter(1000))
+
+    assert receipt.reconcile(now) == {"groups": 3, "updated": 2, "final": 2}
+    assert ("13064754220", midnight.strftime("%Y%m%d")) in queries
+    obj = M.SMSHistory.get(id=resent.id)
+    assert (obj.receipt, obj.content) == (SMSReceipt.FAIL, "content-2")
+    assert M.SMSHistory.get(id=late.id).receipt == SMSReceipt.DELIVERED
+
+    # 连续MAX_CHECKS次没对上的不再查询
+    for i in range(receipt.MAX_CHECKS - 1):
+        assert receipt.reconcile(now)["groups"] == 1
+    assert M.SMSHistory.get(id=lost.id).receipt_checks == receipt.MAX_CHECKS
+    assert receipt.reconcile(now)["groups"] == 0
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+关联id和耗时分段
+"""
+import pytest
+import threading
+
+from util import trace
+
+
+class FakeEntrypoint(object):
+    method_name = "create_order"
+
+
+class FakeWorkerContext(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.entrypoint = FakeEntrypoint()
+
+
+@pytest.fixture
+def flushed(monkeypatch):
+    spans = []
+    monkeypatch.setattr(trace, "flush", spans.extend)
+    monkeypatch.setattr(trace, "thread_call_out", lambda func, *args: func(*args))
+    return spans
+
+
+def test_correlation(flushed):
+    provider = trace.Correlation()
+
+    # 调用头带了关联id就沿用
+    worker_ctx = FakeWorkerContext({trace.CONTEXT_KEY: "abc"})
+    provider.worker_setup(worker_ctx)
+    assert provider.get_dependency(worker_ctx)() == "abc"
+    provider.worker_teardown(worker_ctx)
+    assert trace.current() is None
+    # 没有记录分段时不写入
+    assert flushed == []
+
+    # 没有则新生成，并写回调用头
+    worker_ctx = FakeWorkerContext({})
+    provider.worker_setup(worker_ctx)
+    cid = trace.current_id()
+    assert cid and worker_ctx.data[trace.CONTEXT_KEY] == cid
+    provider.worker_teardown(worker_ctx)
+
+
+def test_span(flushed):
+    @trace.traced("pay.precreate")
+    def precreate(fail):
+        if fail:
+            raise IOError("timeout")
+        return "ok"
+
+    # 不在上下文里时不记录
+    assert precreate(False) == "ok"
+
+    with trace.scope("abc", "create_order") as context:
+        context.order_no = "20180701000001"
+        precreate(False)
+        with pytest.raises(IOError):
+            precreate(True)
+
+    assert [s["name"] for s in flushed] == ["pay.precreate", "pay.precreate", "rpc.create_order"]
+    assert all(s["cid"] == "abc" and s["order_no"] == "20180701000001" for s in flushed)
+    assert [s.get("error", False) for s in flushed] == [False, True, False]
+    assert flushed[-1]["ms"] >= flushed[0]["ms"]
+
+
+def test_flush_in_background(monkeypatch):
+    gate, done = threading.Event(), threading.Event()
+    flushed = []
+
+    def flush(spans):
+        gate.wait(1)
+        flushed.extend(s["name"] for s in spans)
+        done.set()
+
+    monkeypatch.setattr(trace, "flush", flush)
+    with trace.scope("abc", "create_order"):
+        with trace.span("pay.precreate"):
+            pass
+
+    # 分段由后台执行器写入，worker结束时不用等Redis
+    assert flushed == []
+    gate.set()
+    assert done.wait(1)
+    assert flushed == ["pay.precreate", "rpc.create_order"]
@@ -2,9 +2,7 @@
 import hashlib
 
 from lxml import etree
-from concurrent.futures import ThreadPoolExecutor
-
-_executor = ThreadPoolExecutor(4)
+from config import config
 
 
 def md5(text):
@@ -29,5 +27,13 @@ def dict_to_xml(data):
     return s.encode("utf-8")
 
 
+def _default_executor():
+    from util.executor import get_executor
+    return get_executor("default",
+                        workers=config.executor_workers,
+                        queue_size=config.executor_queue_size)
+
+
 def thread_call_out(func, *args, **kwargs):
-    _executor.submit(func, *args, **kwargs)
+    "后台执行，返回Future；队列满时抛util.executor.QueueFull"
+    return _default_executor().submit(func, *args, **kwargs)
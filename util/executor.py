@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""
+后台任务执行器
+
+固定数量的工作线程 + 有界队列：队列满时submit最多等待submit_timeout秒，
+仍然满就抛QueueFull，由调用方决定丢弃还是同步执行，不会无限堆积。
+
+call_later的延迟任务放在一个最小堆里，由单独的调度线程在到期时才放进队列，
+等待期间不占用工作线程。
+
+每个任务返回Future，异常会记日志并计数；队列长度、等待耗时、执行耗时等
+通过util.metrics的gauge输出。
+"""
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+from Queue import Queue, Full
+from concurrent.futures import Future
+from util import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Task(object):
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.submitted_at = time.time()
+
+    @property
+    def name(self):
+        return getattr(self.func, "__name__", repr(self.func))
+
+
+class BoundedExecutor(object):
+    """
+    workers: 工作线程数；queue_size: 待执行队列上限；delay_size: 延迟任务上限
+    """
+
+    def __init__(self, name, workers=4, queue_size=1000, delay_size=10000, submit_timeout=1):
+        self.name = name
+        self.workers = workers
+        self.delay_size = delay_size
+        self.submit_timeout = submit_timeout
+        self._queue = Queue(queue_size)
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._started = False
+        self._start_lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.wait_time = metrics.Histogram(metrics.TIME_BUCKETS)
+        self.run_time = metrics.Histogram(metrics.TIME_BUCKETS)
+
+    def _start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            for i in range(self.workers):
+                self._spawn(self._work, "%s-worker-%s" % (self.name, i))
+            self._spawn(self._schedule, "%s-scheduler" % self.name)
+            self._started = True
+
+    def _spawn(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        提交任务，返回Future；队列满且等待submit_timeout秒后仍满时抛QueueFull
+        """
+        self._start()
+        task = _Task(func, args, kwargs)
+        try:
+            self._queue.put(task, timeout=self.submit_timeout)
+        except Full:
+            self.rejected += 1
+            logger.warning("[executor] %s queue full, reject %s", self.name, task.name)
+            raise QueueFull("%s queue full" % self.name)
+        self.submitted += 1
+        return task.future
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """
+        delay秒后执行，返回Future；延迟任务数超过上限时抛QueueFull
+        """
+        self._start()
+        task = _Task(func, args, kwargs)
+        with self._cond:
+            if len(self._delayed) >= self.delay_size:
+                self.rejected += 1
+                raise QueueFull("%s delay queue full" % self.name)
+            heapq.heappush(self._delayed, (time.time() + delay, next(self._seq), task))
+            self._cond.notify()
+        return task.future
+
+    def _schedule(self):
+        while True:
+            with self._cond:
+                while not self._delayed or self._delayed[0][0] > time.time():
+                    timeout = self._delayed[0][0] - time.time() if self._delayed else None
+                    self._cond.wait(timeout)
+                _, _, task = heapq.heappop(self._delayed)
+            task.submitted_at = time.time()
+            try:
+                self._queue.put(task, timeout=self.submit_timeout)
+                self.submitted += 1
+            except Full:
+                self.rejected += 1
+                logger.warning("[executor] %s queue full, drop delayed %s", self.name, task.name)
+                task.future.set_exception(QueueFull("%s queue full" % self.name))
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if not task.future.set_running_or_notify_cancel():
+                continue
+
+            begin = time.time()
+            self.wait_time.observe(begin - task.submitted_at)
+            try:
+                result = task.func(*task.args, **task.kwargs)
+            except Exception as e:
+                self.errors += 1
+                logger.exception("[executor] %s task %s error", self.name, task.name)
+                task.future.set_exception(e)
+            else:
+                task.future.set_result(result)
+            finally:
+                self.completed += 1
+                self.run_time.observe(time.time() - begin)
+
+    @staticmethod
+    def _avg_ms(hist):
+        return round(hist.sum * 1000 / hist.count, 2) if hist.count else 0
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "delayed": len(self._delayed),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "wait_avg_ms": self._avg_ms(self.wait_time),
+            "run_avg_ms": self._avg_ms(self.run_time),
+        }
+
+
+_executors = {}
+
+
+def get_executor(name="default", **kwargs):
+    """
+    按名字共享的执行器，第一次获取时创建
+    """
+    if name not in _executors:
+        _executors[name] = BoundedExecutor(name, **kwargs)
+    return _executors[name]
+
+
+metrics.register_gauges("executor", "executor",
+                        lambda: dict((name, e.stats()) for name, e in _executors.items()))
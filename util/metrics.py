@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+RPC性能指标
+
+rpc/transaction_rpc装饰器用track()包住每次调用，调用期间的SQL、Redis、HTTP
+请求通过钩子累加到当前调用上，结束后按RPC名字记入直方图。
+
+指标在进程内累计，render()输出Prometheus文本格式供抓取，summary()输出
+每个RPC的调用数、分位耗时和平均SQL条数，用于定时打日志。
+"""
+import time
+import bisect
+import logging
+import threading
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 耗时分桶，单位秒
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 次数分桶
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {}
+_gauges = []
+
+
+class Histogram(object):
+    """
+    累计直方图，counts[i]为落在(buckets[i-1], buckets[i]]的次数，最后一个为+Inf
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        分位数的估计值：所在分桶的上界；落在+Inf桶的取最后一个分桶的上界，
+        避免inf在日志里json序列化失败
+        """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        acc = 0
+        for i, cnt in enumerate(self.counts):
+            acc += cnt
+            if acc >= rank:
+                return self.buckets[min(i, len(self.buckets) - 1)]
+
+    def cumulative(self):
+        res, acc = [], 0
+        for i, cnt in enumerate(self.counts):
+            acc += cnt
+            res.append((self.buckets[i] if i < len(self.buckets) else "+Inf", acc))
+        return res
+
+
+class RpcStats(object):
+    """
+    单个RPC的累计指标
+    """
+
+    def __init__(self):
+        self.errors = 0
+        self.wall = Histogram(TIME_BUCKETS)
+        self.db_time = Histogram(TIME_BUCKETS)
+        self.sql = Histogram(COUNT_BUCKETS)
+        self.redis = Histogram(COUNT_BUCKETS)
+        self.http = Histogram(COUNT_BUCKETS)
+        self.http_time = Histogram(TIME_BUCKETS)
+
+    def histograms(self):
+        return [
+            ("rpc_seconds", self.wall),
+            ("rpc_db_seconds", self.db_time),
+            ("rpc_sql_statements", self.sql),
+            ("rpc_redis_calls", self.redis),
+            ("rpc_http_calls", self.http),
+            ("rpc_http_seconds", self.http_time),
+        ]
+
+
+class Tracker(object):
+    """
+    一次RPC调用期间的计数
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.error = False
+        self.db_time = 0
+        self.sql_count = 0
+        self.redis_count = 0
+        self.http_count = 0
+        self.http_time = 0
+
+
+def current():
+    """
+    当前协程正在执行的RPC，没有则返回None
+    """
+    return getattr(_local, "tracker", None)
+
+
+@contextmanager
+def track(name):
+    """
+    统计一次RPC调用；嵌套调用只记最外层
+    """
+    if current() is not None:
+        yield current()
+        return
+
+    tracker = _local.tracker = Tracker(name)
+    try:
+        yield tracker
+    except Exception:
+        tracker.error = True
+        raise
+    finally:
+        _local.tracker = None
+        _record(tracker, time.time() - tracker.start)
+
+
+def _record(tracker, wall):
+    with _lock:
+        stats = _stats.get(tracker.name)
+        if stats is None:
+            stats = _stats[tracker.name] = RpcStats()
+        stats.wall.observe(wall)
+        stats.db_time.observe(tracker.db_time)
+        stats.sql.observe(tracker.sql_count)
+        stats.redis.observe(tracker.redis_count)
+        stats.http.observe(tracker.http_count)
+        stats.http_time.observe(tracker.http_time)
+        if tracker.error:
+            stats.errors += 1
+
+
+def on_sql(sql, params, seconds):
+    tracker = current()
+    if tracker is not None:
+        tracker.sql_count += 1
+        tracker.db_time += seconds
+
+
+def on_redis(seconds):
+    tracker = current()
+    if tracker is not None:
+        tracker.redis_count += 1
+
+
+def on_http(seconds):
+    tracker = current()
+    if tracker is not None:
+        tracker.http_count += 1
+        tracker.http_time += seconds
+
+
+def patch_http():
+    """
+    给httplib加钩子，统计出站HTTP请求（requests和阿里云SDK都基于httplib）
+
+    耗时从发出请求算到收到响应头
+    """
+    import httplib
+    cls = httplib.HTTPConnection
+    if getattr(cls, "_metrics_patched", False):
+        return
+
+    origin_request = cls.request
+    origin_getresponse = cls.getresponse
+
+    def request(self, *args, **kwargs):
+        self._metrics_start = time.time()
+        return origin_request(self, *args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        try:
+            return origin_getresponse(self, *args, **kwargs)
+        finally:
+            start = getattr(self, "_metrics_start", None)
+            if start is not None:
+                self._metrics_start = None
+                on_http(time.time() - start)
+
+    cls.request = request
+    cls.getresponse = getresponse
+    cls._metrics_patched = True
+
+
+def register_gauges(name, label, func):
+    """
+    登记一组瞬时指标，func()返回{label值: {指标名: 数值}}，
+    输出为invbox_<name>_<指标名>{<label>="label值"}
+    """
+    _gauges.append((name, label, func))
+
+
+def collect_gauges():
+    res = {}
+    for name, label, func in _gauges:
+        try:
+            res[name] = func()
+        except Exception:
+            logger.exception("collect gauges %s error", name)
+    return res
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def get_stats(name):
+    return _stats.get(name)
+
+
+def render():
+    """
+    Prometheus文本格式
+    """
+    lines = []
+    with _lock:
+        items = sorted(_stats.items())
+        for metric, _ in RpcStats().histograms():
+            lines.append("# TYPE invbox_%s histogram" % metric)
+            for name, stats in items:
+                hist = dict(stats.histograms())[metric]
+                for le, acc in hist.cumulative():
+                    lines.append('invbox_%s_bucket{rpc="%s",le="%s"} %s' % (metric, name, le, acc))
+                lines.append('invbox_%s_sum{rpc="%s"} %s' % (metric, name, hist.sum))
+                lines.append('invbox_%s_count{rpc="%s"} %s' % (metric, name, hist.count))
+        lines.append("# TYPE invbox_rpc_errors_total counter")
+        for name, stats in items:
+            lines.append('invbox_rpc_errors_total{rpc="%s"} %s' % (name, stats.errors))
+
+    gauges = collect_gauges()
+    for name, label, _ in _gauges:
+        values = sorted(gauges.get(name, {}).items())
+        fields = sorted(set(m for _, data in values for m in data))
+        for metric in fields:
+            lines.append("# TYPE invbox_%s_%s gauge" % (name, metric))
+            for key, data in values:
+                if metric in data:
+                    lines.append('invbox_%s_%s{%s="%s"} %s' % (name, metric, label, key, data[metric]))
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """
+    每个RPC的调用数、错误数、p50/p95/p99耗时(ms)、平均SQL条数/DB耗时/Redis/HTTP次数
+    """
+    res = {}
+    with _lock:
+        for name, stats in _stats.items():
+            calls = stats.wall.count
+            if not calls:
+                continue
+            res[name] = {
+                "calls": calls,
+                "errors": stats.errors,
+                "p50": stats.wall.quantile(0.5) * 1000,
+                "p95": stats.wall.quantile(0.95) * 1000,
+                "p99": stats.wall.quantile(0.99) * 1000,
+                "avg_ms": round(stats.wall.sum * 1000 / calls, 2),
+                "avg_db_ms": round(stats.db_time.sum * 1000 / calls, 2),
+                "avg_sql": round(float(stats.sql.sum) / calls, 2),
+                "avg_redis": round(float(stats.redis.sum) / calls, 2),
+                "avg_http": round(float(stats.http.sum) / calls, 2),
+            }
+    return res
@@ -1,23 +1,138 @@
 # -*- coding: utf-8 -*-
 
+import time
 import redis
+import logging
+
+from contextlib import contextmanager
+from redis.client import Pipeline as _Pipeline
 from config import config
+from util import metrics
+
+logger = logging.getLogger(__name__)
+
+_redis = None
+
+
+class ConnectionPool(redis.BlockingConnectionPool):
+    """
+    连接池满时等待空闲连接（最多timeout秒），而不是直接报错；
+    空闲超过health_check_interval秒的连接取出时先PING，失败的断开，执行命令时会自动重连
+    """
+
+    def __init__(self, health_check_interval=30, **kwargs):
+        self.health_check_interval = health_check_interval
+        super(ConnectionPool, self).__init__(**kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        connection = super(ConnectionPool, self).get_connection(command_name, *keys, **options)
+        last_used = getattr(connection, "last_used", None)
+        if last_used and time.time() - last_used > self.health_check_interval:
+            try:
+                connection.send_command("PING")
+                connection.read_response()
+            except (redis.ConnectionError, redis.TimeoutError):
+                logger.warning("[redis] stale connection, reconnect")
+                connection.disconnect()
+        return connection
+
+    def release(self, connection):
+        connection.last_used = time.time()
+        super(ConnectionPool, self).release(connection)
+
+    def pool_stats(self):
+        idle = sum(1 for c in list(self.pool.queue) if c is not None)
+        return {
+            "created": len(self._connections),
+            "idle": idle,
+            "in_use": len(self._connections) - idle,
+            "max": self.max_connections,
+        }
+
+
+class Pipeline(_Pipeline):
+    """
+    一次pipeline执行算一次Redis调用
+    """
+
+    def execute(self, raise_on_error=True):
+        begin = time.time()
+        try:
+            return super(Pipeline, self).execute(raise_on_error)
+        finally:
+            metrics.on_redis(time.time() - begin)
+
+
+class Redis(redis.Redis):
+    """
+    统计每次Redis命令
+    """
 
+    def execute_command(self, *args, **options):
+        begin = time.time()
+        try:
+            return super(Redis, self).execute_command(*args, **options)
+        finally:
+            metrics.on_redis(time.time() - begin)
 
-_redis_pool = None
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self.connection_pool, self.response_callbacks,
+                        transaction, shard_hint)
+
+
+def create_redis(conf):
+    pool = ConnectionPool(
+        host=conf["host"],
+        port=conf["port"],
+        db=conf["db"],
+        max_connections=conf.get("max_connections", 50),
+        timeout=conf.get("pool_timeout", 5),
+        socket_timeout=conf.get("socket_timeout", 5),
+        socket_connect_timeout=conf.get("socket_connect_timeout", 2),
+        socket_keepalive=True,
+        health_check_interval=conf.get("health_check_interval", 30),
+    )
+    return Redis(connection_pool=pool)
 
 
 def get_redis():
-    global _redis_pool
-    conf = config.redis
+    """
+    进程内共享的Redis客户端
+    """
+    global _redis
+
+    if _redis is None:
+        _redis = create_redis(config.redis)
+        metrics.register_gauges("redis_pool", "pool",
+                                lambda: {"default": _redis.connection_pool.pool_stats()})
+    return _redis
+
+
+@contextmanager
+def pipeline(transaction=False):
+    """
+    把多条命令合并成一次往返：
+
+        with pipeline() as pipe:
+            pipe.incr(key)
+            pipe.expire(key, 60)
+        count = pipe.results[0]
+    """
+    pipe = get_redis().pipeline(transaction=transaction)
+    yield pipe
+    pipe.results = pipe.execute()
+
 
-    if not _redis_pool:
-        _redis_pool = redis.ConnectionPool(
-            host=conf["host"],
-            port=conf["port"],
-        )
-    r = redis.Redis(connection_pool=_redis_pool, db=conf["db"])
-    return r
+def batch(commands, transaction=False):
+    """
+    批量执行[(命令名, 参数...), ...]，返回对应的结果列表
+    """
+    if not commands:
+        return []
+    pipe = get_redis().pipeline(transaction=transaction)
+    for command in commands:
+        getattr(pipe, command[0])(*command[1:])
+    return pipe.execute()
 
 
 class RedisKeys(object):
@@ -26,6 +141,18 @@ class RedisKeys(object):
 
     WECHAT_SMSCODE = "invbox:smswechat:%s"  # %s表示手机号码, 存验证码
 
-    TIMER_LOCK = "invbox:timerlock:%s"    # %s表示被装饰函数名字
+    TIMER_LEADER = "invbox:timerleader:%s"    # %s表示被装饰函数名字, 存领导者节点id和任期
+
+    TIMER_TERM = "invbox:timerterm:%s"        # %s表示被装饰函数名字, 领导者任期计数
+
+    TIMER_FIRED = "invbox:timerfired:%s"      # %s表示被装饰函数名字, 最近一次执行的时间点
+
+    CRON_FIRED = "invbox:cronfired:%s:%s"     # 被装饰函数名字和触发时间, 存执行的节点id
+
+    CRON_LAST = "invbox:cronlast:%s"          # %s表示被装饰函数名字, 最近一次触发时间
+
+    CRON_MISSED = "invbox:cronmissed:%s"      # %s表示被装饰函数名字, 错过的触发时间列表
+
+    TRACE_ORDER = "invbox:traceorder:%s"      # %s表示订单号, 存第一次处理该订单时的关联id
 
-    CRON_LOCK = "invbox:cronlock:%s"      # %s表示被装饰函数名字
+    TRACE_SPANS = "invbox:tracespans:%s"      # %s表示关联id, 耗时分段列表
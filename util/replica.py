@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+只读查询路由到从库
+
+readonly()范围内创建的SELECT查询按轮询分给从库，范围外以及所有写操作都走主库。
+选从库前先看复制延迟：SHOW SLAVE STATUS的Seconds_Behind_Master超过max_lag、
+复制中断或者连不上的从库暂时不用，检查结果缓存check_interval秒；
+没有可用从库时退回主库。
+"""
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaRouter(object):
+    """
+    primary: 主库；replicas: 从库列表；max_lag: 允许的最大复制延迟（秒）
+    """
+
+    def __init__(self, primary, replicas=(), max_lag=5, check_interval=10):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._status = {}       # 从库下标 -> (检查时间, 是否可用)
+        self._index = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def readonly(self, enabled=True):
+        """
+        范围内创建的查询可以走从库，可以嵌套
+        """
+        origin = getattr(self._local, "readonly", False)
+        self._local.readonly = origin or enabled
+        try:
+            yield
+        finally:
+            self._local.readonly = origin
+
+    def in_readonly(self):
+        return getattr(self._local, "readonly", False)
+
+    def read_database(self):
+        """
+        当前查询应该用的数据库
+        """
+        if not self.replicas or not self.in_readonly():
+            return self.primary
+
+        with self._lock:
+            start = self._index
+            self._index = (self._index + 1) % len(self.replicas)
+
+        for i in range(len(self.replicas)):
+            idx = (start + i) % len(self.replicas)
+            if self.is_available(idx):
+                return self.replicas[idx]
+        return self.primary
+
+    def is_available(self, idx):
+        now = time.time()
+        checked_at, ok = self._status.get(idx, (0, False))
+        if now - checked_at < self.check_interval:
+            return ok
+
+        lag = self.get_lag(self.replicas[idx])
+        ok = lag is not None and lag <= self.max_lag
+        if not ok:
+            logger.warning("[replica] replica %s unavailable, lag: %s", idx, lag)
+        self._status[idx] = (now, ok)
+        return ok
+
+    def get_lag(self, database):
+        """
+        从库复制延迟（秒），复制中断或者查询失败返回None
+        """
+        try:
+            cursor = database.get_cursor()
+            cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+            if not row:
+                return None
+            status = dict(zip([c[0] for c in cursor.description], row))
+            return status.get("Seconds_Behind_Master")
+        except Exception as e:
+            logger.warning("[replica] check lag failed: %s", e)
+            return None
+
+    def reset(self):
+        with self._lock:
+            self._status.clear()
+            self._index = 0
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+慢查询记录
+
+作为主库和各从库的sql hook，超过阈值的SQL记日志（耗时、所在RPC），并按指纹聚合：
+指纹是把字面量、参数占位符、IN列表归一化后的SQL，同一类查询只占一条记录。
+参数里有手机号、验证码等，日志里只记指纹，不记参数。
+SELECT语句每个指纹第一次出现时抓一次EXPLAIN，之后按比例抽样刷新；EXPLAIN在
+执行这条SQL的库上跑，从库的查询不会到主库上看执行计划。
+"""
+import re
+import time
+import random
+import logging
+import threading
+import peewee as pw
+
+from functools import partial
+from util import metrics
+
+logger = logging.getLogger(__name__)
+
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_RE_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_PARAM = re.compile(r"%s|\?")
+_RE_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_RE_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql):
+    """
+    SQL指纹：字面量和参数都换成?，IN (?, ?, ...)合并成IN (?+)
+    """
+    sql = _RE_STRING.sub("?", sql)
+    sql = _RE_NUMBER.sub("?", sql)
+    sql = _RE_PARAM.sub("?", sql)
+    sql = _RE_IN_LIST.sub("(?+)", sql)
+    return _RE_SPACE.sub(" ", sql).strip()
+
+
+class SlowQuery(object):
+    """
+    一类慢查询的聚合
+    """
+
+    def __init__(self, fp, sql):
+        self.fingerprint = fp
+        self.sample_sql = sql
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.rpcs = {}
+        self.explain = None
+        self.last_at = None
+
+    def to_dict(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "sample": self.sample_sql,
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 2),
+            "avg_ms": round(self.total * 1000 / self.count, 2) if self.count else 0,
+            "max_ms": round(self.max * 1000, 2),
+            "rpcs": self.rpcs,
+            "explain": self.explain,
+        }
+
+
+class SlowQueryRecorder(object):
+    """
+    慢查询记录器，hook签名与models.db.sql_hooks一致，EXPLAIN在db上执行；
+    其它库用for_database(database)取绑定到该库的hook，汇总记在同一个记录器里
+
+    threshold: 慢查询阈值（秒）；explain_rate: 已有EXPLAIN的指纹再次抽样的比例；
+    max_fingerprints: 最多聚合多少类查询，超出的只计入dropped
+    """
+
+    def __init__(self, db, threshold=0.2, explain_rate=0.05, max_fingerprints=500):
+        self.db = db
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.max_fingerprints = max_fingerprints
+        self.queries = {}
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def for_database(self, database):
+        return partial(self, database=database)
+
+    def __call__(self, sql, params, seconds, database=None):
+        if seconds < self.threshold:
+            return
+
+        tracker = metrics.current()
+        rpc = tracker.name if tracker else ""
+        fp = fingerprint(sql)
+        logger.warning("[slowquery] %.1fms rpc:%s sql:%s", seconds * 1000, rpc, fp)
+
+        with self._lock:
+            query = self.queries.get(fp)
+            if query is None:
+                if len(self.queries) >= self.max_fingerprints:
+                    self.dropped += 1
+                    return
+                query = self.queries[fp] = SlowQuery(fp, sql)
+            query.count += 1
+            query.total += seconds
+            query.max = max(query.max, seconds)
+            query.last_at = time.time()
+            query.rpcs[rpc] = query.rpcs.get(rpc, 0) + 1
+            need_explain = query.explain is None or random.random() < self.explain_rate
+
+        if need_explain and sql.lstrip()[:6].upper() == "SELECT":
+            query.explain = self.explain(sql, params, database)
+
+    def explain(self, sql, params, database=None):
+        """
+        在database(默认为db)上执行EXPLAIN，返回每行执行计划
+
+        直接用游标执行，不经过execute_sql，也就不会再触发sql hook
+        """
+        database = database or self.db
+        prefix = "EXPLAIN QUERY PLAN " if isinstance(database, pw.SqliteDatabase) \
+            else "EXPLAIN "
+        try:
+            cursor = database.get_cursor()
+            cursor.execute(prefix + sql, params or ())
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.warning("[slowquery] explain failed: %s", e)
+            return None
+
+    def report(self, limit=20):
+        """
+        按总耗时倒序的慢查询汇总
+        """
+        with self._lock:
+            queries = sorted(self.queries.values(), key=lambda q: q.total, reverse=True)
+            return [q.to_dict() for q in queries[:limit]]
+
+    def reset(self):
+        with self._lock:
+            self.queries.clear()
+            self.dropped = 0
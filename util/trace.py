@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+请求关联id和耗时分段
+
+每次RPC/定时任务由Correlation依赖在worker里开一个上下文：关联id优先取调用方通过
+nameko调用头传来的correlation_id，没有则新生成，并写回worker_ctx.data，之后
+本worker发出的RPC、事件都会带上。
+
+订单流程跨多个请求(create_order、支付回调、deliver_result…)，bind_order把
+订单号和第一次见到它的关联id记在Redis里，后续请求处理同一订单时沿用这个id，
+同一订单的日志和分段都能串起来。
+
+span()记录一段调用的耗时，worker结束时交给后台执行器按关联id用一次pipeline
+写入Redis，不占RPC的耗时；get_spans()按时间顺序取回，用来看订单生命周期里
+时间花在了哪一段。
+"""
+import time
+import uuid
+import logging
+import threading
+import ujson as json
+
+from functools import wraps
+from contextlib import contextmanager
+from nameko.extensions import DependencyProvider
+from util import thread_call_out
+from util.executor import QueueFull
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_KEY = "correlation_id"     # nameko调用头里的key
+TRACE_EXPIRE = 7 * 24 * 3600       # 关联id和分段在Redis里保存的秒数
+MAX_SPANS = 500                    # 每个关联id最多保存的分段数
+
+_local = threading.local()
+
+
+class Context(object):
+    """
+    一个worker的关联上下文
+    """
+
+    def __init__(self, correlation_id=None, name="", data=None):
+        self.correlation_id = correlation_id or new_id()
+        self.name = name
+        self.data = data            # worker_ctx.data，发出的调用从这里取调用头
+        self.order_no = None
+        self.start = time.time()
+        self.spans = []
+
+
+def new_id():
+    return uuid.uuid4().hex
+
+
+def current():
+    """
+    当前协程的关联上下文，没有则返回None
+    """
+    return getattr(_local, "context", None)
+
+
+def current_id():
+    context = current()
+    return context.correlation_id if context else None
+
+
+def start(correlation_id=None, name="", data=None):
+    _local.context = Context(correlation_id, name, data)
+    return _local.context
+
+
+def finish():
+    """
+    结束当前上下文，把整个worker记为一段，在后台写入分段；后台队列满时丢弃
+    """
+    context = current()
+    if context is None:
+        return
+    _local.context = None
+    if context.spans:
+        context.spans.append(_make_span(context, "rpc.%s" % context.name, context.start,
+                                        time.time(), False))
+        try:
+            thread_call_out(flush, context.spans)
+        except QueueFull:
+            logger.warning("[trace] executor queue full, drop %s spans", len(context.spans))
+
+
+@contextmanager
+def scope(correlation_id=None, name=""):
+    start(correlation_id, name)
+    try:
+        yield current()
+    finally:
+        finish()
+
+
+def bind_order(order_no):
+    """
+    当前上下文处理订单order_no：第一次见到的订单记下当前关联id，
+    之前见过的订单改用当时的关联id
+    """
+    context = current()
+    if context is None or not order_no or context.order_no == order_no:
+        return
+    context.order_no = order_no
+
+    from util.rds import pipeline, RedisKeys
+    key = RedisKeys.TRACE_ORDER % order_no
+    try:
+        with pipeline() as pipe:
+            pipe.set(key, context.correlation_id, ex=TRACE_EXPIRE, nx=True)
+            pipe.get(key)
+        stored = pipe.results[1]
+    except Exception:
+        logger.warning("[trace] bind order %s failed", order_no, exc_info=True)
+        return
+    if stored and stored != context.correlation_id:
+        logger.info("[trace](%s) order %s continues %s", context.correlation_id, order_no, stored)
+        context.correlation_id = stored
+        if context.data is not None:
+            context.data[CONTEXT_KEY] = stored
+
+
+def _make_span(context, name, begin, end, error):
+    span = {
+        "cid": context.correlation_id,
+        "name": name,
+        "start": round(begin, 3),
+        "ms": int((end - begin) * 1000),
+    }
+    if context.order_no:
+        span["order_no"] = context.order_no
+    if error:
+        span["error"] = True
+    return span
+
+
+@contextmanager
+def span(name):
+    """
+    记录一段调用的耗时；不在上下文里时什么都不做
+    """
+    context = current()
+    if context is None:
+        yield
+        return
+
+    begin = time.time()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        if len(context.spans) < MAX_SPANS:
+            context.spans.append(_make_span(context, name, begin, time.time(), error))
+
+
+def traced(name):
+    """
+    把函数调用记成一段
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrap(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrap
+    return decorator
+
+
+def flush(spans):
+    """
+    按关联id写入分段；同一worker中途改用订单的关联id时会分到两个id下
+    """
+    from util.rds import batch, RedisKeys
+
+    groups = {}
+    for item in spans:
+        groups.setdefault(item["cid"], []).append(json.dumps(item))
+    commands = []
+    for cid, items in groups.items():
+        key = RedisKeys.TRACE_SPANS % cid
+        commands.append(("rpush", key) + tuple(items))
+        commands.append(("ltrim", key, -MAX_SPANS, -1))
+        commands.append(("expire", key, TRACE_EXPIRE))
+    try:
+        batch(commands)
+    except Exception:
+        logger.warning("[trace] flush %s spans failed", len(spans), exc_info=True)
+
+
+def get_spans(correlation_id=None, order_no=None):
+    """
+    按开始时间排序的分段；给订单号时取该订单的关联id
+    """
+    from util.rds import get_redis, RedisKeys
+
+    rds = get_redis()
+    if order_no:
+        correlation_id = rds.get(RedisKeys.TRACE_ORDER % order_no)
+    if not correlation_id:
+        return []
+    spans = [json.loads(item) for item in rds.lrange(RedisKeys.TRACE_SPANS % correlation_id, 0, -1)]
+    return sorted(spans, key=lambda item: item["start"])
+
+
+class Correlation(DependencyProvider):
+    """
+    服务上声明 correlation = Correlation()，worker内可以用self.correlation取到当前关联id
+    """
+
+    def worker_setup(self, worker_ctx):
+        context = start(worker_ctx.data.get(CONTEXT_KEY), worker_ctx.entrypoint.method_name,
+                        worker_ctx.data)
+        worker_ctx.data[CONTEXT_KEY] = context.correlation_id
+
+    def worker_teardown(self, worker_ctx):
+        finish()
+
+    def get_dependency(self, worker_ctx):
+        return current_id